@@ -1,11 +1,21 @@
 import datetime
-from typing import Dict, List, Tuple, Union
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+import requests
 import stride
+import metrics
+import stride_transport
+from lookup_cache import persistent_cache
 
 pre_requests_callback = "print"
 pre_requests_callback = None
 
 from consts import (
+    MAX_RETRIES,
+    RETRY_BACKOFF,
+    STRIDE_PAGE_SIZE,
+    STRIDE_REQUESTS_PER_SECOND,
     LineRef,
     LocationId,
     OperatorRef,
@@ -18,12 +28,92 @@ from consts import (
 )
 
 
+class RateLimiter:
+    """
+    a thread safe token bucket: allows rate calls per second on average,
+    and bursts of up to burst calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        blocks until a call is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(STRIDE_REQUESTS_PER_SECOND)
+
+
+def set_rate_limit(requests_per_second: Optional[float], burst: int = 1):
+    """
+    sets the maximum rate of stride requests, None for no limit.
+    """
+    global rate_limiter
+    rate_limiter = (
+        None if requests_per_second is None else RateLimiter(requests_per_second, burst)
+    )
+
+
+transport = stride_transport.from_environment(pre_requests_callback)
+
+
+def set_transport(new_transport):
+    """
+    sets the transport the stride requests are sent through (see stride_transport.py).
+    """
+    global transport
+    transport = new_transport
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, stride.StrideRequestFailedException):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def stride_get(path: str, params: Dict):
+    """
+    stride.get with rate limiting, and retries with exponential backoff
+    for network errors and server errors.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        metrics.count("api_calls", path=path)
+        try:
+            with metrics.span("stride_get", path=path):
+                return transport.get(path, params)
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+
+
 def comma_separated_string(l) -> str:
     if hasattr(l, "__iter__") and not isinstance(l, str):
         return ",".join([str(i) for i in l])
     return str(l)
 
 
+@metrics.timed("get_locations_for_kmenas")
 def get_locations_for_kmenas(
     locations_ids: List[LocationId],
     siri_ride_stop_ids: List[SiriRideStopId],
@@ -31,7 +121,7 @@ def get_locations_for_kmenas(
     operator_ref: OperatorRef,
 ) -> List[Dict]:
 
-    return stride.get(
+    return stride_get(
         "/siri_vehicle_locations/list",
         {
             "limit": 1000000,
@@ -41,7 +131,6 @@ def get_locations_for_kmenas(
             "siri_routes__operator_ref": operator_ref,
             "order_by": "recorded_at_time desc",
         },
-        pre_requests_callback=pre_requests_callback,
     )
 
 
@@ -51,7 +140,7 @@ def get_locations(
     line_refs: List[LineRef],
     operator_refs: List[LineRef],
 ) -> List[Dict]:
-    return stride.get(
+    return stride_get(
         "/siri_vehicle_locations/list",
         {
             "limit": 1000000,
@@ -61,51 +150,181 @@ def get_locations(
             "siri_rides__schedualed_start_time_to": to_day,
             "order_by": "recorded_at_time desc",
         },
-        pre_requests_callback=pre_requests_callback,
     )
 
 
-def get_locations_by_ride_id(ride_ids: List[SiriRideId]) -> List[Dict]:
-    return stride.get(
+def get_locations_by_ride_id(
+    ride_ids: List[SiriRideId], page_size: int = STRIDE_PAGE_SIZE
+) -> List[Dict]:
+    """
+    returns all of the vehicle locations of the rides, fetched page by page
+    (see iterate_locations_by_ride_id), so a request's limit doesn't cut them off.
+    """
+    return [
+        location
+        for page in iterate_locations_by_ride_id(ride_ids, page_size)
+        for location in page
+    ]
+
+
+def iterate_pages(
+    path: str, params: Dict, page_size: int = STRIDE_PAGE_SIZE
+) -> Iterator[List[Dict]]:
+    """
+    yields the results of a stride list query page by page, page_size records per request,
+    so only a single page is held in memory at a time.
+    the params should order the results by a unique order, or records may repeat or be skipped between pages.
+    """
+    offset = 0
+    while True:
+        page = stride_get(path, {**params, "limit": page_size, "offset": offset})
+        if len(page) > 0:
+            yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def iterate_list(
+    path: str, params: Dict, page_size: int = STRIDE_PAGE_SIZE
+) -> Iterator[Dict]:
+    """
+    yields the records of a stride list query one by one, see iterate_pages.
+    """
+    for page in iterate_pages(path, params, page_size):
+        yield from page
+
+
+def iterate_locations_by_ride_id(
+    ride_ids: List[SiriRideId], page_size: int = STRIDE_PAGE_SIZE
+) -> Iterator[List[Dict]]:
+    """
+    yields the vehicle locations of the rides, ordered by recorded_at_time desc, page by page.
+    """
+    return iterate_pages(
         "/siri_vehicle_locations/list",
+        {
+            "siri_rides__ids": comma_separated_string(ride_ids),
+            "order_by": "recorded_at_time desc,id desc",
+        },
+        page_size,
+    )
+
+
+def iterate_rides(
+    from_time: datetime.datetime,
+    to_time: datetime.datetime,
+    line_refs: List[LineRef],
+    operator_refs: List[OperatorRef],
+    page_size: int = STRIDE_PAGE_SIZE,
+) -> Iterator[List[Dict]]:
+    """
+    yields the rides of the lines scheduled to start between from_time and to_time, page by page.
+    """
+    return iterate_pages(
+        "/siri_rides/list",
+        {
+            "scheduled_start_time_from": from_time,
+            "scheduled_start_time_to": to_time,
+            "siri_route__line_refs": comma_separated_string(line_refs),
+            "siri_route__operator_refs": comma_separated_string(operator_refs),
+            "order_by": "scheduled_start_time asc,id asc",
+        },
+        page_size,
+    )
+
+
+def get_ride_start_times(
+    from_time: datetime.datetime,
+    to_time: datetime.datetime,
+    line_refs: List[LineRef],
+    operator_refs: List[OperatorRef],
+) -> Dict[SiriRideId, datetime.datetime]:
+    """
+    returns the scheduled start time of every ride of the lines scheduled to start
+    between from_time and to_time, from a single paged query.
+    the start times are cached for get_start_time_for_ride_id too.
+    """
+    start_times = dict()
+    for page in iterate_rides(from_time, to_time, line_refs, operator_refs):
+        start_times.update({ride["id"]: ride["scheduled_start_time"] for ride in page})
+    get_start_time_for_ride_id.store(start_times)
+    return start_times
+
+
+def get_ride_stops(ride_ids: List[SiriRideId]) -> List[Dict]:
+    return stride_get(
+        "/siri_ride_stops/list",
         {
             "limit": 1000000,
-            "siri_rides__ids": ride_ids,
-            "order_by": "recorded_at_time desc",
+            "siri_ride_ids": comma_separated_string(ride_ids),
         },
-        pre_requests_callback=pre_requests_callback,
     )
 
 
+@persistent_cache
 def get_start_time_for_ride_id(ride_id: SiriRideId) -> datetime.datetime:
-    return stride.get(
+    return stride_get(
         "/siri_rides/get",
         {
             "id": ride_id,
         },
-        pre_requests_callback=pre_requests_callback,
     )["scheduled_start_time"]
 
 
+@persistent_cache
 def get_stop_id(stop_id: SiriRideId) -> SiriStopId:
-    return stride.get(
-        "/siri_ride_stops/get",
-        {"id": stop_id},
-        pre_requests_callback=pre_requests_callback,
-    )["siri_stop_id"]
+    return stride_get("/siri_ride_stops/get", {"id": stop_id})["siri_stop_id"]
 
 
+@persistent_cache
 def get_stop_name(stop_id: SiriStopId) -> SiriStopCode:
-    return stride.get(
-        "/siri_stops/get", {"id": stop_id}, pre_requests_callback=pre_requests_callback
-    )["code"]
+    return stride_get("/siri_stops/get", {"id": stop_id})["code"]
 
 
-def get_stop_position(code: int) -> Tuple[Longtitude, Latitute]:
-    gtfs_stop = stride.get(
-        "/gtfs_stops/list",
-        {"code": code, "limit": 1},
-        pre_requests_callback=pre_requests_callback,
+def get_siri_stop_ids(codes: List[SiriStopCode]) -> Dict[SiriStopCode, SiriStopId]:
+    """
+    returns the siri stop id of every stop code, in a single request.
+    the codes are cached for get_stop_name too.
+    """
+    siri_stops = stride_get(
+        "/siri_stops/list", {"limit": 1000000, "codes": comma_separated_string(codes)}
     )
+    get_stop_name.store({stop["id"]: stop["code"] for stop in siri_stops})
+    return {stop["code"]: stop["id"] for stop in siri_stops}
+
+
+def get_siri_operator_refs(line_refs: List[LineRef]) -> Dict[LineRef, Set[OperatorRef]]:
+    """
+    returns the operator refs of the siri routes of every line ref, from a single paged query.
+    """
+    operator_refs = {line_ref: set() for line_ref in line_refs}
+    for siri_route in iterate_list(
+        "/siri_routes/list",
+        {"line_refs": comma_separated_string(line_refs), "order_by": "id asc"},
+    ):
+        operator_refs.setdefault(siri_route["line_ref"], set()).add(
+            siri_route["operator_ref"]
+        )
+    return operator_refs
+
+
+def get_stop_position(code: int) -> Tuple[Longtitude, Latitute]:
+    """
+    returns the stop's location from the local GTFS tables (see gtfs.py) if there are any,
+    otherwise from stride.
+    """
+    # gtfs imports this module, so it is imported only when it is needed
+    import gtfs
+
+    tables = gtfs.get_gtfs_tables()
+    if tables is not None and code in tables.code_index:
+        return tables.stop_location(code)
+    return fetch_stop_position(code)
+
+
+@persistent_cache
+def fetch_stop_position(code: int) -> Tuple[Longtitude, Latitute]:
+    gtfs_stop = stride_get("/gtfs_stops/list", {"code": code, "limit": 1})
     gtfs_stop = gtfs_stop[0]
     return gtfs_stop["lon"], gtfs_stop["lat"]
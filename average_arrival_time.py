@@ -1,19 +1,30 @@
+import json
 import time
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 import pandas as pd
 from api_functions import (
-    get_locations,
     get_locations_by_ride_id,
+    get_ride_start_times,
+    get_ride_stops,
     get_start_time_for_ride_id,
     get_stop_id,
 )
 import datetime
 from dateutil import tz
 import os
+from catalog import discover_partitions, get_line_arrival_data
+from get_data import ArrivalDataWriter, arrival_data_file_name, get_arrival_data
+from location_store import store_locations
+import lookup_cache
+import metrics
 
 from consts import (
     START_HOUR,
     END_HOUR,
+    RIDES_PER_REQUEST,
+    WORKERS,
     OPERATOR_REFS,
     LINE_REFS,
     LineRef,
@@ -53,6 +64,7 @@ def generate_time_ranges(
     return time_ranges
 
 
+@metrics.timed("get_relevant_siri_ride_ids")
 def get_relevant_siri_ride_ids(
     start_time: datetime.datetime,
     end_time: datetime.datetime,
@@ -63,84 +75,293 @@ def get_relevant_siri_ride_ids(
 ) -> List[SiriRideId]:
     """
     Get relevant SIRI ride IDs based on the specified time range and line reference.
+    the rides of all the days are listed in one query (without their vehicle locations),
+    and the rides that start between start hour and end hour on their day are kept.
+    their start times are cached on the way, see get_ride_start_times.
     """
+    days_siri_ride_ids = get_relevant_siri_ride_ids_by_day(
+        start_time, end_time, line_ref, operator_ref, start_hour, end_hour
+    )
+    return set().union(*days_siri_ride_ids.values())
+
+
+def get_relevant_siri_ride_ids_by_day(
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    start_hour: datetime.time = START_HOUR,
+    end_hour: datetime.time = END_HOUR,
+) -> Dict[datetime.date, Set[SiriRideId]]:
+    """
+    like get_relevant_siri_ride_ids, returns the relevant ride ids of every day that has any.
+    the days and hours are of Israel time, naive times are taken as Israel time.
+    """
+    start_time, end_time = to_israel_time(start_time), to_israel_time(end_time)
     time_ranges = generate_time_ranges(start_time, end_time, start_hour, end_hour)
-    all_siri_ride_ids = set()
+    if len(time_ranges) == 0:
+        return dict()
+    day_ranges = {start.date(): (start, end) for start, end in time_ranges}
+
+    days_siri_ride_ids = dict()
+    start_times = get_ride_start_times(
+        time_ranges[0][0], time_ranges[-1][1], line_ref, operator_ref
+    )
+    for siri_ride_id, scheduled_start_time in start_times.items():
+        day = scheduled_start_time.astimezone(start_time.tzinfo).date()
+        day_range = day_ranges.get(day)
+        if (
+            day_range is not None
+            and day_range[0] <= scheduled_start_time <= day_range[1]
+        ):
+            days_siri_ride_ids.setdefault(day, set()).add(siri_ride_id)
 
-    for start, end in time_ranges:
-        locations_df = pd.DataFrame(get_locations(start, end, line_ref, operator_ref))
-        if "siri_ride__id" not in locations_df.columns:
-            continue
-        siri_ride_ids = locations_df["siri_ride__id"].unique().tolist()
-        all_siri_ride_ids.update(siri_ride_ids)
+    return days_siri_ride_ids
 
-    return all_siri_ride_ids
 
+def to_israel_time(time: datetime.datetime) -> datetime.datetime:
+    """
+    returns the time in Israel time, a naive time is taken as Israel time.
+    """
+    israel = tz.gettz("Israel")
+    if time.tzinfo is None:
+        return time.replace(tzinfo=israel)
+    return time.astimezone(israel)
 
+
+@metrics.timed("generate_data")
 def generate_data(
     start_time: datetime.datetime,
     end_time: datetime.datetime,
     line_ref: LineRef,
     operator_ref: OperatorRef,
+    file_format: str = "csv",
+    incremental: bool = False,
+    workers: int = WORKERS,
 ) -> pd.DataFrame:
     """
     Generate data for the specified time range and line reference.
-    If the data already exists in a CSV file, it will be loaded from there.
-    """
+    If the data already exists in a file of the given format ("csv" or "columnar"),
+    it will be loaded from there.
 
-    file_name = f"{start_time.date()}-{end_time.date()},REF{line_ref}.csv"
-    if not os.path.exists(file_name):
+    If incremental is set, only the days that are not covered yet for the line
+    are fetched (see refresh_data), and the data is loaded from all the line's files.
+    up to workers rides are fetched concurrently.
 
-        results_df = pd.DataFrame(
-            columns=[
-                "id",
-                "date",
-                "day_of_week",
-                "start_time",
-                "siri_stop_id",
-                "siri_ride_stop_id",
-                "arrival_time",
-            ]
+    the data is returned with the schema of get_arrival_data (start_time and arrival_time in
+    seconds since midnight, a categorical day_of_week), not as the strings of the csv file.
+    """
+    if incremental:
+        refresh_data(
+            start_time,
+            end_time,
+            line_ref,
+            operator_ref,
+            file_format=file_format,
+            workers=workers,
         )
+        return get_line_arrival_data(line_ref, start_time.date(), end_time.date())
+
+    file_name = arrival_data_file_name(
+        start_time.date(), end_time.date(), line_ref, file_format
+    )
+    if not os.path.exists(file_name):
         siri_ride_ids = get_relevant_siri_ride_ids(
             start_time, end_time, line_ref, operator_ref
         )
         print(f"\nFound {len(siri_ride_ids)} relevant unique ride ids!\n")
 
-        for i, id in enumerate(tqdm(siri_ride_ids, desc="Processing rides")):
-            start_time = get_start_time_for_ride_id(id)
-            day_of_week = start_time.strftime("%A")
-            date = start_time.astimezone(tz.gettz("Israel")).date()
-            start_time = start_time.astimezone(tz.gettz("Israel")).time()
-            arrival_times = get_arrival_times([id])
-
-            for stop_ids, arrival_time in arrival_times.items():
-                siri_stop_id, siri_ride_stop_id = int(stop_ids[0]), int(stop_ids[1])
-                arrival_time = arrival_time.astimezone(tz.gettz("Israel")).time()
-
-                results_df = pd.concat(
-                    [
-                        results_df,
-                        pd.DataFrame(
-                            [
-                                {
-                                    "id": id,
-                                    "date": date,
-                                    "day_of_week": day_of_week,
-                                    "start_time": start_time,
-                                    "siri_ride_stop_id": siri_ride_stop_id,
-                                    "siri_stop_id": siri_stop_id,
-                                    "arrival_time": arrival_time,
-                                }
-                            ]
-                        ),
-                    ],
-                    ignore_index=True,
-                )
-
-        results_df.to_csv(file_name, index=False)
-        return results_df
-    return pd.read_csv(file_name)
+        generate_rides_data(siri_ride_ids, file_name, workers)
+    return get_arrival_data(file_name)
+
+
+@metrics.timed("generate_rides_data")
+def generate_rides_data(
+    siri_ride_ids: List[SiriRideId],
+    file_name: str,
+    workers: int = WORKERS,
+    rides_per_request: int = RIDES_PER_REQUEST,
+):
+    """
+    writes the arrival data rows (one per stop arrival) of the given rides to file_name.
+    the rows are streamed to disk in chunks while the rides are processed.
+
+    the rides are fetched in chunks of rides_per_request rides (see get_rides_arrival_times),
+    up to workers chunks concurrently (the stride requests are rate limited in api_functions),
+    and the rows are written in the order of the sorted ride ids.
+    the fetched vehicle locations of the rides are saved to the location store, for the knn.
+    """
+    siri_ride_ids = sorted(siri_ride_ids)
+    chunks = [
+        siri_ride_ids[i : i + rides_per_request]
+        for i in range(0, len(siri_ride_ids), rides_per_request)
+    ]
+    with ArrivalDataWriter(file_name) as writer, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        # only a bounded window of chunks is in flight, so the rows of finished chunks
+        # are written in order without holding the rows of all the rides in memory.
+        window = workers * 2
+        futures = deque()
+        with tqdm(total=len(siri_ride_ids), desc="Processing rides") as progress:
+            for chunk in chunks:
+                futures.append((len(chunk), executor.submit(get_rides_rows, chunk)))
+                if len(futures) >= window:
+                    write_rows(writer, futures.popleft(), progress)
+            while futures:
+                write_rows(writer, futures.popleft(), progress)
+
+
+def write_rows(writer: ArrivalDataWriter, chunk, progress: tqdm):
+    rides, future = chunk
+    rows, locations = future.result()
+    for row in rows:
+        writer.append(**row)
+    store_locations(locations)
+    progress.update(rides)
+
+
+@metrics.timed("get_rides_rows")
+def get_rides_rows(ids: List[SiriRideId]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    returns the arrival data rows (one per stop arrival) of the rides, ride by ride,
+    and the vehicle locations of the rides they were calculated from.
+    """
+    locations = get_locations_by_ride_id(ids)
+    rides_arrival_times = get_rides_arrival_times(ids, locations)
+
+    rows = []
+    for id in ids:
+        start_time = get_start_time_for_ride_id(id)
+        day_of_week = start_time.strftime("%A")
+        date = start_time.astimezone(tz.gettz("Israel")).date()
+        start_time = start_time.astimezone(tz.gettz("Israel")).time()
+
+        for stop_ids, arrival_time in rides_arrival_times[id].items():
+            siri_stop_id, siri_ride_stop_id = int(stop_ids[0]), int(stop_ids[1])
+            arrival_time = arrival_time.astimezone(tz.gettz("Israel")).time()
+
+            rows.append(
+                {
+                    "id": id,
+                    "date": date,
+                    "day_of_week": day_of_week,
+                    "start_time": start_time,
+                    "siri_ride_stop_id": siri_ride_stop_id,
+                    "siri_stop_id": siri_stop_id,
+                    "arrival_time": arrival_time,
+                }
+            )
+    return rows, locations
+
+
+def manifest_path(line_ref: LineRef, directory: str = ".") -> str:
+    return os.path.join(directory, f"REF{line_ref}.manifest.json")
+
+
+def get_covered_days(line_ref: LineRef, directory: str = ".") -> Set[datetime.date]:
+    """
+    returns the days that were already fetched for the line:
+    the days in its manifest, and the days in the range of every arrival data file of the line.
+    """
+    covered_days = set()
+    path = manifest_path(line_ref, directory)
+    if os.path.exists(path):
+        with open(path) as f:
+            covered_days.update(
+                datetime.date.fromisoformat(day) for day in json.load(f)["covered_days"]
+            )
+    for partition in discover_partitions(directory):
+        if partition.line_ref == line_ref:
+            covered_days.update(
+                pd.date_range(partition.start_date, partition.end_date).date
+            )
+    return covered_days
+
+
+def save_covered_days(
+    line_ref: LineRef, covered_days: Set[datetime.date], directory: str = "."
+):
+    path = manifest_path(line_ref, directory)
+    with open(path + ".tmp", "w") as f:
+        json.dump(
+            {"covered_days": [day.isoformat() for day in sorted(covered_days)]},
+            f,
+            indent=1,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def refresh_data(
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    directory: str = ".",
+    file_format: str = "csv",
+    workers: int = WORKERS,
+) -> List[str]:
+    """
+    fetches only the days between start_time and end_time that are not covered yet for the line.
+    today and later days are skipped, their rides may not have all been recorded yet.
+
+    every run of consecutive days with rides is written as a new arrival data file
+    ({first_day}-{last_day},REF{line_ref}), existing files are never rewritten,
+    and the line's data (see catalog.py) includes the new files once they are written.
+    the days are recorded as covered in the line's manifest as soon as their file is written,
+    so an interrupted refresh continues where it stopped. days without rides aren't covered,
+    they are looked up again on the next refresh.
+    returns the paths of the new files.
+    """
+    covered_days = get_covered_days(line_ref, directory)
+    today = datetime.datetime.now(start_time.tzinfo).date()
+    missing_days = [
+        day
+        for day in pd.date_range(start_time.date(), end_time.date()).date
+        if day not in covered_days and day < today
+    ]
+    print(f"\n{len(missing_days)} days are missing for line {line_ref}\n")
+
+    new_files = []
+    for run in consecutive_runs(missing_days):
+        days_siri_ride_ids = get_relevant_siri_ride_ids_by_day(
+            datetime.datetime.combine(
+                run[0], datetime.time(), tzinfo=start_time.tzinfo
+            ),
+            datetime.datetime.combine(
+                run[-1], datetime.time(), tzinfo=start_time.tzinfo
+            ),
+            line_ref,
+            operator_ref,
+        )
+        for days in consecutive_runs(sorted(days_siri_ride_ids)):
+            siri_ride_ids = set().union(*(days_siri_ride_ids[day] for day in days))
+            print(
+                f"\nFound {len(siri_ride_ids)} relevant unique ride ids for {days[0]} - {days[-1]}!\n"
+            )
+            file_name = os.path.join(
+                directory,
+                arrival_data_file_name(days[0], days[-1], line_ref, file_format),
+            )
+            generate_rides_data(siri_ride_ids, file_name, workers)
+            new_files.append(file_name)
+            covered_days.update(days)
+            save_covered_days(line_ref, covered_days, directory)
+
+    return new_files
+
+
+def consecutive_runs(days: List[datetime.date]) -> List[List[datetime.date]]:
+    """
+    splits sorted days into runs of consecutive days.
+    """
+    runs = []
+    for day in days:
+        if runs and runs[-1][-1] + datetime.timedelta(days=1) == day:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
 
 
 def find_id_of_closest_to_stop(
@@ -183,6 +404,72 @@ def get_arrival_times(
     return times
 
 
+def get_rides_arrival_times(
+    ids: List[SiriRideId], locations: Optional[List[Dict]] = None
+) -> Dict[SiriRideId, dict[tuple[SiriStopId, SiriRideStopId], datetime.datetime]]:
+    """
+    like get_arrival_times, for many rides at once:
+    returns a dict ride id : (stop : arrival time) for each of the rides.
+
+    the locations of all the rides are fetched in a single request (unless they are given)
+    and split by ride, and the siri_stop_ids of all their stops are resolved with a single request.
+    """
+    times = {id: dict() for id in ids}
+    if locations is None:
+        locations = get_locations_by_ride_id(ids)
+    loc_df = pd.DataFrame(locations)
+    if loc_df.empty:
+        return times
+
+    closest = loc_df.loc[
+        loc_df.groupby(["siri_ride__id", "siri_ride_stop_id"])[
+            "distance_from_journey_start"
+        ].idxmax()
+    ]
+    stop_ids = get_stop_ids(ids, closest["siri_ride_stop_id"].unique())
+    for ride_id, siri_ride_stop_id, recorded_at_time in zip(
+        closest["siri_ride__id"],
+        closest["siri_ride_stop_id"],
+        closest["recorded_at_time"],
+    ):
+        if ride_id in times:
+            times[ride_id][
+                (stop_ids[siri_ride_stop_id], siri_ride_stop_id)
+            ] = recorded_at_time
+    return times
+
+
+def get_stop_ids(
+    ride_ids: List[SiriRideId], siri_ride_stop_ids: List[SiriRideStopId]
+) -> Dict[SiriRideStopId, SiriStopId]:
+    """
+    returns the siri_stop_id of each of the ride stops of the rides.
+    ride stops that aren't in the lookup cache are resolved with one request for all the rides.
+    """
+    stop_ids = {
+        int(siri_ride_stop_id): get_stop_id.cached(int(siri_ride_stop_id))
+        for siri_ride_stop_id in siri_ride_stop_ids
+    }
+    missing = [
+        siri_ride_stop_id
+        for siri_ride_stop_id, stop_id in stop_ids.items()
+        if stop_id is lookup_cache.MISSING
+    ]
+    if len(missing) > 0:
+        fetched = {
+            ride_stop["id"]: ride_stop["siri_stop_id"]
+            for ride_stop in get_ride_stops(ride_ids)
+        }
+        get_stop_id.store(fetched)
+        for siri_ride_stop_id in missing:
+            stop_ids[siri_ride_stop_id] = (
+                fetched[siri_ride_stop_id]
+                if siri_ride_stop_id in fetched
+                else get_stop_id(siri_ride_stop_id)
+            )
+    return stop_ids
+
+
 def main():
     from_time = datetime.datetime(2024, 12, 1, 0, 1, tzinfo=tz.gettz("Israel"))
     to_time = datetime.datetime(2024, 12, 2, 0, 0, tzinfo=tz.gettz("Israel"))
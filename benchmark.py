@@ -0,0 +1,761 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+import numpy as np
+import pandas as pd
+from dateutil import tz
+
+import api_functions
+import fake_stride
+import neighbors
+import stride
+from average_arrival_time import generate_data
+from consts import (
+    K,
+    LINE_REFS,
+    OPERATOR_REFS,
+    ROUTES_FILE,
+    SPATIAL_INDEX_MIN_LOCATIONS,
+    SiriStopId,
+)
+from get_data import (
+    ARRIVAL_DATA_DTYPES,
+    ARRIVAL_DATA_FILE,
+    FILE_FORMATS,
+    convert_to_columnar,
+    get_arrival_data,
+    load_arrival_data,
+    read_arrival_data,
+    time_to_seconds,
+)
+from knn import next_stops_eta, run_knn, run_knn_batch, run_knn_vectorized
+from location_store import store_locations
+from neighbors import (
+    calculate_times_to_arrive,
+    get_relavent_ids,
+    run_route_knn,
+    run_route_knn_batch,
+)
+from route import PositionIndex, Route, get_file_route, get_route
+from spatial_index import GridIndex
+from stop_to_stop import calculate_time_diffs, generate_time_diffs
+
+# sizes of the synthetic neighbor sets of the knn benchmark
+KNN_SIZES = [1000, 10000, 50000, 100000]
+# the number of random queries per neighbor set
+KNN_QUERIES = 20
+# the number of vehicles in a batch of the knn batch benchmark
+KNN_BATCH_SIZE = 200
+# the suite runs on the bundled arrival data repeated this many times
+SUITE_SCALES = [1, 10, 100]
+# the number of (slot, next stop, position) queries of the suite
+SUITE_QUERIES = 20
+# generate_data fetches the whole dataset from the fake api, so it is only timed up to this scale
+GENERATE_DATA_MAX_SCALE = 10
+# the bundled month that generate_data builds again in the suite
+GENERATE_DATA_FILE = "2025-01-01-2025-01-31,REF29094.csv"
+SUITE_RESULTS_FILE = "benchmark_results.json"
+SUITE_QUERIES_FILE = "suite_queries.json"
+
+
+def generate_time_diffs_loop(
+    filtered_data: pd.DataFrame, start_time: datetime.datetime, route: Route
+) -> Dict[SiriStopId, float]:
+    """
+    the original per-ride implementation of stop_to_stop.calculate_time_diffs.
+    kept only as a baseline for the benchmarks.
+    """
+    stops = route.stop_ids
+    rides = filtered_data["id"].unique()
+    all_times = {stop: list() for stop in stops}
+    for i in range(1, len(stops)):
+        last = stops[i - 1]
+        curr = stops[i]
+
+        for ride in rides:
+
+            last_entry = filtered_data[
+                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == last)
+            ]
+
+            curr_entry = filtered_data[
+                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == curr)
+            ]
+
+            if len(curr_entry) != 1 or len(last_entry) != 1:
+                if len(curr_entry) == 0 or len(last_entry) == 0:
+                    continue
+                else:
+                    raise ValueError(
+                        f"Expected one entry for a ride, found more then one with ride {ride}, stop: {curr}, or stop: {last}"
+                    )
+            last_time = last_entry["arrival_time"].values[0]
+            curr_time = curr_entry["arrival_time"].values[0]
+            curr_time = datetime.datetime.strptime(curr_time, "%H:%M:%S")
+            last_time = datetime.datetime.strptime(last_time, "%H:%M:%S")
+
+            diff = (curr_time - last_time).total_seconds()
+            all_times[curr].append(diff)
+
+    for stop in stops[1:]:
+        if len(all_times[stop]) == 0:
+            raise ValueError(f"No data found for stop {stop} at {start_time.time()}")
+
+    times = {stop: sum(all_times[stop]) / len(all_times[stop]) for stop in stops[1:]}
+    return times
+
+
+def time_call(func: Callable, *args, repeat: int = 3):
+    """
+    calls func(*args) repeat times.
+    returns the best run time in seconds and the result of the last call,
+    or the message of the ValueError it raised.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except ValueError as e:
+            result = str(e)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_time_diffs(repeat: int = 3):
+    """
+    compares the vectorized stop to stop engine against the per-ride loop,
+    on every (day_of_week, start_time) slot of the arrival data.
+    the loop runs on the raw csv, the same way it did before the typed loader.
+    """
+    raw_data = pd.read_csv(ARRIVAL_DATA_FILE)
+    arrival_data = load_arrival_data(ARRIVAL_DATA_FILE)
+    route = get_file_route(ARRIVAL_DATA_FILE)
+    loop_total = 0
+    vectorized_total = 0
+    for (day_of_week, start_hour), filtered_data in raw_data.groupby(
+        ["day_of_week", "start_time"]
+    ):
+        start_time = datetime.datetime.strptime(start_hour, "%H:%M:%S")
+        typed_data = arrival_data.data.iloc[
+            arrival_data.slot_index[(day_of_week, time_to_seconds(start_time))]
+        ]
+        loop_time, expected = time_call(
+            generate_time_diffs_loop, filtered_data, start_time, route, repeat=repeat
+        )
+        vectorized_time, result = time_call(
+            calculate_time_diffs, typed_data, start_time, route, repeat=repeat
+        )
+
+        if result != expected:
+            raise AssertionError(
+                f"results differ for {day_of_week} {start_hour}: {expected} != {result}"
+            )
+        loop_total += loop_time
+        vectorized_total += vectorized_time
+        print(
+            f"{day_of_week:<10} {start_hour} rides: {filtered_data['id'].nunique():>3} "
+            f"loop: {loop_time * 1000:8.2f}ms vectorized: {vectorized_time * 1000:6.2f}ms"
+        )
+
+    print(
+        f"total loop: {loop_total:.3f}s vectorized: {vectorized_total:.3f}s "
+        f"speedup: x{loop_total / vectorized_total:.1f}"
+    )
+
+
+def benchmark_load_formats(repeat: int = 5):
+    """
+    compares the cold load time of the bundled arrival data files in each format:
+    the plain csv read, the typed csv read and the memory-mapped columnar read.
+    the columnar datasets are converted from the csv files if they are missing.
+    """
+    for csv_path in sorted(glob.glob("*,REF*.csv")):
+        columnar_path = csv_path[: -len(FILE_FORMATS["csv"])] + FILE_FORMATS["columnar"]
+        if not os.path.exists(columnar_path):
+            convert_to_columnar(csv_path)
+
+        raw_time, data = time_call(pd.read_csv, csv_path, repeat=repeat)
+        typed_time, _ = time_call(read_arrival_data, csv_path, repeat=repeat)
+        columnar_time, _ = time_call(read_arrival_data, columnar_path, repeat=repeat)
+        print(
+            f"{csv_path} rows: {len(data):>6} read_csv: {raw_time * 1000:7.2f}ms "
+            f"typed csv: {typed_time * 1000:7.2f}ms columnar: {columnar_time * 1000:6.2f}ms"
+        )
+
+
+def synthetic_locations(size: int, seed: int = 0) -> pd.DataFrame:
+    """
+    returns size random vehicle locations spread around the stops of the route,
+    recorded between 07:00 and 07:10 (Israel time) on the way to one of 100 ride stops.
+    """
+    rng = np.random.default_rng(seed)
+    route = get_route()
+    stops = np.column_stack([route.lons, route.lats])
+    around = stops[rng.integers(0, len(stops), size)]
+    recorded_at_time = pd.Timestamp("2025-01-22 05:00", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 600, size), unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "lon": around[:, 0] + rng.normal(0, 0.002, size),
+            "lat": around[:, 1] + rng.normal(0, 0.002, size),
+            "siri_ride_stop_id": rng.integers(0, 100, size),
+            "recorded_at_time": recorded_at_time.to_pydatetime(),
+        }
+    )
+
+
+def benchmark_knn(repeat: int = 3):
+    """
+    compares the dataframe knn (knn.run_knn) against the array knn (knn.run_knn_vectorized),
+    with and without the spatial index, on synthetic neighbor sets of KNN_SIZES locations.
+    every query's results are checked to be the same.
+    the knn along the route (neighbors.run_route_knn) is timed too, its results use another distance.
+    """
+    rng = np.random.default_rng(1)
+    arrival_dict = {i: 7 * 3600 + 600 + i * 10 for i in range(100)}
+    for size in KNN_SIZES:
+        locations = synthetic_locations(size)
+        lons = locations["lon"].to_numpy(dtype=float)
+        lats = locations["lat"].to_numpy(dtype=float)
+        times_to_arrive = calculate_times_to_arrive(locations, arrival_dict)
+        index = GridIndex(lons, lats)
+        route = get_route()
+        position_index = PositionIndex(route.project_many(lons, lats))
+        queries = np.column_stack(
+            [
+                rng.uniform(lons.min(), lons.max(), KNN_QUERIES),
+                rng.uniform(lats.min(), lats.max(), KNN_QUERIES),
+            ]
+        )
+
+        totals = {"dataframe": 0.0, "arrays": 0.0, "arrays + index": 0.0, "route": 0.0}
+        for lon, lat in queries:
+            dataframe_time, expected = time_call(
+                lambda: run_knn(locations.copy(), arrival_dict, None, lon, lat, K),
+                repeat=repeat,
+            )
+            arrays_time, result = time_call(
+                run_knn_vectorized,
+                lons,
+                lats,
+                times_to_arrive,
+                lon,
+                lat,
+                K,
+                repeat=repeat,
+            )
+            index_time, indexed_result = time_call(
+                run_knn_vectorized,
+                lons,
+                lats,
+                times_to_arrive,
+                lon,
+                lat,
+                K,
+                index,
+                repeat=repeat,
+            )
+            if not np.isclose(result, expected) or not np.isclose(
+                indexed_result, expected
+            ):
+                raise AssertionError(
+                    f"results differ at ({lon}, {lat}): "
+                    f"{expected} != {result} / {indexed_result}"
+                )
+            totals["dataframe"] += dataframe_time
+            totals["arrays"] += arrays_time
+            totals["arrays + index"] += index_time
+            totals["route"] += time_call(
+                lambda: run_route_knn(
+                    position_index, times_to_arrive, route.project(lon, lat), K
+                ),
+                repeat=repeat,
+            )[0]
+
+        print(
+            f"locations: {size:>6} "
+            + " ".join(
+                f"{name}: {total / KNN_QUERIES * 1000:8.3f}ms"
+                for name, total in totals.items()
+            )
+            + f" speedup: x{totals['dataframe'] / totals['arrays']:.1f}"
+        )
+
+
+def benchmark_knn_batch(repeat: int = 3):
+    """
+    compares a batch of KNN_BATCH_SIZE positions estimated one by one against the same batch
+    estimated in one pass, on synthetic neighbor sets of KNN_SIZES locations:
+    knn.run_knn_vectorized against knn.run_knn_batch (both with the spatial index if the set
+    is large enough to have one, see neighbors.get_neighbor_set), and neighbors.run_route_knn
+    against neighbors.run_route_knn_batch. every batch's results are checked to be the same.
+    """
+    rng = np.random.default_rng(1)
+    arrival_dict = {i: 7 * 3600 + 600 + i * 10 for i in range(100)}
+    route = get_route()
+    for size in KNN_SIZES:
+        locations = synthetic_locations(size)
+        lons = locations["lon"].to_numpy(dtype=float)
+        lats = locations["lat"].to_numpy(dtype=float)
+        times_to_arrive = calculate_times_to_arrive(locations, arrival_dict)
+        # the vehicles of a batch drive where the recorded vehicles drove
+        vehicles = synthetic_locations(KNN_BATCH_SIZE, seed=1)
+        query_lons = vehicles["lon"].to_numpy(dtype=float)
+        query_lats = vehicles["lat"].to_numpy(dtype=float)
+        index = GridIndex(lons, lats) if size >= SPATIAL_INDEX_MIN_LOCATIONS else None
+        position_index = PositionIndex(route.project_many(lons, lats))
+        query_positions = route.project_many(query_lons, query_lats)
+
+        one_by_one_time, expected = time_call(
+            lambda: np.array(
+                [
+                    run_knn_vectorized(lons, lats, times_to_arrive, lon, lat, K, index)
+                    for lon, lat in zip(query_lons, query_lats)
+                ]
+            ),
+            repeat=repeat,
+        )
+        batch_time, result = time_call(
+            run_knn_batch,
+            lons,
+            lats,
+            times_to_arrive,
+            query_lons,
+            query_lats,
+            K,
+            index,
+            repeat=repeat,
+        )
+        route_one_by_one_time, route_expected = time_call(
+            lambda: np.array(
+                [
+                    run_route_knn(position_index, times_to_arrive, position, K)
+                    for position in query_positions
+                ]
+            ),
+            repeat=repeat,
+        )
+        route_batch_time, route_result = time_call(
+            run_route_knn_batch,
+            position_index,
+            times_to_arrive,
+            query_positions,
+            K,
+            repeat=repeat,
+        )
+        if not np.allclose(result, expected) or not np.allclose(
+            route_result, route_expected
+        ):
+            raise AssertionError(f"results differ for {size} locations")
+        print(
+            f"locations: {size:>6} per vehicle: "
+            f"euclidean one by one: {one_by_one_time / KNN_BATCH_SIZE * 1000:7.3f}ms "
+            f"batch: {batch_time / KNN_BATCH_SIZE * 1000:7.3f}ms "
+            f"route one by one: {route_one_by_one_time / KNN_BATCH_SIZE * 1000:7.3f}ms "
+            f"batch: {route_batch_time / KNN_BATCH_SIZE * 1000:7.3f}ms"
+        )
+
+
+def scale_arrival_data(data: pd.DataFrame, scale: int) -> pd.DataFrame:
+    """
+    returns the arrival data repeated scale times, every copy with its own ride and ride stop ids,
+    so every slot has scale times the rides.
+    """
+    ride_span = int(data["id"].max()) + 1
+    ride_stop_span = int(data["siri_ride_stop_id"].max()) + 1
+    copies = []
+    for i in range(scale):
+        copy = data.copy()
+        copy["id"] += i * ride_span
+        copy["siri_ride_stop_id"] += i * ride_stop_span
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def synthetic_vehicle_locations(data: pd.DataFrame, route: Route) -> pd.DataFrame:
+    """
+    returns the vehicle locations of the arrivals, the same ones fake_stride serves
+    (at the stop at the arrival time, and half way from the previous stop APPROACH_SECONDS before it),
+    synthesized in a single vectorized pass so the large datasets are quick to store.
+    """
+    data = data[data["siri_stop_id"].isin(route.stop_ids)]
+    index = data["siri_stop_id"].map(route.stop_index).to_numpy()
+    last_index = np.maximum(index - 1, 0)
+    arrival_time = pd.to_datetime(
+        data["date"] + " " + data["arrival_time"]
+    ).dt.tz_localize(tz.gettz("Israel"))
+    approach_time = arrival_time - pd.Timedelta(seconds=fake_stride.APPROACH_SECONDS)
+    at_stop = pd.DataFrame(
+        {
+            "siri_ride__id": data["id"].to_numpy(),
+            "siri_ride_stop_id": data["siri_ride_stop_id"].to_numpy(),
+            "recorded_at_time": arrival_time.to_numpy(),
+            "lon": route.lons[index],
+            "lat": route.lats[index],
+            "distance_from_journey_start": index * fake_stride.STOP_DISTANCE,
+        }
+    )
+    approaching = at_stop.assign(
+        recorded_at_time=approach_time.to_numpy(),
+        lon=(route.lons[index] + route.lons[last_index]) / 2,
+        lat=(route.lats[index] + route.lats[last_index]) / 2,
+        distance_from_journey_start=index * fake_stride.STOP_DISTANCE
+        - fake_stride.STOP_DISTANCE / 2,
+    )
+    locations = pd.concat([approaching, at_stop], ignore_index=True)
+    locations["id"] = np.arange(1, len(locations) + 1)
+    locations["siri_route__line_ref"] = route.line_ref
+    locations["siri_route__operator_ref"] = route.operator_ref
+    return locations
+
+
+def suite_queries(file_path: str = ARRIVAL_DATA_FILE, seed: int = 0) -> List[Dict]:
+    """
+    returns SUITE_QUERIES random ETA queries of vehicles of the arrival data file:
+    a minute before an arrival, between the stop before and the arrival's stop.
+    only slots with stop to stop times for all the stops are queried, so the queries don't fail.
+    """
+    rng = np.random.default_rng(seed)
+    route = get_file_route(file_path)
+    data = pd.read_csv(file_path, dtype=ARRIVAL_DATA_DTYPES)
+    data = data[data["siri_stop_id"].isin(route.stop_ids[1:])]
+    queries = []
+    for row in rng.permutation(len(data)):
+        arrival = data.iloc[row]
+        date = datetime.date.fromisoformat(arrival["date"])
+        start_time = datetime.datetime.combine(
+            date, datetime.time.fromisoformat(arrival["start_time"])
+        )
+        try:
+            generate_time_diffs(
+                start_time, route.line_ref, os.path.dirname(file_path) or "."
+            )
+        except ValueError:
+            continue
+        next_stop_id = int(arrival["siri_stop_id"])
+        last_stop_id = route.stop_ids[route.stop_index[next_stop_id] - 1]
+        lons, lats = zip(
+            route.stop_location(last_stop_id), route.stop_location(next_stop_id)
+        )
+        queries.append(
+            {
+                "start_time": start_time.isoformat(),
+                "recorded_at_time": (
+                    datetime.datetime.combine(
+                        date, datetime.time.fromisoformat(arrival["arrival_time"])
+                    )
+                    - datetime.timedelta(seconds=60)
+                ).isoformat(),
+                "next_stop_id": next_stop_id,
+                "lon": float(np.mean(lons) + rng.normal(0, 0.0005)),
+                "lat": float(np.mean(lats) + rng.normal(0, 0.0005)),
+            }
+        )
+        if len(queries) == SUITE_QUERIES:
+            break
+    return queries
+
+
+def suite_workload(scale: int, repeat: int = 3) -> List[Dict]:
+    """
+    times the hot paths on the arrival data in the current directory, one by one,
+    without the network: the knn reads the local location store, and generate_data
+    fetches from a fake stride api. returns a result per (benchmark, stat):
+        cold - the first call, that builds the caches (the parsed data, the segment table...)
+        warm - the best of repeat calls, per query
+    """
+    line_ref = LINE_REFS["8_to_cinema"]
+    operator_ref = OPERATOR_REFS["METROPOLIN"]
+    results = []
+
+    def record(benchmark: str, stat: str, seconds: float, **details):
+        results.append(
+            {
+                "benchmark": benchmark,
+                "stat": stat,
+                "scale": scale,
+                "seconds": seconds,
+                **details,
+            }
+        )
+
+    def time_queries(benchmark: str, func: Callable, **details):
+        # queries of slots without data raise a ValueError, they are counted as errors
+        errors = 0
+        start = time.perf_counter()
+        for query in queries:
+            try:
+                func(query)
+            except ValueError:
+                errors += 1
+        record(benchmark, "cold", time.perf_counter() - start, errors=errors, **details)
+        total = sum(time_call(func, query, repeat=repeat)[0] for query in queries)
+        record(benchmark, "warm", total / len(queries), errors=errors, **details)
+
+    route = get_file_route(ARRIVAL_DATA_FILE)
+    raw_data = pd.read_csv(ARRIVAL_DATA_FILE, dtype=ARRIVAL_DATA_DTYPES)
+    store_locations(synthetic_vehicle_locations(raw_data, route).to_dict("records"))
+    with open(SUITE_QUERIES_FILE) as f:
+        queries = json.load(f)
+    for query in queries:
+        for name in ["start_time", "recorded_at_time"]:
+            query[name] = datetime.datetime.fromisoformat(query[name])
+
+    start = time.perf_counter()
+    data = get_arrival_data(ARRIVAL_DATA_FILE)
+    record("get_arrival_data", "cold", time.perf_counter() - start, rows=len(data))
+    warm, _ = time_call(get_arrival_data, ARRIVAL_DATA_FILE, repeat=repeat)
+    record("get_arrival_data", "warm", warm, rows=len(data))
+
+    time_queries(
+        "generate_time_diffs",
+        lambda query: generate_time_diffs(query["start_time"]),
+    )
+    time_queries(
+        "get_relavent_ids",
+        lambda query: get_relavent_ids(query["start_time"], query["next_stop_id"]),
+    )
+    # the cold queries build the neighbor sets, that the knn functions run on below
+    for metric, benchmark in [
+        ("euclidean", "next_stops_eta"),
+        ("route", "next_stops_eta_route"),
+    ]:
+        time_queries(
+            benchmark,
+            lambda query: next_stops_eta(
+                query["recorded_at_time"],
+                query["lon"],
+                query["lat"],
+                query["start_time"],
+                query["next_stop_id"],
+                line_ref,
+                operator_ref,
+                metric=metric,
+                offline=True,
+                exact=True,
+            ),
+        )
+
+    for query in queries:
+        query["neighbor_set"] = neighbors.get_neighbor_set(
+            query["start_time"], query["next_stop_id"], line_ref, operator_ref, True
+        )
+        query["position"] = route.project(query["lon"], query["lat"])
+    locations = float(
+        np.mean([len(query["neighbor_set"].locations) for query in queries])
+    )
+    time_queries(
+        "run_knn_vectorized",
+        lambda query: run_knn_vectorized(
+            query["neighbor_set"].lons,
+            query["neighbor_set"].lats,
+            query["neighbor_set"].times_to_arrive,
+            query["lon"],
+            query["lat"],
+            K,
+            query["neighbor_set"].index,
+        ),
+        locations=locations,
+    )
+    time_queries(
+        "run_route_knn",
+        lambda query: run_route_knn(
+            query["neighbor_set"].position_index,
+            query["neighbor_set"].times_to_arrive,
+            query["position"],
+            K,
+        ),
+        locations=locations,
+    )
+
+    if os.path.exists(os.path.join("fake", GENERATE_DATA_FILE)):
+        server = fake_stride.serve(file_path=os.path.join("fake", GENERATE_DATA_FILE))
+        stride.config.STRIDE_API_BASE_URL = f"http://localhost:{server.server_port}"
+        api_functions.set_rate_limit(None)
+        israel = tz.gettz("Israel")
+        start = time.perf_counter()
+        data = generate_data(
+            datetime.datetime(2025, 1, 1, 0, 1, tzinfo=israel),
+            datetime.datetime(2025, 2, 1, 0, 0, tzinfo=israel),
+            line_ref,
+            operator_ref,
+        )
+        record("generate_data", "cold", time.perf_counter() - start, rows=len(data))
+        server.shutdown()
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_suite(
+    scales: List[int] = SUITE_SCALES,
+    output: str = SUITE_RESULTS_FILE,
+    compare: Optional[str] = None,
+    repeat: int = 3,
+):
+    """
+    times get_arrival_data, generate_time_diffs, get_relavent_ids, next_stops_eta (with both knn metrics),
+    the knn functions it serves with (run_knn_vectorized and run_route_knn) and generate_data separately, on the bundled arrival data and on synthetic datasets of it repeated (see scale_arrival_data).
+
+    every scale runs in a fresh process in a temporary directory, so the caches start cold
+    and nothing is read from (or written to) the project's files.
+    the results are written to output as json, and compared to the results in compare if it is given.
+    """
+    base_data = pd.read_csv(ARRIVAL_DATA_FILE)
+    generate_data_base = pd.read_csv(GENERATE_DATA_FILE)
+    # the queries are of the bundled data, so they are the same at every scale
+    queries = suite_queries()
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, SUITE_QUERIES_FILE), "w") as f:
+                json.dump(queries, f)
+            scale_arrival_data(base_data, scale).to_csv(
+                os.path.join(directory, ARRIVAL_DATA_FILE), index=False
+            )
+            shutil.copy(ROUTES_FILE, directory)
+            if scale <= GENERATE_DATA_MAX_SCALE:
+                os.mkdir(os.path.join(directory, "fake"))
+                scale_arrival_data(generate_data_base, scale).to_csv(
+                    os.path.join(directory, "fake", GENERATE_DATA_FILE), index=False
+                )
+            worker = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--suite-worker",
+                    str(scale),
+                    "--repeat",
+                    str(repeat),
+                ],
+                cwd=directory,
+                capture_output=True,
+                text=True,
+            )
+            if worker.returncode != 0:
+                raise RuntimeError(
+                    f"the suite failed at scale {scale}:\n{worker.stderr}"
+                )
+            with open(os.path.join(directory, SUITE_RESULTS_FILE)) as f:
+                results.extend(json.load(f))
+        for result in results:
+            if result["scale"] == scale:
+                print(
+                    f"x{scale:<4} {result['benchmark']:<20} {result['stat']:<5} "
+                    f"{result['seconds'] * 1000:10.3f}ms"
+                )
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "queries": SUITE_QUERIES,
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"results written to {output}")
+    if compare is not None:
+        compare_results(compare, report)
+
+
+def compare_results(baseline_path: str, report: Dict):
+    """
+    prints the change of every result from the baseline results file.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_seconds = {
+        (result["benchmark"], result["stat"], result["scale"]): result["seconds"]
+        for result in baseline["results"]
+    }
+    print(f"compared to {baseline.get('commit')} ({baseline_path}):")
+    for result in report["results"]:
+        key = (result["benchmark"], result["stat"], result["scale"])
+        if key not in baseline_seconds:
+            continue
+        ratio = result["seconds"] / baseline_seconds[key]
+        print(
+            f"x{result['scale']:<4} {result['benchmark']:<20} {result['stat']:<5} "
+            f"{baseline_seconds[key] * 1000:10.3f}ms -> {result['seconds'] * 1000:10.3f}ms "
+            f"(x{ratio:.2f})"
+        )
+
+
+BENCHMARKS = {
+    "time_diffs": benchmark_time_diffs,
+    "load_formats": benchmark_load_formats,
+    "knn": benchmark_knn,
+    "knn_batch": benchmark_knn_batch,
+    "suite": benchmark_suite,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"benchmarks to run ({', '.join(BENCHMARKS)}), all of them by default",
+    )
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=SUITE_SCALES, help="of the suite"
+    )
+    parser.add_argument(
+        "--output", default=SUITE_RESULTS_FILE, help="the suite's results file"
+    )
+    parser.add_argument(
+        "--compare", help="a results file of the suite to compare the results to"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs of every query of the suite"
+    )
+    parser.add_argument("--suite-worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.suite_worker is not None:
+        results = suite_workload(args.suite_worker, args.repeat)
+        with open(SUITE_RESULTS_FILE, "w") as f:
+            json.dump(results, f)
+        return
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"--- {name}")
+        if name == "suite":
+            benchmark_suite(args.scales, args.output, args.compare, args.repeat)
+        else:
+            BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
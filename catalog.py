@@ -0,0 +1,289 @@
+import datetime
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+import pandas as pd
+
+from consts import LINE_REFS, LineRef, SiriStopId
+from get_data import (
+    FILE_FORMATS,
+    ArrivalData,
+    NoDataError,
+    file_format_of,
+    file_signature,
+    get_slot_rows,
+    index_arrival_data,
+    read_arrival_data,
+)
+
+PARTITION_PATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2})-(\d{4}-\d{2}-\d{2}),REF(\d+)("
+    + "|".join(re.escape(suffix) for suffix in FILE_FORMATS.values())
+    + r")$"
+)
+
+
+@dataclass
+class Partition:
+    """
+    an arrival data file, as named by "generate_data": {start_date}-{end_date},REF{line_ref}
+    """
+
+    path: str
+    start_date: datetime.date
+    end_date: datetime.date
+    line_ref: LineRef
+    file_format: str
+
+    def days(self) -> int:
+        return (self.end_date - self.start_date).days + 1
+
+
+# directory : (its mtime, its partitions)
+_partitions: Dict[str, Tuple[int, List[Partition]]] = dict()
+
+# (directory, line_ref, start_date, end_date) : (the directory's mtime, see line_partitions)
+_line_partitions: Dict[Tuple, Tuple[int, Tuple]] = dict()
+
+# (directory, line_ref, start_date, end_date) : the indexed arrival data of the line
+_line_arrival_data: Dict[Tuple, ArrivalData] = dict()
+
+
+def discover_partitions(directory: str = ".") -> List[Partition]:
+    """
+    returns all the arrival data files in the directory.
+    if the same range of a line is stored in more than one format, only the columnar one is returned.
+    """
+    partitions = dict()
+    for file_name in sorted(os.listdir(directory)):
+        match = PARTITION_PATTERN.match(file_name)
+        if match is None:
+            continue
+        path = os.path.join(directory, file_name)
+        partition = Partition(
+            path=path,
+            start_date=datetime.date.fromisoformat(match.group(1)),
+            end_date=datetime.date.fromisoformat(match.group(2)),
+            line_ref=LineRef(int(match.group(3))),
+            file_format=file_format_of(path),
+        )
+        key = (partition.start_date, partition.end_date, partition.line_ref)
+        if key not in partitions or partition.file_format == "columnar":
+            partitions[key] = partition
+    return list(partitions.values())
+
+
+def select_partitions(
+    partitions: List[Partition],
+    line_ref: LineRef,
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> List[Partition]:
+    """
+    returns the partitions of the line to load for the date range.
+
+    partitions are picked greedily, the ones that cover more of the range first
+    (and the smaller one of equal coverage), and a partition is skipped
+    if the days it covers in the range are already covered by the picked ones.
+    """
+    candidates = []
+    for partition in partitions:
+        if partition.line_ref != line_ref:
+            continue
+        first = max(partition.start_date, start_date)
+        last = min(partition.end_date, end_date)
+        if first > last:
+            continue
+        days = {
+            first + datetime.timedelta(days=i) for i in range((last - first).days + 1)
+        }
+        candidates.append((partition, days))
+
+    candidates.sort(key=lambda candidate: (-len(candidate[1]), candidate[0].days()))
+    selected = []
+    covered = set()
+    for partition, days in candidates:
+        if days <= covered:
+            continue
+        selected.append(partition)
+        covered |= days
+    return selected
+
+
+def get_partitions(directory: str = ".") -> List[Partition]:
+    """
+    returns the partitions of the directory, discovered again only when a file was added to it,
+    removed from it or replaced.
+    """
+    mtime = os.stat(directory).st_mtime_ns
+    cached = _partitions.get(directory)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, discover_partitions(directory))
+        _partitions[directory] = cached
+    return cached[1]
+
+
+def line_partitions(
+    line_ref: LineRef,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    directory: str = ".",
+) -> Tuple[List[Partition], datetime.date, datetime.date]:
+    """
+    returns the partitions to load for the line in the date range, and the range.
+    the range defaults to all the days the partitions of the line cover.
+    """
+    key = (directory, line_ref, start_date, end_date)
+    mtime = os.stat(directory).st_mtime_ns
+    cached = _line_partitions.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (
+            mtime,
+            select_line_partitions(line_ref, start_date, end_date, directory),
+        )
+        _line_partitions[key] = cached
+    return cached[1]
+
+
+def select_line_partitions(
+    line_ref: LineRef,
+    start_date: Optional[datetime.date],
+    end_date: Optional[datetime.date],
+    directory: str,
+) -> Tuple[List[Partition], datetime.date, datetime.date]:
+    partitions = [
+        partition
+        for partition in get_partitions(directory)
+        if partition.line_ref == line_ref
+    ]
+    if start_date is None and partitions:
+        start_date = min(partition.start_date for partition in partitions)
+    if end_date is None and partitions:
+        end_date = max(partition.end_date for partition in partitions)
+    selected = select_partitions(partitions, line_ref, start_date, end_date)
+    if len(selected) == 0:
+        raise NoDataError(
+            f"No arrival data found for line {line_ref} between {start_date} and {end_date}"
+        )
+    return selected, start_date, end_date
+
+
+def dataset_signature(
+    line_ref: LineRef,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    directory: str = ".",
+) -> Tuple:
+    """
+    returns the paths and the (mtime, size) of the partitions the arrival data of the line is read from,
+    used to tell if it changed.
+    """
+    partitions, _, _ = line_partitions(line_ref, start_date, end_date, directory)
+    return tuple(
+        (partition.path, *file_signature(partition.path)) for partition in partitions
+    )
+
+
+def iterate_arrival_data(
+    line_ref: LineRef,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    directory: str = ".",
+    partitions: Optional[List[Partition]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    lazily yields the arrival data of the line in the date range, one partition at a time.
+    a partition is only read when its data is requested, and rides that
+    were already yielded from an overlapping partition are dropped.
+    """
+    if partitions is None:
+        partitions = discover_partitions(directory)
+    seen_rides = set()
+    for partition in select_partitions(partitions, line_ref, start_date, end_date):
+        data = read_arrival_data(partition.path)
+        dates = data["date"]
+        data = data[
+            (dates >= pd.Timestamp(start_date))
+            & (dates <= pd.Timestamp(end_date))
+            & ~data["id"].isin(seen_rides)
+        ]
+        seen_rides.update(data["id"].unique().tolist())
+        yield data
+
+
+def get_line_arrival_data(
+    line_ref: LineRef,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    directory: str = ".",
+) -> pd.DataFrame:
+    """
+    returns the arrival data of the line in the date range (all of it by default),
+    from all the partitions it is in.
+    """
+    partitions, start_date, end_date = line_partitions(
+        line_ref, start_date, end_date, directory
+    )
+    parts = list(
+        iterate_arrival_data(line_ref, start_date, end_date, partitions=partitions)
+    )
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts, ignore_index=True)
+
+
+def load_line_arrival_data(
+    line_ref: LineRef,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    directory: str = ".",
+) -> ArrivalData:
+    """
+    returns the cached arrival data of the line in the date range (all of it by default),
+    reading it again if a partition was added, removed or changed since it was read.
+    """
+    key = (directory, line_ref, start_date, end_date)
+    signature = dataset_signature(line_ref, start_date, end_date, directory)
+    arrival_data = _line_arrival_data.get(key)
+    if arrival_data is None or arrival_data.signature != signature:
+        data = get_line_arrival_data(line_ref, start_date, end_date, directory)
+        arrival_data = index_arrival_data(data, signature)
+        _line_arrival_data[key] = arrival_data
+    return arrival_data
+
+
+def get_slot_data(
+    start_time: datetime.datetime,
+    line_ref: LineRef,
+    siri_stop_id: Optional[SiriStopId] = None,
+    directory: str = ".",
+) -> pd.DataFrame:
+    """
+    returns the arrival data of the line's rides with the same day of week and start time as start_time.
+    if siri_stop_id is given, returns only the arrivals to that stop.
+    """
+    return get_slot_rows(
+        load_line_arrival_data(line_ref, directory=directory), start_time, siri_stop_id
+    )
+
+
+def main():
+    for partition in discover_partitions():
+        print(
+            f"{partition.path}: REF{partition.line_ref} {partition.start_date} - {partition.end_date} ({partition.file_format})"
+        )
+
+    start = time.time()
+    start_date = datetime.date(2025, 1, 15)
+    end_date = datetime.date(2025, 2, 15)
+    data = get_line_arrival_data(LINE_REFS["8_to_cinema"], start_date, end_date)
+    print(
+        f"{len(data)} arrivals of {data['id'].nunique()} rides between {start_date} and {end_date}"
+    )
+    print("calculation time:", time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
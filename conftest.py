@@ -0,0 +1,128 @@
+"""
+shared fixtures of the tests (test_*.py), run with:
+    python -m pytest
+"""
+
+import math
+import os
+import shutil
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+
+import api_functions
+import fake_stride
+import location_store
+import lookup_cache
+import stride
+import stride_transport
+from consts import ROUTES_FILE
+from get_data import ARRIVAL_DATA_FILE
+from neighbors import NeighborSet
+from route import EARTH_RADIUS, PositionIndex, Route
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# the bundled arrival data the fake stride api serves, a single month so it starts quickly
+FAKE_API_FILE = "2025-01-01-2025-01-31,REF29094.csv"
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    an empty working directory with the routes file, so the tests don't read or write the project's files.
+    the local stores are opened again in it.
+    """
+    shutil.copy(os.path.join(PROJECT_DIRECTORY, ROUTES_FILE), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(location_store, "_connections", dict())
+    monkeypatch.setattr(lookup_cache, "_connection", None)
+    monkeypatch.setattr(lookup_cache, "_memory", OrderedDict())
+    return tmp_path
+
+
+def copy_arrival_data(directory, file_name: str = ARRIVAL_DATA_FILE) -> str:
+    """
+    copies a bundled arrival data file to the directory, returns its path there.
+    """
+    return shutil.copy(os.path.join(PROJECT_DIRECTORY, file_name), directory)
+
+
+def serve_fake_api(monkeypatch, **kwargs):
+    """
+    sends the stride requests to a new fake stride api of FAKE_API_FILE (see fake_stride.serve for the kwargs),
+    without a rate limit. returns the fake's server.
+    """
+    server = fake_stride.serve(
+        file_path=os.path.join(PROJECT_DIRECTORY, FAKE_API_FILE), **kwargs
+    )
+    monkeypatch.setattr(
+        stride.config,
+        "STRIDE_API_BASE_URL",
+        f"http://localhost:{server.server_port}",
+    )
+    monkeypatch.setattr(api_functions, "rate_limiter", None)
+    monkeypatch.setattr(api_functions, "transport", stride_transport.StrideTransport())
+    return server
+
+
+@pytest.fixture
+def fake_api(workspace, monkeypatch):
+    """
+    the stride requests are sent to a fake stride api of FAKE_API_FILE (see fake_stride.py),
+    without a rate limit. returns the fake's server.
+    """
+    server = serve_fake_api(monkeypatch)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def flaky_api(workspace, monkeypatch):
+    """
+    fake_api, with a third of the requests failing with a 503.
+    they are retried without waiting, and up to more times than a request is likely to fail in a row.
+    """
+    server = serve_fake_api(monkeypatch, error_rate=0.3, seed=1)
+    monkeypatch.setattr(api_functions, "RETRY_BACKOFF", 0)
+    monkeypatch.setattr(api_functions, "MAX_RETRIES", 20)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def route() -> Route:
+    """
+    a route of three stops on the equator going east, 1000 and 2000 meters apart.
+    """
+    return Route(
+        operator_ref=15,
+        line_ref=1,
+        name="test",
+        stop_ids=[10, 20, 30],
+        codes=[100, 200, 300],
+        lons=[0, 1000 / METERS_PER_DEGREE, 3000 / METERS_PER_DEGREE],
+        lats=[0, 0, 0],
+    )
+
+
+@pytest.fixture
+def neighbor_set(route) -> NeighborSet:
+    """
+    300 locations a few meters off the route, of vehicles driving 10 meters a second to its last stop.
+    """
+    rng = np.random.default_rng(0)
+    positions = rng.uniform(0, 3000, 300)
+    lons, _ = route.points_at(positions)
+    lats = rng.normal(0, 5, len(positions)) / METERS_PER_DEGREE
+    locations = pd.DataFrame({"lon": lons, "lat": lats})
+    return NeighborSet(
+        locations=locations,
+        arrival_dict=dict(),
+        index=None,
+        lons=lons,
+        lats=lats,
+        times_to_arrive=(3000 - positions) / 10 + rng.normal(0, 20, len(positions)),
+        position_index=PositionIndex(route.location_positions(locations)),
+    )
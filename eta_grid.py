@@ -0,0 +1,477 @@
+"""
+compiled ETA grids: the knn estimation evaluated ahead of time on a dense grid of positions along the route,
+for every (day_of_week, start_time, next_stop) of the arrival data, so a query is a single interpolation.
+
+    python eta_grid.py --compile [--metric euclidean|route]
+
+the grids are compiled for a knn metric (KNN_METRIC by default): the euclidean knn is evaluated at the lon, lat
+of the route at every position, the route knn at the position itself. the knn doesn't use the time of the fix,
+so the grids have no time axis. every grid keeps the error measured against the exact knn (see compile_grid),
+and the intervals with an error above ETA_GRID_MAX_ERROR fall back to the exact knn.
+
+the grids of a line are saved next to its arrival data files (REF{line_ref},OP{operator_ref}.eta_grid.npz),
+and are used by knn.next_stop_eta with the metric they were compiled for (unless it is asked for the exact knn,
+see EXACT_KNN) as long as neither the arrival data of the line (see catalog.py), its stored locations
+(see location_store.py) nor its route changed since they were compiled.
+"""
+
+import argparse
+import datetime
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+import numpy as np
+
+import catalog
+import neighbors
+from consts import (
+    ETA_GRID_MAX_ERROR,
+    ETA_GRID_SPACING,
+    K,
+    KNN_METRIC,
+    LINE_REFS,
+    OPERATOR_REFS,
+    LineRef,
+    OperatorRef,
+    SiriStopId,
+)
+from get_data import NoDataError, time_to_seconds
+from location_store import get_store_version
+from route import Route, get_route
+
+# bump whenever the saved layout changes, so old grids are ignored
+ETA_GRID_VERSION = 5
+# meters from a location where the error of a grid is checked
+ERROR_CHECK_OFFSET = 0.01
+# positions in every interval of a grid where its error is checked
+ERROR_CHECK_POINTS = 4
+
+
+@dataclass
+class EtaGrid:
+    """
+    the estimated seconds to arrive at the next stop, at positions
+    start_position, start_position + spacing, ... along the route.
+    errors[i] is the largest difference from the exact knn measured at the positions checked
+    between values[i] and values[i + 1] (see compile_grid). it is measured at sample positions only,
+    so it isn't a bound of the error, but it marks the intervals the knn jumps in.
+    """
+
+    start_position: float
+    spacing: float
+    values: np.ndarray
+    errors: np.ndarray
+
+    @property
+    def end_position(self) -> float:
+        return self.start_position + self.spacing * (len(self.values) - 1)
+
+    @property
+    def max_error(self) -> float:
+        return float(self.errors.max(initial=0))
+
+    def lookup(
+        self, position: float, max_error: float = ETA_GRID_MAX_ERROR
+    ) -> Optional[float]:
+        """
+        returns the interpolated estimation at the position, or None if it is outside of the grid
+        or the measured error of its interval is above max_error.
+        """
+        offset = (position - self.start_position) / self.spacing
+        if offset < 0 or offset > len(self.values) - 1:
+            return None
+        index = min(int(offset), len(self.values) - 2)
+        if self.errors[index] > max_error:
+            return None
+        fraction = offset - index
+        # in float64 whatever the type of position, so every caller gets the same estimation
+        return (
+            float(self.values[index]) * (1 - fraction)
+            + float(self.values[index + 1]) * fraction
+        )
+
+    def lookup_many(
+        self, positions: np.ndarray, max_error: float = ETA_GRID_MAX_ERROR
+    ) -> np.ndarray:
+        """
+        lookup for many positions at once, with NaN where lookup returns None.
+        """
+        offsets = (
+            np.asarray(positions, dtype=float) - self.start_position
+        ) / self.spacing
+        inside = (offsets >= 0) & (offsets <= len(self.values) - 1)
+        indexes = np.clip(offsets, 0, max(0, len(self.values) - 2)).astype(int)
+        inside &= self.errors[indexes] <= max_error
+        fractions = offsets - indexes
+        values = self.values.astype(float)
+        estimates = values[indexes] * (1 - fractions) + values[indexes + 1] * fractions
+        return np.where(inside, estimates, np.nan)
+
+
+@dataclass
+class EtaGrids:
+    """
+    the grids of a line and operator, keyed by (day_of_week, start_time, next_stop).
+    source_signature and store_version are the catalog.dataset_signature of the line's arrival data
+    and the location_store.get_store_version of its locations when the grids were compiled,
+    and stop_positions are the positions of the stops of its route (that the grids' positions are in).
+    the grids are of the knn with the metric and k neighbors.
+    """
+
+    line_ref: LineRef
+    operator_ref: OperatorRef
+    source_signature: Tuple
+    store_version: int
+    stop_positions: np.ndarray
+    metric: str
+    k: int
+    grids: Dict[Tuple[str, int, SiriStopId], EtaGrid]
+
+
+# (directory, line_ref, operator_ref) : the grids, or None if there are no up to date ones
+_eta_grids: Dict[Tuple[str, LineRef, OperatorRef], Optional[EtaGrids]] = dict()
+
+
+def eta_grids_path(
+    line_ref: LineRef, operator_ref: OperatorRef, directory: str = "."
+) -> str:
+    return os.path.join(directory, f"REF{line_ref},OP{operator_ref}.eta_grid.npz")
+
+
+def lookup_eta(
+    start_time: datetime.datetime,
+    next_stop_id: SiriStopId,
+    position: float,
+    k: int,
+    metric: str,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    directory: str = ".",
+) -> Optional[float]:
+    """
+    returns the compiled estimation of the knn metric of the seconds to arrive at the next stop from the position,
+    or None if there is no up to date grid for it, or the grid's measured error at the position
+    is above ETA_GRID_MAX_ERROR (then the exact knn should be used).
+    """
+    grid = get_eta_grid(
+        start_time, next_stop_id, k, metric, line_ref, operator_ref, directory
+    )
+    if grid is None:
+        return None
+    return grid.lookup(position)
+
+
+def lookup_etas(
+    start_time: datetime.datetime,
+    next_stop_id: SiriStopId,
+    positions: np.ndarray,
+    k: int,
+    metric: str,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    directory: str = ".",
+) -> np.ndarray:
+    """
+    lookup_eta for many positions of the same slot and next stop,
+    with NaN where lookup_eta returns None.
+    """
+    grid = get_eta_grid(
+        start_time, next_stop_id, k, metric, line_ref, operator_ref, directory
+    )
+    if grid is None:
+        return np.full(len(positions), np.nan)
+    return grid.lookup_many(positions)
+
+
+def get_eta_grid(
+    start_time: datetime.datetime,
+    next_stop_id: SiriStopId,
+    k: int,
+    metric: str,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    directory: str = ".",
+) -> Optional[EtaGrid]:
+    """
+    returns the up to date grid of the slot and next stop compiled for the knn metric with k neighbors,
+    if there is one.
+    """
+    grids = get_eta_grids(line_ref, operator_ref, directory)
+    if grids is None or grids.metric != metric or grids.k != k:
+        return None
+    return grids.grids.get(
+        (start_time.strftime("%A"), time_to_seconds(start_time), next_stop_id)
+    )
+
+
+def get_eta_grids(
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+    operator_ref: OperatorRef = OPERATOR_REFS["METROPOLIN"],
+    directory: str = ".",
+) -> Optional[EtaGrids]:
+    """
+    returns the compiled grids of the line, or None if they weren't compiled
+    since its arrival data, its stored locations or its route's stop positions last changed.
+    """
+    signature = catalog.dataset_signature(line_ref, directory=directory)
+    store_version = get_store_version(line_ref, operator_ref)
+    stop_positions = get_route(line_ref, operator_ref).stop_positions
+    key = (directory, line_ref, operator_ref)
+    grids = _eta_grids.get(key)
+    if grids is None or not is_up_to_date(
+        grids, signature, store_version, stop_positions
+    ):
+        grids = load_eta_grids(line_ref, operator_ref, directory)
+        if grids is not None and not is_up_to_date(
+            grids, signature, store_version, stop_positions
+        ):
+            grids = None
+        _eta_grids[key] = grids
+    return grids
+
+
+def is_up_to_date(
+    grids: EtaGrids, signature: Tuple, store_version: int, stop_positions: np.ndarray
+) -> bool:
+    return (
+        grids.source_signature == signature
+        and grids.store_version == store_version
+        and np.array_equal(grids.stop_positions, stop_positions)
+    )
+
+
+def load_eta_grids(
+    line_ref: LineRef, operator_ref: OperatorRef, directory: str = "."
+) -> Optional[EtaGrids]:
+    path = eta_grids_path(line_ref, operator_ref, directory)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if saved.get("version") != ETA_GRID_VERSION:
+            return None
+        values = np.split(saved["values"], saved["offsets"][1:-1])
+        # a grid of n values has n - 1 intervals
+        errors = np.split(
+            saved["errors"], saved["offsets"][1:-1] - np.arange(1, len(values))
+        )
+        return EtaGrids(
+            line_ref=line_ref,
+            operator_ref=operator_ref,
+            source_signature=tuple(
+                (str(path), int(mtime), int(size))
+                for path, mtime, size in zip(
+                    saved["source_paths"], saved["source_mtimes"], saved["source_sizes"]
+                )
+            ),
+            store_version=int(saved["store_version"]),
+            stop_positions=saved["stop_positions"],
+            metric=str(saved["metric"]),
+            k=int(saved["k"]),
+            grids={
+                (str(day), int(start), int(stop)): EtaGrid(
+                    float(start_position), float(spacing), grid_values, grid_errors
+                )
+                for day, start, stop, start_position, spacing, grid_values, grid_errors in zip(
+                    saved["days_of_week"],
+                    saved["start_times"],
+                    saved["next_stops"],
+                    saved["start_positions"],
+                    saved["spacings"],
+                    values,
+                    errors,
+                )
+            },
+        )
+
+
+def compile_grid(
+    neighbor_set: neighbors.NeighborSet,
+    route: Route,
+    k: int = K,
+    spacing: float = ETA_GRID_SPACING,
+    metric: str = KNN_METRIC,
+) -> EtaGrid:
+    """
+    evaluates the knn of the neighbor set every spacing meters along the route,
+    from the first to the last position of its locations: the euclidean knn at the lon, lat of the route
+    at every position (see neighbors.run_knn_batch), or the route knn (see neighbors.run_route_knn_batch).
+    the error of every interval is measured against the exact knn at ERROR_CHECK_POINTS positions spread in it,
+    and on both sides of the positions in it where the knn isn't smooth.
+    """
+    positions = neighbor_set.position_index.sorted_positions
+    start, end = positions[0], positions[-1]
+    points = max(2, int(np.ceil((end - start) / spacing)) + 1)
+
+    def exact(grid_positions):
+        if metric == "route":
+            return neighbors.run_route_knn_batch(
+                neighbor_set.position_index,
+                neighbor_set.times_to_arrive,
+                grid_positions,
+                k,
+            )
+        lons, lats = route.points_at(grid_positions)
+        return neighbors.run_knn_batch(
+            neighbor_set.lons,
+            neighbor_set.lats,
+            neighbor_set.times_to_arrive,
+            lons,
+            lats,
+            k,
+            neighbor_set.index,
+        )
+
+    values = exact(start + np.arange(points) * spacing).astype(np.float32)
+    grid = EtaGrid(
+        float(start), float(spacing), values, np.zeros(points - 1, dtype=np.float32)
+    )
+    # the knn isn't smooth next to the locations, and the route knn jumps where the k nearest change
+    # (half way between every location and the k-th one after it), so both are checked too
+    edges = np.concatenate([positions, (positions[:-k] + positions[k:]) / 2])
+    checked = np.concatenate(
+        [
+            start
+            + (
+                np.arange(points - 1)[:, np.newaxis]
+                + (np.arange(ERROR_CHECK_POINTS) + 0.5) / ERROR_CHECK_POINTS
+            ).ravel()
+            * spacing,
+            np.clip(edges - ERROR_CHECK_OFFSET, start, grid.end_position),
+            np.clip(edges + ERROR_CHECK_OFFSET, start, grid.end_position),
+        ]
+    )
+    intervals = np.minimum(
+        ((checked - start) / spacing).astype(int), len(grid.errors) - 1
+    )
+    errors = np.abs(grid.lookup_many(checked, np.inf) - exact(checked))
+    np.maximum.at(grid.errors, intervals, errors)
+    return grid
+
+
+def compile_eta_grids(
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k: int = K,
+    spacing: float = ETA_GRID_SPACING,
+    metric: str = KNN_METRIC,
+    directory: str = ".",
+) -> EtaGrids:
+    """
+    compiles the grids of the knn metric of every (day_of_week, start_time, next_stop) in the arrival data
+    of the line that has locations in the local location store, and saves them next to the arrival data files.
+    """
+    store_version = get_store_version(line_ref, operator_ref)
+    arrival_data = catalog.load_line_arrival_data(line_ref, directory=directory)
+    signature = arrival_data.signature
+    route = get_route(line_ref, operator_ref)
+    data = arrival_data.data
+    slots = data.drop_duplicates(["day_of_week", "start_time"])
+
+    grids = dict()
+    for date, day_of_week, start_seconds in zip(
+        slots["date"], slots["day_of_week"], slots["start_time"]
+    ):
+        start_time = datetime.datetime.combine(
+            date.date(), datetime.time()
+        ) + datetime.timedelta(seconds=int(start_seconds))
+        for next_stop_id in route.stop_ids:
+            try:
+                neighbor_set = neighbors.get_neighbor_set(
+                    start_time, next_stop_id, line_ref, operator_ref, offline=True
+                )
+            except NoDataError:
+                # no arrivals or no stored locations of the slot and next stop
+                continue
+            grids[(str(day_of_week), int(start_seconds), next_stop_id)] = compile_grid(
+                neighbor_set, route, k, spacing, metric
+            )
+
+    keys = list(grids.keys())
+    lengths = [len(grid.values) for grid in grids.values()]
+    np.savez_compressed(
+        eta_grids_path(line_ref, operator_ref, directory),
+        version=ETA_GRID_VERSION,
+        source_paths=np.array([path for path, _, _ in signature], dtype=str),
+        source_mtimes=np.array([mtime for _, mtime, _ in signature], dtype=np.int64),
+        source_sizes=np.array([size for _, _, size in signature], dtype=np.int64),
+        store_version=store_version,
+        stop_positions=route.stop_positions,
+        metric=metric,
+        k=k,
+        days_of_week=np.array([day for day, _, _ in keys], dtype=str),
+        start_times=np.array([start for _, start, _ in keys], dtype=np.int32),
+        next_stops=np.array([stop for _, _, stop in keys], dtype=np.int64),
+        start_positions=np.array([grid.start_position for grid in grids.values()]),
+        spacings=np.array([grid.spacing for grid in grids.values()]),
+        errors=(
+            np.concatenate([grid.errors for grid in grids.values()])
+            if grids
+            else np.array([], dtype=np.float32)
+        ),
+        offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+        values=(
+            np.concatenate([grid.values for grid in grids.values()])
+            if grids
+            else np.array([], dtype=np.float32)
+        ),
+    )
+    eta_grids = EtaGrids(
+        line_ref,
+        operator_ref,
+        signature,
+        store_version,
+        route.stop_positions,
+        metric,
+        k,
+        grids,
+    )
+    _eta_grids[(directory, line_ref, operator_ref)] = eta_grids
+    return eta_grids
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="compile the grids of the arrival data"
+    )
+    parser.add_argument("--spacing", type=float, default=ETA_GRID_SPACING)
+    parser.add_argument("--metric", choices=["euclidean", "route"], default=KNN_METRIC)
+    parser.add_argument("--line", type=int, default=LINE_REFS["8_to_cinema"])
+    parser.add_argument("--operator", type=int, default=OPERATOR_REFS["METROPOLIN"])
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.compile:
+        compile_eta_grids(
+            args.line, args.operator, spacing=args.spacing, metric=args.metric
+        )
+    grids = get_eta_grids(args.line, args.operator)
+    if grids is None:
+        print(
+            "the grids weren't compiled since the arrival data or the stored locations last changed"
+        )
+        return
+
+    errors = np.array([grid.max_error for grid in grids.grids.values()])
+    points = sum(len(grid.values) for grid in grids.grids.values())
+    print(
+        f"{len(grids.grids)} grids, {points} points, metric={grids.metric}, k={grids.k}"
+    )
+    if len(errors) > 0:
+        intervals = np.concatenate([grid.errors for grid in grids.grids.values()])
+        print(
+            f"measured error vs exact knn per grid: max {errors.max():.2f}s, "
+            f"mean {errors.mean():.2f}s, median {np.median(errors):.2f}s"
+        )
+        print(
+            f"{(intervals > ETA_GRID_MAX_ERROR).mean():.1%} of the intervals are above "
+            f"ETA_GRID_MAX_ERROR ({ETA_GRID_MAX_ERROR}s) and fall back to the exact knn"
+        )
+    print("calculation time:", time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+a long-running ETA service: loads the arrival data, the segment table and the neighbor sets once,
+and answers ETA queries over JSON on localhost.
+
+    python eta_service.py --port 8080
+
+    curl -X POST localhost:8080/eta -d '{"recorded_at_time": "2025-01-22T07:20:00",
+        "lon": 34.846114, "lat": 32.134802, "start_time": "2025-01-22T07:15:00", "next_stop_id": 2391}'
+
+endpoints:
+    POST /eta - the ETAs of a vehicle to its next stops (see knn.next_stops_eta)
+    POST /etas - the ETAs of {"vehicles": [...]} (see knn.batch_next_stops_eta)
+    GET /health - the number of warm neighbor sets and the requests' latency
+    GET /metrics - the latency of every stage of the requests, in the prometheus text format
+                   (with --metrics, see metrics.py)
+
+the service only uses the local data (the location store), it never calls the stride api.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Tuple, Union
+import pandas as pd
+
+import catalog
+import knn
+import metrics
+import neighbors
+from consts import EXACT_KNN, K, KNN_METRIC, LINE_REFS, OPERATOR_REFS, WORKERS
+from get_data import NoDataError
+from route import Route, get_route
+from stop_to_stop import get_segment_table
+
+# the largest request body accepted, in bytes
+MAX_BODY_SIZE = 10_000_000
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class EtaService:
+    """
+    the state of the service: the defaults of the queries and the latency statistics.
+    the estimations run in a thread pool, so a slow query (e.g. one that builds a neighbor set)
+    doesn't block the others.
+    """
+
+    def __init__(
+        self,
+        line_ref=LINE_REFS["8_to_cinema"],
+        operator_ref=OPERATOR_REFS["METROPOLIN"],
+        workers: int = WORKERS,
+    ):
+        self.line_ref = line_ref
+        self.operator_ref = operator_ref
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.requests = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def warm_up(self):
+        """
+        loads the arrival data of the line and its segment table before the first query.
+        """
+        catalog.load_line_arrival_data(self.line_ref)
+        get_segment_table(self.line_ref)
+
+    def parse_options(self, query: Dict) -> Dict:
+        """
+        returns the line, the operator and the knn options of a query (or their defaults),
+        and the route of the line. raises BadRequest if any of them is invalid.
+        """
+        if not isinstance(query, dict):
+            raise BadRequest("the query must be a json object")
+        options = {
+            "line_ref": query.get("line_ref", self.line_ref),
+            "operator_ref": query.get("operator_ref", self.operator_ref),
+            "k": query.get("k", K),
+            "metric": query.get("metric", KNN_METRIC),
+            "exact": query.get("exact", EXACT_KNN),
+        }
+        for name in ["line_ref", "operator_ref", "k"]:
+            # a json true or false is a bool, which python counts as an int
+            if (
+                isinstance(options[name], bool)
+                or not isinstance(options[name], int)
+                or options[name] < 1
+            ):
+                raise BadRequest(f"{name} must be a positive integer")
+        if options["metric"] not in knn.METRICS:
+            raise BadRequest(f"metric must be one of {', '.join(knn.METRICS)}")
+        if not isinstance(options["exact"], bool):
+            raise BadRequest("exact must be true or false")
+        try:
+            route = get_route(options["line_ref"], options["operator_ref"])
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return options, route
+
+    def next_stops_eta(self, query: Dict) -> Dict:
+        options, route = self.parse_options(query)
+        vehicle = parse_vehicle(query, route)
+        etas = knn.next_stops_eta(
+            vehicle["recorded_at_time"],
+            vehicle["lon"],
+            vehicle["lat"],
+            vehicle["start_time"],
+            vehicle["next_stop_id"],
+            options["line_ref"],
+            options["operator_ref"],
+            options["k"],
+            options["metric"],
+            offline=True,
+            exact=options["exact"],
+        )
+        return {"etas": {str(stop): float(seconds) for stop, seconds in etas.items()}}
+
+    def batch_next_stops_eta(self, query: Dict) -> Dict:
+        options, route = self.parse_options(query)
+        if not isinstance(query.get("vehicles"), list):
+            raise BadRequest("vehicles must be a list")
+        vehicles = pd.DataFrame(
+            [parse_vehicle(vehicle, route) for vehicle in query["vehicles"]],
+            columns=["recorded_at_time", "lon", "lat", "start_time", "next_stop_id"],
+        )
+        etas = knn.batch_next_stops_eta(
+            vehicles,
+            options["line_ref"],
+            options["operator_ref"],
+            options["k"],
+            options["metric"],
+            offline=True,
+            exact=options["exact"],
+        )
+        return {
+            "etas": [
+                {
+                    "vehicle": int(vehicle),
+                    "siri_stop_id": int(stop),
+                    "seconds_to_arrive": float(seconds),
+                }
+                for vehicle, stop, seconds in etas.itertuples(index=False, name=None)
+            ]
+        }
+
+    def health(self) -> Dict:
+        return {
+            "status": "ok",
+            "neighbor_sets": neighbors.neighbor_sets_count(),
+            "requests": self.requests,
+            "mean_latency_ms": (
+                self.total_latency / self.requests * 1000 if self.requests else 0
+            ),
+            "max_latency_ms": self.max_latency * 1000,
+        }
+
+    async def respond(
+        self, method: str, path: str, body: bytes
+    ) -> Tuple[int, Union[Dict, str]]:
+        """
+        returns the status and the json response of a request (or the text of the metrics).
+        """
+        routes = {
+            ("POST", "/eta"): self.next_stops_eta,
+            ("POST", "/etas"): self.batch_next_stops_eta,
+        }
+        if (method, path) == ("GET", "/health"):
+            return 200, self.health()
+        if (method, path) == ("GET", "/metrics"):
+            return 200, metrics.to_prometheus()
+        if (method, path) not in routes:
+            return 404, {"message": f"unknown endpoint: {method} {path}"}
+        try:
+            query = json.loads(body)
+        except json.JSONDecodeError as e:
+            return 400, {"message": f"invalid json: {e}"}
+
+        loop = asyncio.get_running_loop()
+        try:
+            return 200, await loop.run_in_executor(
+                self.executor, routes[(method, path)], query
+            )
+        except BadRequest as e:
+            return 400, {"message": f"bad query: {e}"}
+        except NoDataError as e:
+            return 422, {"message": f"can't estimate: {e}"}
+        except Exception as e:
+            return 500, {"message": f"internal error: {e!r}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        serves the requests of a connection (with keep-alive) until the client closes it.
+        a body larger than MAX_BODY_SIZE isn't read, so the connection is closed after its error.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = await read_headers(reader)
+                length = int(headers.get("content-length", 0))
+                close = headers.get("connection", "").lower() == "close"
+                if length > MAX_BODY_SIZE:
+                    status, response = 413, {"message": "request body too large"}
+                    close = True
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.respond(method, path, body)
+
+                latency = time.perf_counter() - start
+                self.requests += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                metrics.observe("request_seconds", latency, path=path, status=status)
+                logger.info("%s %s %d %.2fms", method, path, status, latency * 1000)
+
+                if isinstance(response, str):
+                    content_type = "text/plain; version=0.0.4"
+                    data = response.encode()
+                else:
+                    response["latency_ms"] = latency * 1000
+                    content_type = "application/json"
+                    data = json.dumps(response).encode()
+                connection = "Connection: close\r\n" if close else ""
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n{connection}\r\n".encode() + data
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+    headers = dict()
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            return headers
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+def parse_time(query: Dict, name: str) -> datetime:
+    try:
+        return datetime.fromisoformat(query[name])
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be an iso format time, got {query[name]!r}")
+
+
+def parse_vehicle(vehicle: Dict, route: Route) -> Dict:
+    """
+    returns the position, times and next stop of a vehicle of a query.
+    raises BadRequest if a field is missing or invalid, or the next stop isn't on the route.
+    """
+    if not isinstance(vehicle, dict):
+        raise BadRequest("a vehicle must be a json object")
+    missing = [
+        name
+        for name in ["recorded_at_time", "lon", "lat", "start_time", "next_stop_id"]
+        if name not in vehicle
+    ]
+    if missing:
+        raise BadRequest(f"missing fields: {', '.join(missing)}")
+    try:
+        lon, lat = float(vehicle["lon"]), float(vehicle["lat"])
+        next_stop_id = int(vehicle["next_stop_id"])
+    except (TypeError, ValueError) as e:
+        raise BadRequest(f"lon, lat and next_stop_id must be numbers: {e}")
+    if next_stop_id not in route.stop_index:
+        raise BadRequest(
+            f"stop {next_stop_id} isn't on the route of line {route.line_ref}"
+        )
+    return {
+        "recorded_at_time": parse_time(vehicle, "recorded_at_time"),
+        "lon": lon,
+        "lat": lat,
+        "start_time": parse_time(vehicle, "start_time"),
+        "next_stop_id": next_stop_id,
+    }
+
+
+async def serve(service: EtaService, host: str = "localhost", port: int = 8080):
+    service.warm_up()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"eta service on http://{host}:{server.sockets[0].getsockname()[1]}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument(
+        "--metrics", action="store_true", help="collect the metrics of /metrics"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.metrics:
+        metrics.enable()
+
+    try:
+        asyncio.run(serve(EtaService(workers=args.workers), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+a local fake of the stride api endpoints used by api_functions,
+serving rides synthesized from an arrival data csv.
+
+to run the dataset builder against it:
+    python fake_stride.py --port 8000 --latency 0.05
+    STRIDE_API_BASE_URL=http://localhost:8000 python average_arrival_time.py
+"""
+
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+import pandas as pd
+from dateutil import tz
+
+from consts import (
+    OPERATOR_REFS,
+    LineRef,
+    OperatorRef,
+)
+from get_data import ARRIVAL_DATA_FILE
+from route import get_route, line_ref_of_file
+
+# seconds before the arrival to a stop of the extra location recorded on the way to it
+APPROACH_SECONDS = 30
+# meters between consecutive stops in the synthesized distance_from_journey_start
+STOP_DISTANCE = 500
+
+
+class FakeStride:
+    """
+    the rides, ride stops and vehicle locations of the fake stride api.
+
+    every arrival in the csv becomes a ride stop with two vehicle locations:
+    one APPROACH_SECONDS before the arrival, half way from the previous stop,
+    and one at the stop at the arrival time.
+    """
+
+    def __init__(
+        self, data: pd.DataFrame, line_ref: LineRef, operator_ref: OperatorRef
+    ):
+        israel = tz.gettz("Israel")
+        self.route = route = get_route(line_ref, operator_ref)
+        self.rides = dict()
+        self.ride_stops = dict()
+        self.locations = []
+
+        for ride_id, ride in data.groupby("id", sort=True):
+            first = ride.iloc[0]
+            scheduled_start_time = datetime.datetime.combine(
+                datetime.date.fromisoformat(first["date"]),
+                datetime.time.fromisoformat(first["start_time"]),
+                tzinfo=israel,
+            )
+            self.rides[int(ride_id)] = {
+                "id": int(ride_id),
+                "scheduled_start_time": scheduled_start_time,
+                "line_ref": line_ref,
+                "operator_ref": operator_ref,
+            }
+            for _, arrival in ride.iterrows():
+                siri_stop_id = int(arrival["siri_stop_id"])
+                siri_ride_stop_id = int(arrival["siri_ride_stop_id"])
+                self.ride_stops[siri_ride_stop_id] = {
+                    "id": siri_ride_stop_id,
+                    "siri_stop_id": siri_stop_id,
+                    "siri_ride_id": int(ride_id),
+                }
+                arrival_time = datetime.datetime.combine(
+                    scheduled_start_time.date(),
+                    datetime.time.fromisoformat(arrival["arrival_time"]),
+                    tzinfo=israel,
+                )
+                index = route.stop_index.get(siri_stop_id)
+                if index is None:
+                    index, (lon, lat), (last_lon, last_lat) = 0, (0, 0), (0, 0)
+                else:
+                    lon, lat = route.stop_location(siri_stop_id)
+                    last_lon, last_lat = route.stop_location(
+                        route.stop_ids[max(index - 1, 0)]
+                    )
+                for seconds_before, position, distance in [
+                    (
+                        APPROACH_SECONDS,
+                        ((lon + last_lon) / 2, (lat + last_lat) / 2),
+                        index * STOP_DISTANCE - STOP_DISTANCE / 2,
+                    ),
+                    (0, (lon, lat), index * STOP_DISTANCE),
+                ]:
+                    self.locations.append(
+                        {
+                            "id": len(self.locations) + 1,
+                            "siri_ride_stop_id": siri_ride_stop_id,
+                            "recorded_at_time": arrival_time
+                            - datetime.timedelta(seconds=seconds_before),
+                            "lon": position[0],
+                            "lat": position[1],
+                            "distance_from_journey_start": distance,
+                            "siri_ride__id": int(ride_id),
+                            "siri_ride__scheduled_start_time": scheduled_start_time,
+                            "siri_route__line_ref": line_ref,
+                            "siri_route__operator_ref": operator_ref,
+                        }
+                    )
+
+        self.locations.sort(key=lambda location: location["recorded_at_time"])
+
+    def handle(self, path: str, params: Dict[str, List[str]]):
+        """
+        returns the response of an api call, or None for an unknown path / id.
+        """
+        if path == "/siri_vehicle_locations/list":
+            return paginate(self.filter_locations(params), params)
+        if path == "/siri_rides/get":
+            ride = self.rides.get(int(params["id"][0]))
+            return None if ride is None else public_ride(ride)
+        if path == "/siri_rides/list":
+            return paginate(self.filter_rides(params), params)
+        if path == "/siri_ride_stops/list":
+            ride_ids = int_set(params.get("siri_ride_ids"))
+            ride_stops = [
+                ride_stop
+                for ride_stop in self.ride_stops.values()
+                if ride_ids is None or ride_stop["siri_ride_id"] in ride_ids
+            ]
+            return paginate(ride_stops, params)
+        if path == "/siri_ride_stops/get":
+            return self.ride_stops.get(int(params["id"][0]))
+        if path == "/siri_stops/get":
+            stop_id = int(params["id"][0])
+            if stop_id not in self.route.stop_index:
+                return None
+            return {"id": stop_id, "code": self.route.stop_code(stop_id)}
+        if path == "/siri_stops/list":
+            codes = int_set(params.get("codes"))
+            siri_stops = [
+                {"id": stop_id, "code": self.route.stop_code(stop_id)}
+                for stop_id in self.route.stop_ids
+                if codes is None or self.route.stop_code(stop_id) in codes
+            ]
+            return paginate(siri_stops, params)
+        if path == "/siri_routes/list":
+            line_refs = int_set(params.get("line_refs"))
+            operator_refs = int_set(params.get("operator_refs"))
+            siri_routes = [
+                {
+                    "id": 1,
+                    "line_ref": self.route.line_ref,
+                    "operator_ref": self.route.operator_ref,
+                }
+            ]
+            return paginate(
+                [
+                    siri_route
+                    for siri_route in siri_routes
+                    if (line_refs is None or siri_route["line_ref"] in line_refs)
+                    and (
+                        operator_refs is None
+                        or siri_route["operator_ref"] in operator_refs
+                    )
+                ],
+                params,
+            )
+        if path == "/gtfs_stops/list":
+            index = self.route.code_index.get(int(params["code"][0]))
+            if index is None:
+                return []
+            stop_id = self.route.stop_ids[index]
+            lon, lat = self.route.stop_location(stop_id)
+            return [{"code": self.route.stop_code(stop_id), "lon": lon, "lat": lat}]
+        return None
+
+    def filter_rides(self, params: Dict[str, List[str]]) -> List[Dict]:
+        line_refs = int_set(params.get("siri_route__line_refs"))
+        operator_refs = int_set(params.get("siri_route__operator_refs"))
+        start_from = datetime_param(params, "scheduled_start_time_from")
+        start_to = datetime_param(params, "scheduled_start_time_to")
+
+        rides = [
+            public_ride(ride)
+            for ride in self.rides.values()
+            if (line_refs is None or ride["line_ref"] in line_refs)
+            and (operator_refs is None or ride["operator_ref"] in operator_refs)
+            and (start_from is None or ride["scheduled_start_time"] >= start_from)
+            and (start_to is None or ride["scheduled_start_time"] <= start_to)
+        ]
+        rides.sort(key=lambda ride: (ride["scheduled_start_time"], ride["id"]))
+        if params.get("order_by", [""])[0].split(",")[0].endswith("desc"):
+            rides.reverse()
+        return rides
+
+    def filter_locations(self, params: Dict[str, List[str]]) -> List[Dict]:
+        ride_ids = int_set(params.get("siri_rides__ids"))
+        ride_stop_ids = int_set(params.get("siri_ride_stop_ids"))
+        line_refs = int_set(params.get("siri_routes__line_ref"))
+        operator_refs = int_set(params.get("siri_routes__operator_ref"))
+        start_from = datetime_param(
+            params, "siri_rides__schedualed_start_time_from"
+        ) or datetime_param(params, "siri_rides__scheduled_start_time_from")
+        start_to = datetime_param(
+            params, "siri_rides__schedualed_start_time_to"
+        ) or datetime_param(params, "siri_rides__scheduled_start_time_to")
+
+        locations = [
+            location
+            for location in self.locations
+            if (ride_ids is None or location["siri_ride__id"] in ride_ids)
+            and (
+                ride_stop_ids is None or location["siri_ride_stop_id"] in ride_stop_ids
+            )
+            and (line_refs is None or location["siri_route__line_ref"] in line_refs)
+            and (
+                operator_refs is None
+                or location["siri_route__operator_ref"] in operator_refs
+            )
+            and (
+                start_from is None
+                or location["siri_ride__scheduled_start_time"] >= start_from
+            )
+            and (
+                start_to is None
+                or location["siri_ride__scheduled_start_time"] <= start_to
+            )
+        ]
+        if params.get("order_by", [""])[0].endswith("desc"):
+            locations.reverse()
+        return locations
+
+
+def public_ride(ride: Dict) -> Dict:
+    return {
+        "id": ride["id"],
+        "scheduled_start_time": ride["scheduled_start_time"],
+    }
+
+
+def paginate(items: List, params: Dict[str, List[str]]) -> List:
+    offset = int(params.get("offset", ["0"])[0])
+    limit = int(params.get("limit", ["100"])[0])
+    return items[offset : offset + limit]
+
+
+def int_set(values: Optional[List[str]]):
+    """
+    parses a parameter given either as a comma separated string or as repeated values.
+    """
+    if values is None:
+        return None
+    return {int(value) for joined in values for value in joined.split(",") if value}
+
+
+def datetime_param(params: Dict[str, List[str]], name: str):
+    if name not in params:
+        return None
+    return datetime.datetime.strptime(params[name][0], "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.astimezone(datetime.timezone.utc).isoformat(timespec="seconds")
+    raise TypeError(f"can't serialize {type(value)}")
+
+
+def make_handler(
+    fake: FakeStride, latency: float, error_rate: float, seed: Optional[int]
+):
+    random_errors = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            time.sleep(latency)
+            with lock:
+                fail = random_errors.random() < error_rate
+            if fail:
+                self.respond(503, {"message": "injected error"})
+                return
+            try:
+                response = fake.handle(url.path, params)
+            except (KeyError, ValueError) as e:
+                self.respond(422, {"message": f"bad request: {e}"})
+                return
+            if response is None:
+                self.respond(404, {"message": "not found"})
+            else:
+                self.respond(200, response)
+
+        def respond(self, status: int, body):
+            data = json.dumps(body, default=to_json).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            return
+
+    return Handler
+
+
+def serve(
+    port: int = 0,
+    file_path: str = ARRIVAL_DATA_FILE,
+    line_ref: Optional[LineRef] = None,
+    operator_ref: OperatorRef = OPERATOR_REFS["METROPOLIN"],
+    latency: float = 0,
+    error_rate: float = 0,
+    seed: Optional[int] = 0,
+) -> ThreadingHTTPServer:
+    """
+    starts a fake stride server on localhost in a background thread, and returns it.
+    the server's url is f"http://localhost:{server.server_port}", stop it with server.shutdown().
+
+    the line ref defaults to the one in the name of the arrival data file.
+    every request waits latency seconds, and error_rate of the requests fail with a 503.
+    """
+    if line_ref is None:
+        line_ref = line_ref_of_file(file_path)
+    data = pd.read_csv(file_path, dtype=str)
+    fake = FakeStride(data, line_ref, operator_ref)
+    server = ThreadingHTTPServer(
+        ("localhost", port), make_handler(fake, latency, error_rate, seed)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--file", default=ARRIVAL_DATA_FILE)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per request")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of requests to fail"
+    )
+    args = parser.parse_args()
+
+    server = serve(
+        args.port, args.file, latency=args.latency, error_rate=args.error_rate
+    )
+    print(f"fake stride api on http://localhost:{server.server_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
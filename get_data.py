@@ -1,12 +1,381 @@
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+import numpy as np
 import pandas as pd
 
+import metrics
+from consts import LineRef, SiriStopId
 
-def get_arrival_data():
+ARRIVAL_DATA_FILE = (
+    "2025-01-01-2025-04-30,REF29094.csv"  # Update this path to your actual CSV file
+)
+
+DAYS_OF_WEEK = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+# file suffix of each arrival data format.
+# a columnar dataset is a directory with one .npy file per column, so it can be memory-mapped.
+FILE_FORMATS = {"csv": ".csv", "columnar": ".columns"}
+
+# fixed width dtype of each column in the columnar format
+COLUMN_DTYPES = {
+    "id": np.int64,
+    "date": "datetime64[D]",
+    "day_of_week": np.int8,
+    "start_time": np.int32,
+    "siri_stop_id": np.int64,
+    "siri_ride_stop_id": np.int64,
+    "arrival_time": np.int32,
+}
+
+ARRIVAL_DATA_DTYPES = {
+    "id": "int64",
+    "date": "str",
+    "day_of_week": "str",
+    "start_time": "str",
+    "siri_stop_id": "int64",
+    "siri_ride_stop_id": "int64",
+    "arrival_time": "str",
+}
+
+
+# rows buffered by an ArrivalDataWriter before they are written to disk
+WRITER_CHUNK_SIZE = 10000
+
+
+class NoDataError(ValueError):
+    """
+    raised when there is no data to estimate from,
+    e.g. no arrivals of a slot, no locations of a stop or no arrival data files of a line.
+    """
+
+
+@dataclass
+class ArrivalData:
+    """
+    parsed arrival data, with indexes of the row positions of every
+    (day_of_week, start_time) and (day_of_week, start_time, siri_stop_id).
+    signature tells if the files it was read from changed (see file_signature).
+    """
+
+    signature: Tuple
+    data: pd.DataFrame
+    slot_index: Dict[Tuple[str, int], np.ndarray]
+    stop_index: Dict[Tuple[str, int, SiriStopId], np.ndarray]
+
+
+_arrival_data: Dict[str, ArrivalData] = dict()
+
+
+def time_to_seconds(time: datetime.time) -> int:
+    """
+    returns the seconds since midnight of a time (or the time of a datetime).
+    """
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def seconds_to_time(seconds: int) -> datetime.time:
+    return datetime.time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def time_column_to_seconds(column: pd.Series) -> pd.Series:
+    """
+    converts a column of "%H:%M:%S" strings to seconds since midnight.
+    """
+    parts = column.str.split(":", expand=True).astype("int64")
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def arrival_data_file_name(
+    start_date: datetime.date,
+    end_date: datetime.date,
+    line_ref: LineRef,
+    file_format: str = "csv",
+) -> str:
+    return f"{start_date}-{end_date},REF{line_ref}{FILE_FORMATS[file_format]}"
+
+
+def file_format_of(file_path: str) -> str:
+    for file_format, suffix in FILE_FORMATS.items():
+        if file_path.endswith(suffix):
+            return file_format
+    raise ValueError(f"Unknown arrival data format: {file_path}")
+
+
+def file_signature(file_path: str) -> Tuple[int, int]:
+    """
+    returns the (mtime, size) of an arrival data file, used to tell if it changed.
+    for a columnar dataset these are the latest mtime and total size of its columns.
+    """
+    if not os.path.isdir(file_path):
+        stat = os.stat(file_path)
+        return stat.st_mtime_ns, stat.st_size
+    stats = [
+        os.stat(os.path.join(file_path, f"{column}.npy")) for column in COLUMN_DTYPES
+    ]
+    return max(stat.st_mtime_ns for stat in stats), sum(stat.st_size for stat in stats)
+
+
+@metrics.timed("get_arrival_data")
+def get_arrival_data(file_path: str = ARRIVAL_DATA_FILE) -> pd.DataFrame:
     """
     return a dataframe of arrival data returned by the "generate_data" function.
-    this is a placeholder.
+    the file is parsed once, and parsed again only if it changed on disk.
+
+    start_time and arrival_time are int32 seconds since midnight,
+    day_of_week is a categorical of DAYS_OF_WEEK.
+    the dataframe is shared between callers and should not be modified.
+    """
+    return load_arrival_data(file_path).data
+
+
+def load_arrival_data(file_path: str = ARRIVAL_DATA_FILE) -> ArrivalData:
+    """
+    returns the cached arrival data of the file, parsing it if it is not cached
+    or if the file's mtime or size changed since it was parsed.
+    """
+    signature = file_signature(file_path)
+    arrival_data = _arrival_data.get(file_path)
+    if arrival_data is None or arrival_data.signature != signature:
+        arrival_data = index_arrival_data(read_arrival_data(file_path), signature)
+        _arrival_data[file_path] = arrival_data
+    return arrival_data
+
+
+def index_arrival_data(data: pd.DataFrame, signature: Tuple) -> ArrivalData:
+    return ArrivalData(
+        signature=signature,
+        data=data,
+        slot_index=data.groupby(["day_of_week", "start_time"], observed=True).indices,
+        stop_index=data.groupby(
+            ["day_of_week", "start_time", "siri_stop_id"], observed=True
+        ).indices,
+    )
+
+
+def get_slot_rows(
+    arrival_data: ArrivalData,
+    start_time: datetime.datetime,
+    siri_stop_id: Optional[SiriStopId] = None,
+) -> pd.DataFrame:
+    """
+    returns the arrival data of rides with the same day of week and start time as start_time.
+    if siri_stop_id is given, returns only the arrivals to that stop.
+    """
+    day_of_week = start_time.strftime("%A")
+    start_seconds = time_to_seconds(start_time)
+    if siri_stop_id is None:
+        rows = arrival_data.slot_index.get((day_of_week, start_seconds))
+    else:
+        rows = arrival_data.stop_index.get((day_of_week, start_seconds, siri_stop_id))
+    if rows is None:
+        return arrival_data.data.iloc[:0]
+    return arrival_data.data.iloc[rows]
+
+
+def read_arrival_data(file_path: str) -> pd.DataFrame:
+    """
+    reads an arrival data file of any format with the arrival data schema.
+    """
+    if file_format_of(file_path) == "columnar":
+        return read_columnar(file_path)
+    return apply_schema(pd.read_csv(file_path, dtype=ARRIVAL_DATA_DTYPES))
+
+
+def apply_schema(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    applies the arrival data schema to arrival data as written by "generate_data".
+    """
+    data = data.astype(ARRIVAL_DATA_DTYPES)
+    data["date"] = pd.to_datetime(data["date"], format="%Y-%m-%d").astype(
+        "datetime64[s]"
+    )
+    data["day_of_week"] = pd.Categorical(data["day_of_week"], categories=DAYS_OF_WEEK)
+    data["start_time"] = time_column_to_seconds(data["start_time"]).astype(np.int32)
+    data["arrival_time"] = time_column_to_seconds(data["arrival_time"]).astype(np.int32)
+    return data
+
+
+def read_columnar(file_path: str) -> pd.DataFrame:
+    """
+    reads a columnar arrival dataset.
+    the columns are memory-mapped, only the day of week codes are copied into a categorical.
+    """
+    columns = {
+        column: np.load(os.path.join(file_path, f"{column}.npy"), mmap_mode="r")
+        for column in COLUMN_DTYPES
+    }
+    columns["date"] = columns["date"].astype("datetime64[s]")
+    columns["day_of_week"] = pd.Categorical.from_codes(
+        columns["day_of_week"], categories=DAYS_OF_WEEK
+    )
+    return pd.DataFrame(columns, copy=False)
+
+
+def write_arrival_data(data: pd.DataFrame, file_path: str):
+    """
+    writes arrival data as generated by "generate_data" in the format of the file path.
+    """
+    if file_format_of(file_path) == "csv":
+        data.to_csv(file_path, index=False)
+    else:
+        write_columnar(apply_schema(data), file_path)
+
+
+def column_values(data: pd.DataFrame, column: str) -> np.ndarray:
+    """
+    returns the values of a column of data with the arrival data schema, as stored in the columnar format.
+    """
+    if column == "day_of_week":
+        return data[column].cat.codes.to_numpy()
+    return data[column].to_numpy()
+
+
+def write_columnar(data: pd.DataFrame, file_path: str):
+    """
+    writes arrival data with the arrival data schema as a columnar dataset.
+    the columns are written to a temporary directory that then replaces file_path,
+    so readers never see a partially written dataset.
     """
-    file_path = (
-        "2025-01-01-2025-04-30,REF29094.csv"  # Update this path to your actual CSV file
+    temp_path = file_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    for column, dtype in COLUMN_DTYPES.items():
+        np.save(
+            os.path.join(temp_path, f"{column}.npy"),
+            column_values(data, column).astype(dtype),
+        )
+    shutil.rmtree(file_path, ignore_errors=True)
+    os.replace(temp_path, file_path)
+
+
+class ArrivalDataWriter:
+    """
+    streams arrival data rows into a file of the format of the file path.
+
+    rows are gathered in a buffer of one list per column, and every chunk_size rows
+    the buffer is flushed to a temporary file, so memory stays bounded by the chunk size.
+    the temporary file replaces file_path on close, so readers never see a partial file.
+    a csv is written exactly as "write_arrival_data" would write all the rows at once.
+
+    use as a context manager, the file is only written if no exception was raised.
+    """
+
+    def __init__(self, file_path: str, chunk_size: int = WRITER_CHUNK_SIZE):
+        self.file_path = file_path
+        self.file_format = file_format_of(file_path)
+        self.chunk_size = chunk_size
+        self.temp_path = file_path + ".tmp"
+        self.rows = 0
+        self.buffer = {column: list() for column in ARRIVAL_DATA_DTYPES}
+
+        if self.file_format == "csv":
+            pd.DataFrame(columns=list(ARRIVAL_DATA_DTYPES)).to_csv(
+                self.temp_path, index=False
+            )
+        else:
+            shutil.rmtree(self.temp_path, ignore_errors=True)
+            os.makedirs(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file_format == "csv":
+            os.remove(self.temp_path)
+        else:
+            shutil.rmtree(self.temp_path)
+
+    def append(self, **row):
+        for column, values in self.buffer.items():
+            values.append(row[column])
+        if len(self.buffer["id"]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer["id"]) == 0:
+            return
+        chunk = pd.DataFrame(self.buffer)
+        if self.file_format == "csv":
+            chunk.to_csv(self.temp_path, mode="a", header=False, index=False)
+        else:
+            chunk = apply_schema(chunk)
+            for column, dtype in COLUMN_DTYPES.items():
+                with open(self._raw_column_path(column), "ab") as f:
+                    f.write(column_values(chunk, column).astype(dtype).tobytes())
+        self.rows += len(chunk)
+        self.buffer = {column: list() for column in ARRIVAL_DATA_DTYPES}
+
+    def close(self):
+        self.flush()
+        if self.file_format == "csv":
+            os.replace(self.temp_path, self.file_path)
+            return
+
+        # prepend a .npy header to the raw bytes of every column
+        for column, dtype in COLUMN_DTYPES.items():
+            raw_path = self._raw_column_path(column)
+            with open(os.path.join(self.temp_path, f"{column}.npy"), "wb") as f:
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        "fortran_order": False,
+                        "shape": (self.rows,),
+                    },
+                )
+                if os.path.exists(raw_path):
+                    with open(raw_path, "rb") as raw:
+                        shutil.copyfileobj(raw, f)
+                    os.remove(raw_path)
+        shutil.rmtree(self.file_path, ignore_errors=True)
+        os.replace(self.temp_path, self.file_path)
+
+    def _raw_column_path(self, column: str) -> str:
+        return os.path.join(self.temp_path, f"{column}.raw")
+
+
+def convert_to_columnar(csv_path: str) -> str:
+    """
+    converts an arrival data csv into a columnar dataset next to it.
+    returns the path of the columnar dataset.
+    """
+    columnar_path = csv_path[: -len(FILE_FORMATS["csv"])] + FILE_FORMATS["columnar"]
+    write_columnar(read_arrival_data(csv_path), columnar_path)
+    return columnar_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="convert arrival data csv files into columnar datasets"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="csv files to convert, all the arrival data csv files in the current directory by default",
     )
-    return pd.read_csv(file_path)
+    args = parser.parse_args()
+
+    for csv_path in args.files or sorted(glob.glob("*,REF*.csv")):
+        start = time.time()
+        columnar_path = convert_to_columnar(csv_path)
+        print(f"{csv_path} -> {columnar_path} ({time.time() - start:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
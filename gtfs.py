@@ -0,0 +1,389 @@
+"""
+offline import of the static GTFS feed of the MOT (a zip with stops.txt, routes.txt, trips.txt and stop_times.txt),
+so the stops' locations and names and the routes' stops are read locally in one bulk read,
+instead of a stride call per stop.
+
+    python gtfs.py --file israel-public-transportation.zip --line-ref 29094
+
+the zip is streamed once into compact tables saved next to it ({file}.gtfs.npz),
+which are used as long as the zip doesn't change. with --line-ref, the routes of the lines
+are added to (or updated in) the routes file, see route.py.
+
+a GTFS route_id is the line_ref of the line in the SIRI data, and its agency_id is the operator_ref.
+the imported lines are checked against the siri routes of stride, so a route that doesn't match
+a siri line of its operator isn't imported.
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+import zipfile
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+import api_functions
+from consts import (
+    GTFS_FILE,
+    ROUTES_FILE,
+    Latitute,
+    LineRef,
+    Longtitude,
+    OperatorRef,
+    SiriStopCode,
+    SiriStopId,
+)
+from get_data import file_signature
+from route import Route, get_registry, save_routes
+
+# bump whenever the saved layout changes, so old tables are ignored
+GTFS_TABLES_VERSION = 2
+
+
+@dataclass
+class GtfsTables:
+    """
+    the stops and routes of a GTFS feed, in arrays.
+
+    the stops are indexed by their code (the code of the siri stops).
+    the stops of route i are route_stop_codes[route_offsets[i]:route_offsets[i + 1]],
+    in the order of a trip of the route's most common shape in trips.txt
+    (the stop pattern most of its trips drive).
+    """
+
+    source_file: str
+    source_mtime: int
+    source_size: int
+    stop_codes: np.ndarray
+    stop_lons: np.ndarray
+    stop_lats: np.ndarray
+    stop_names: np.ndarray
+    route_ids: np.ndarray
+    route_agencies: np.ndarray
+    route_names: np.ndarray
+    route_offsets: np.ndarray
+    route_stop_codes: np.ndarray
+    code_index: Dict[int, int] = field(init=False, repr=False)
+    route_index: Dict[int, int] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.code_index = {int(code): i for i, code in enumerate(self.stop_codes)}
+        self.route_index = {int(route): i for i, route in enumerate(self.route_ids)}
+
+    def stop_location(self, code: SiriStopCode) -> Tuple[Longtitude, Latitute]:
+        index = self.code_index[code]
+        return float(self.stop_lons[index]), float(self.stop_lats[index])
+
+    def stop_name(self, code: SiriStopCode) -> str:
+        return str(self.stop_names[self.code_index[code]])
+
+    def route_operator(self, line_ref: LineRef) -> OperatorRef:
+        return OperatorRef(int(self.route_agencies[self.route_index[line_ref]]))
+
+    def route_name(self, line_ref: LineRef) -> str:
+        return str(self.route_names[self.route_index[line_ref]])
+
+    def route_stops(self, line_ref: LineRef) -> List[SiriStopCode]:
+        index = self.route_index[line_ref]
+        start, end = self.route_offsets[index], self.route_offsets[index + 1]
+        return [SiriStopCode(int(code)) for code in self.route_stop_codes[start:end]]
+
+
+_gtfs_tables: Dict[str, Optional[GtfsTables]] = dict()
+
+
+def gtfs_tables_path(file_path: str) -> str:
+    return file_path + ".gtfs.npz"
+
+
+def read_table(feed: zipfile.ZipFile, name: str) -> Iterator[Dict[str, str]]:
+    """
+    yields the rows of a table of the feed one by one, without extracting or loading the whole file.
+    """
+    with feed.open(name) as f:
+        yield from csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig"))
+
+
+def get_gtfs_tables(file_path: str = GTFS_FILE) -> Optional[GtfsTables]:
+    """
+    returns the tables of the GTFS zip, built once and again only when the zip changes,
+    or None if there is no such zip.
+    """
+    if not os.path.exists(file_path):
+        return None
+    signature = file_signature(file_path)
+    tables = _gtfs_tables.get(file_path)
+    if tables is None or (tables.source_mtime, tables.source_size) != signature:
+        tables = load_gtfs_tables(file_path)
+        if tables is None or (tables.source_mtime, tables.source_size) != signature:
+            tables = build_gtfs_tables(file_path)
+        _gtfs_tables[file_path] = tables
+    return tables
+
+
+def load_gtfs_tables(file_path: str) -> Optional[GtfsTables]:
+    path = gtfs_tables_path(file_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if saved.get("version") != GTFS_TABLES_VERSION:
+            return None
+        return GtfsTables(
+            source_file=file_path,
+            source_mtime=int(saved["source_mtime"]),
+            source_size=int(saved["source_size"]),
+            **{
+                name: saved[name]
+                for name in [
+                    "stop_codes",
+                    "stop_lons",
+                    "stop_lats",
+                    "stop_names",
+                    "route_ids",
+                    "route_agencies",
+                    "route_names",
+                    "route_offsets",
+                    "route_stop_codes",
+                ]
+            },
+        )
+
+
+def build_gtfs_tables(file_path: str = GTFS_FILE) -> GtfsTables:
+    """
+    streams the GTFS zip into its tables and saves them next to it.
+
+    stop_times.txt (by far the largest table) is read row by row, and only the rows
+    of a single trip of every route are kept: the first trip of the shape most of the route's trips have.
+    stops without a code (e.g. stations) are left out.
+    """
+    mtime, size = file_signature(file_path)
+    with zipfile.ZipFile(file_path) as feed:
+        stop_codes, stop_lons, stop_lats, stop_names = [], [], [], []
+        # GTFS stop_id : stop code
+        gtfs_stop_codes = dict()
+        for stop in read_table(feed, "stops.txt"):
+            if not stop.get("stop_code"):
+                continue
+            gtfs_stop_codes[stop["stop_id"]] = int(stop["stop_code"])
+            stop_codes.append(int(stop["stop_code"]))
+            stop_lons.append(float(stop["stop_lon"]))
+            stop_lats.append(float(stop["stop_lat"]))
+            stop_names.append(stop["stop_name"])
+
+        routes = {
+            route["route_id"]: (int(route["agency_id"]), route["route_short_name"])
+            for route in read_table(feed, "routes.txt")
+        }
+
+        # (route_id, shape_id) : [the first trip of the shape, the trips of the shape]
+        shapes = dict()
+        for trip in read_table(feed, "trips.txt"):
+            shape = shapes.setdefault(
+                (trip["route_id"], trip.get("shape_id", "")), [trip["trip_id"], 0]
+            )
+            shape[1] += 1
+        # route_id : (the first trip of its most common shape, the trips of the shape)
+        route_trips = dict()
+        for (route_id, _), (trip_id, trips) in shapes.items():
+            if route_id not in route_trips or trips > route_trips[route_id][1]:
+                route_trips[route_id] = (trip_id, trips)
+        # the trip of every route : route_id
+        trip_routes = {
+            trip_id: route_id for route_id, (trip_id, _) in route_trips.items()
+        }
+
+        trip_stops = {trip_id: [] for trip_id in trip_routes}
+        for stop_time in read_table(feed, "stop_times.txt"):
+            stops = trip_stops.get(stop_time["trip_id"])
+            if stops is not None:
+                stops.append((int(stop_time["stop_sequence"]), stop_time["stop_id"]))
+
+    route_ids, route_agencies, route_names, route_stops = [], [], [], []
+    for trip_id, route_id in trip_routes.items():
+        if route_id not in routes:
+            continue
+        agency, name = routes[route_id]
+        route_ids.append(int(route_id))
+        route_agencies.append(agency)
+        route_names.append(name)
+        route_stops.append(
+            [
+                gtfs_stop_codes[stop_id]
+                for _, stop_id in sorted(trip_stops[trip_id])
+                if stop_id in gtfs_stop_codes
+            ]
+        )
+
+    tables = GtfsTables(
+        source_file=file_path,
+        source_mtime=mtime,
+        source_size=size,
+        stop_codes=np.array(stop_codes, dtype=np.int64),
+        stop_lons=np.array(stop_lons, dtype=float),
+        stop_lats=np.array(stop_lats, dtype=float),
+        stop_names=np.array(stop_names, dtype=str),
+        route_ids=np.array(route_ids, dtype=np.int64),
+        route_agencies=np.array(route_agencies, dtype=np.int64),
+        route_names=np.array(route_names, dtype=str),
+        route_offsets=np.concatenate(
+            [[0], np.cumsum([len(stops) for stops in route_stops], dtype=np.int64)]
+        ).astype(np.int64),
+        route_stop_codes=np.array(
+            [code for stops in route_stops for code in stops], dtype=np.int64
+        ),
+    )
+    np.savez_compressed(
+        gtfs_tables_path(file_path),
+        version=GTFS_TABLES_VERSION,
+        source_mtime=mtime,
+        source_size=size,
+        stop_codes=tables.stop_codes,
+        stop_lons=tables.stop_lons,
+        stop_lats=tables.stop_lats,
+        stop_names=tables.stop_names,
+        route_ids=tables.route_ids,
+        route_agencies=tables.route_agencies,
+        route_names=tables.route_names,
+        route_offsets=tables.route_offsets,
+        route_stop_codes=tables.route_stop_codes,
+    )
+    _gtfs_tables[file_path] = tables
+    return tables
+
+
+def gtfs_route(
+    tables: GtfsTables,
+    line_ref: LineRef,
+    siri_stop_ids: Dict[SiriStopCode, SiriStopId],
+    name: Optional[str] = None,
+) -> Route:
+    """
+    returns the route of a line from the GTFS tables.
+    siri_stop_ids maps the codes of the route's stops to their siri stop ids,
+    raises ValueError if it doesn't have some of them.
+    """
+    codes = tables.route_stops(line_ref)
+    missing = [code for code in codes if code not in siri_stop_ids]
+    if missing:
+        raise ValueError(f"no siri stop ids of the stops {missing} of line {line_ref}")
+    return Route(
+        operator_ref=tables.route_operator(line_ref),
+        line_ref=line_ref,
+        name=name if name is not None else tables.route_name(line_ref),
+        stop_ids=[siri_stop_ids[code] for code in codes],
+        codes=codes,
+        lons=[tables.stop_location(code)[0] for code in codes],
+        lats=[tables.stop_location(code)[1] for code in codes],
+        stop_names=[tables.stop_name(code) for code in codes],
+    )
+
+
+def import_routes(
+    line_refs: List[LineRef],
+    file_path: str = GTFS_FILE,
+    routes_path: str = ROUTES_FILE,
+) -> List[Route]:
+    """
+    adds the routes of the lines from the GTFS zip to the routes file, replacing their old routes.
+    the siri stop ids of the stops are taken from the old routes, and the ones they don't have
+    are fetched from stride in a single request.
+    raises ValueError if a line isn't in the GTFS routes, or stride has no siri line of it
+    of the GTFS route's operator.
+    returns the imported routes.
+    """
+    tables = get_gtfs_tables(file_path)
+    if tables is None:
+        raise ValueError(f"GTFS file {file_path} not found")
+    validate_lines(tables, line_refs)
+    registry = get_registry(routes_path) if os.path.exists(routes_path) else None
+    old_routes = [] if registry is None else list(registry.routes.values())
+
+    siri_stop_ids = {
+        SiriStopCode(int(code)): stop
+        for route in old_routes
+        for stop, code in zip(route.stop_ids, route.codes)
+    }
+    missing = {
+        code
+        for line_ref in line_refs
+        for code in tables.route_stops(line_ref)
+        if code not in siri_stop_ids
+    }
+    if missing:
+        siri_stop_ids.update(api_functions.get_siri_stop_ids(sorted(missing)))
+
+    imported = []
+    for line_ref in line_refs:
+        old_route = None if registry is None else registry.lines.get(line_ref)
+        imported.append(
+            gtfs_route(
+                tables,
+                line_ref,
+                siri_stop_ids,
+                name=None if old_route is None else old_route.name,
+            )
+        )
+    imported_lines = {route.line_ref for route in imported}
+    save_routes(
+        [route for route in old_routes if route.line_ref not in imported_lines]
+        + imported,
+        routes_path,
+    )
+    return imported
+
+
+def validate_lines(tables: GtfsTables, line_refs: List[LineRef]):
+    """
+    checks that the GTFS route of every line is the siri line of the same operator
+    (the route_id is the line_ref and the agency_id is the operator_ref), raises ValueError if not.
+    """
+    missing = [line_ref for line_ref in line_refs if line_ref not in tables.route_index]
+    if missing:
+        raise ValueError(f"lines {missing} aren't routes of the GTFS feed")
+    siri_operator_refs = api_functions.get_siri_operator_refs(line_refs)
+    for line_ref in line_refs:
+        operator_ref = tables.route_operator(line_ref)
+        if operator_ref not in siri_operator_refs.get(line_ref, set()):
+            raise ValueError(
+                f"the GTFS route {line_ref} of agency {operator_ref} isn't a siri line of "
+                f"operator {operator_ref} (siri operators of line {line_ref}: "
+                f"{sorted(siri_operator_refs.get(line_ref, set()))})"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--file", default=GTFS_FILE)
+    parser.add_argument(
+        "--line-ref",
+        type=int,
+        action="append",
+        default=[],
+        help="add the route of the line to the routes file (can be repeated)",
+    )
+    parser.add_argument("--routes", default=ROUTES_FILE)
+    args = parser.parse_args()
+
+    start = time.time()
+    tables = get_gtfs_tables(args.file)
+    if tables is None:
+        print(f"GTFS file {args.file} not found")
+        return
+    print(
+        f"{len(tables.stop_codes)} stops, {len(tables.route_ids)} routes "
+        f"in {time.time() - start:.2f}s"
+    )
+    for route in import_routes(args.line_ref, args.file, args.routes):
+        print(
+            f"line {route.line_ref} of operator {route.operator_ref}: "
+            f"{len(route.stop_ids)} stops, {route.length:.0f} meters"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,43 @@
-from typing import Dict, List, Tuple
-from api_functions import get_locations_for_kmenas
+from typing import Dict, Optional
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from dateutil import tz
 
 from consts import (
+    ETA_GRID_MAX_OFFSET,
+    EXACT_KNN,
     K,
+    KNN_METRIC,
     LINE_REFS,
     OPERATOR_REFS,
-    SIRI_STOP_ORDER,
-    SIRI_STOPS_TO_NAME,
     Latitute,
     LineRef,
-    LocationId,
     Longtitude,
     OperatorRef,
-    SiriRideStopId,
     SiriStopId,
 )
 import time
 
-from get_data import get_arrival_data
-from stop_to_stop import generate_time_diffs
+import eta_grid
+import metrics
+from get_data import time_to_seconds
+from neighbors import (
+    get_neighbor_set,
+    run_knn_batch,
+    run_knn_vectorized,
+    run_route_knn,
+    run_route_knn_batch,
+)
+from route import Route, get_route
+from spatial_index import GridIndex
+from stop_to_stop import time_between_stops
+
+# the distances between locations the knn can use, see next_stop_eta
+METRICS = ("route", "euclidean")
 
 
+@metrics.timed("next_stop_eta")
 def next_stop_eta(
     recorded_at_time: datetime,
     lon: Longtitude,
@@ -33,69 +47,36 @@ def next_stop_eta(
     line_ref: LineRef,
     operator_ref: OperatorRef,
     k=K,
+    metric=KNN_METRIC,
+    offline=False,
+    exact=EXACT_KNN,
 ) -> int:
     """
     knn implementation to get the ETA for the next stop
     returns the estimated seconds to arrive at the next stop
-    """
-    locations, arrival_dict = get_relavent_locations(
-        start_time, next_stop_id, line_ref, operator_ref
-    )
-    seconds_to_arrive = run_knn(locations, arrival_dict, recorded_at_time, lon, lat, k)
-    return seconds_to_arrive
-
 
-def get_relavent_locations(
-    start_time: datetime,
-    next_stop_id: SiriStopId,
-    line_ref: LineRef,
-    operator_ref: OperatorRef,
-) -> pd.DataFrame:
+    metric is the distance between locations:
+        "route" - the distance along the route (see route.py)
+        "euclidean" - the euclidean distance in degrees between the lon, lat values
+    if offline is set, only the local location store is used (see get_relavent_locations).
+    if exact isn't set, the knn is read from the compiled grids when there are any (see eta_grid.py).
     """
-    returns all relevant locations for knn in a dataframe.
-    a location is relevant if it is:
-        - in the same time
-        - the same day of week
-        - has the same next_stop_id
-    """
-    location_ids, siri_ride_stop_ids, arrival_dict = get_relavent_ids(
-        start_time, next_stop_id
-    )
-    if len(location_ids) == 0 or len(siri_ride_stop_ids) == 0:
-        raise Exception(
-            "no valid precalculated arrival time found for the given parameters. can't estimate"
+    if metric not in METRICS:
+        raise ValueError(f"Unknown knn metric: {metric}")
+    if metric == "route":
+        return route_eta(
+            start_time,
+            next_stop_id,
+            get_route(line_ref, operator_ref).project(lon, lat),
+            line_ref,
+            operator_ref,
+            k,
+            offline,
+            exact,
         )
-    locations = get_locations_for_kmenas(
-        location_ids, siri_ride_stop_ids, line_ref, operator_ref
+    return euclidean_eta(
+        start_time, next_stop_id, lon, lat, line_ref, operator_ref, k, offline, exact
     )
-    return pd.DataFrame(locations), arrival_dict
-
-
-def get_relavent_ids(
-    start_time: datetime, next_stop_id: SiriStopId
-) -> Tuple[List[LocationId], List[SiriRideStopId], Dict[SiriRideStopId, datetime]]:
-    """
-    returns all relavent Location ids, siri_ride_stop_ids that are relevant for the knn.
-    also returns a dictionary of arrival times for each stop.
-    """
-
-    day_of_week = start_time.strftime("%A")
-    start_hour = start_time.strftime("%H:%M:%S")
-    data = get_arrival_data()
-
-    filtered_data = data[
-        (data["start_time"] == start_hour)
-        & (data["day_of_week"] == day_of_week)
-        & ((data["siri_stop_id"]) == next_stop_id)
-    ]
-
-    location_ids = list(set(filtered_data["id"].tolist()))
-    siri_ride_stop_ids = filtered_data["siri_ride_stop_id"].tolist()
-    arrival_dict = dict(
-        zip(filtered_data["siri_ride_stop_id"], filtered_data["arrival_time"])
-    )
-
-    return location_ids, siri_ride_stop_ids, arrival_dict
 
 
 def calculate_distance(
@@ -112,6 +93,7 @@ def calculate_distance(
     return distance
 
 
+@metrics.timed("sort_locations")
 def sort_locations(
     locations: pd.DataFrame, lon: Longtitude, lat: Latitute, recorded_at_time: datetime
 ) -> pd.DataFrame:
@@ -128,28 +110,222 @@ def sort_locations(
 def calculate_time_to_arrive(location) -> int:
     """
     calculates the time to arrive (in seconds) for a given location.
-    based on the arrival time and the recorded at time.
+    based on the arrival time (seconds since midnight) and the recorded at time.
+    """
+    recorded_at_time = location["recorded_at_time"].astimezone(tz.gettz("Israel"))
+    seconds_to_arrive = location["arrival_time"] - time_to_seconds(recorded_at_time)
+    return seconds_to_arrive
+
+
+def euclidean_eta(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    lon: Longtitude,
+    lat: Latitute,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k=K,
+    offline=False,
+    exact=EXACT_KNN,
+) -> float:
     """
-    arrival_time = datetime.strptime(location["arrival_time"], "%H:%M:%S").time()
-    recorded_at_time = (
-        location["recorded_at_time"].astimezone(tz.gettz("Israel")).time()
+    returns the estimated seconds to arrive at the next stop from a lon, lat, with the euclidean knn.
+
+    unless exact is set, the estimation is interpolated from the compiled grid of the slot and next stop
+    at the lon, lat's position along the route (see eta_grid.py), if there is an up to date grid
+    that covers the position and the lon, lat is at most ETA_GRID_MAX_OFFSET meters from the route
+    (the grids are compiled on the route). otherwise the knn runs on the neighbor set (see run_knn_vectorized).
+    """
+    grid = (
+        None
+        if exact
+        else eta_grid.get_eta_grid(
+            start_time, next_stop_id, k, "euclidean", line_ref, operator_ref
+        )
     )
-    seconds_to_arrive = (
-        datetime.combine(datetime.min, arrival_time)
-        - datetime.combine(datetime.min, recorded_at_time)
-    ).total_seconds()
+    if grid is not None:
+        positions, offsets = get_route(line_ref, operator_ref).project_with_offsets(
+            lon, lat
+        )
+        if offsets[0] <= ETA_GRID_MAX_OFFSET:
+            seconds_to_arrive = grid.lookup(positions[0])
+            if seconds_to_arrive is not None:
+                metrics.count("grid_lookups")
+                return seconds_to_arrive
+    neighbor_set = get_neighbor_set(
+        start_time, next_stop_id, line_ref, operator_ref, offline
+    )
+    metrics.count("neighbors_considered", len(neighbor_set.lons), metric="euclidean")
+    return run_knn_vectorized(
+        neighbor_set.lons,
+        neighbor_set.lats,
+        neighbor_set.times_to_arrive,
+        lon,
+        lat,
+        k,
+        neighbor_set.index,
+    )
+
+
+def euclidean_etas(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    lons: np.ndarray,
+    lats: np.ndarray,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k=K,
+    offline=False,
+    exact=EXACT_KNN,
+) -> np.ndarray:
+    """
+    euclidean_eta for many lon, lat of the same slot and next stop, returns the estimation of every one.
+
+    the lon, lat are looked up in the slot's grid in one pass, and only the ones it doesn't cover
+    are estimated from the neighbor set, all of them at once (see run_knn_batch).
+    """
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    seconds_to_arrive = np.full(len(lons), np.nan)
+    grid = (
+        None
+        if exact
+        else eta_grid.get_eta_grid(
+            start_time, next_stop_id, k, "euclidean", line_ref, operator_ref
+        )
+    )
+    if grid is not None:
+        positions, offsets = get_route(line_ref, operator_ref).project_with_offsets(
+            lons, lats
+        )
+        on_route = offsets <= ETA_GRID_MAX_OFFSET
+        seconds_to_arrive[on_route] = grid.lookup_many(positions[on_route])
+    missing = np.isnan(seconds_to_arrive)
+    metrics.count("grid_lookups", int((~missing).sum()))
+    if missing.any():
+        neighbor_set = get_neighbor_set(
+            start_time, next_stop_id, line_ref, operator_ref, offline
+        )
+        metrics.count(
+            "neighbors_considered",
+            len(neighbor_set.lons) * int(missing.sum()),
+            metric="euclidean",
+        )
+        seconds_to_arrive[missing] = run_knn_batch(
+            neighbor_set.lons,
+            neighbor_set.lats,
+            neighbor_set.times_to_arrive,
+            lons[missing],
+            lats[missing],
+            k,
+            neighbor_set.index,
+        )
     return seconds_to_arrive
 
 
-def run_knn(locations, arrival_dict, recorded_at_time, lon, lat, k):
+def route_eta(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    position: float,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k=K,
+    offline=False,
+    exact=EXACT_KNN,
+) -> float:
+    """
+    returns the estimated seconds to arrive at the next stop from a position along the route.
+
+    unless exact is set, the estimation is interpolated from the compiled grid of the slot
+    and next stop (see eta_grid.py), if there is an up to date one that covers the position.
+    otherwise the knn runs on the neighbor set (see run_route_knn).
+    """
+    if not exact:
+        seconds_to_arrive = eta_grid.lookup_eta(
+            start_time, next_stop_id, position, k, "route", line_ref, operator_ref
+        )
+        if seconds_to_arrive is not None:
+            metrics.count("grid_lookups")
+            return seconds_to_arrive
+    neighbor_set = get_neighbor_set(
+        start_time, next_stop_id, line_ref, operator_ref, offline
+    )
+    metrics.count(
+        "neighbors_considered",
+        min(k, len(neighbor_set.times_to_arrive)),
+        metric="route",
+    )
+    return run_route_knn(
+        neighbor_set.position_index, neighbor_set.times_to_arrive, position, k
+    )
+
+
+def route_etas(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    positions: np.ndarray,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k=K,
+    offline=False,
+    exact=EXACT_KNN,
+) -> np.ndarray:
+    """
+    route_eta for many positions of the same slot and next stop, returns the estimation of every position.
+
+    the positions are looked up in the slot's grid in one pass, and only the ones it doesn't cover
+    are searched in the neighbor set, all of them at once (see run_route_knn_batch).
+    """
+    positions = np.asarray(positions, dtype=float)
+    if exact:
+        seconds_to_arrive = np.full(len(positions), np.nan)
+    else:
+        seconds_to_arrive = eta_grid.lookup_etas(
+            start_time, next_stop_id, positions, k, "route", line_ref, operator_ref
+        )
+    missing = np.isnan(seconds_to_arrive)
+    metrics.count("grid_lookups", int((~missing).sum()))
+    if missing.any():
+        neighbor_set = get_neighbor_set(
+            start_time, next_stop_id, line_ref, operator_ref, offline
+        )
+        metrics.count(
+            "neighbors_considered",
+            min(k, len(neighbor_set.times_to_arrive)) * int(missing.sum()),
+            metric="route",
+        )
+        seconds_to_arrive[missing] = run_route_knn_batch(
+            neighbor_set.position_index,
+            neighbor_set.times_to_arrive,
+            positions[missing],
+            k,
+        )
+    return seconds_to_arrive
+
+
+def run_knn(
+    locations,
+    arrival_dict,
+    recorded_at_time,
+    lon,
+    lat,
+    k,
+    index: Optional[GridIndex] = None,
+):
     """
     finds the K nearest neighbors to the given lon, lat, recorded_at_time,
     and returns the estimated seconds to arrive at the next stop.
+    if a spatial index over the locations is given, it is used to find the neighbors
+    instead of calculating the distance to every location.
     """
-    sorted = sort_locations(locations, lon, lat, recorded_at_time)
-    k = min(k, len(sorted))
-
-    sorted = sorted.iloc[:k]
+    if index is None:
+        sorted = sort_locations(locations, lon, lat, recorded_at_time)
+        k = min(k, len(sorted))
+        sorted = sorted.iloc[:k]
+    else:
+        nearest, distances = index.query(lon, lat, k)
+        sorted = locations.iloc[nearest].copy()
+        sorted["distance"] = distances
     sorted["arrival_time"] = sorted["siri_ride_stop_id"].map(arrival_dict)
     sorted["time_to_arrive"] = sorted.apply(calculate_time_to_arrive, axis=1)
 
@@ -163,12 +339,10 @@ def run_knn(locations, arrival_dict, recorded_at_time, lon, lat, k):
     weighted_sum = (sorted["inverse_distance"] * sorted["time_to_arrive"]).sum()
     astimated_seconds_to_arrive = weighted_sum / inverse_distance_sum
 
-    if astimated_seconds_to_arrive == 0:
-        print(sorted)
-
     return astimated_seconds_to_arrive
 
 
+@metrics.timed("next_stops_eta")
 def next_stops_eta(
     recorded_at_time: datetime,
     lon: Longtitude,
@@ -178,6 +352,9 @@ def next_stops_eta(
     line_ref: LineRef,
     operator_ref: OperatorRef,
     k=K,
+    metric=KNN_METRIC,
+    offline=False,
+    exact=EXACT_KNN,
 ) -> Dict[SiriStopId, int]:
     """
     uses knn to get the ETAs for the next stop, and uses averages of past data to determine the next stops' ETAs.
@@ -191,29 +368,116 @@ def next_stops_eta(
         line_ref,
         operator_ref,
         k,
+        metric,
+        offline,
+        exact,
     )
     seconds_to_arrive = int(seconds_to_arrive)  # add 1 second to avoid rounding issues
-    stop_index = SIRI_STOP_ORDER.index(next_stop_id)
-    next_stops = SIRI_STOP_ORDER[stop_index + 1 :]
-    stop_to_stop_times = generate_time_diffs(start_time)
+    next_stops = get_route(line_ref, operator_ref).next_stops(next_stop_id)
+    stop_to_stop_times = time_between_stops(
+        start_time, next_stop_id, next_stops, line_ref
+    )
 
     arrival_times = dict()
     arrival_times[next_stop_id] = seconds_to_arrive
-    last_stop = next_stop_id
     for stop in next_stops:
-        arrival_times[stop] = arrival_times[last_stop] + stop_to_stop_times[stop]
-        last_stop = stop
+        arrival_times[stop] = seconds_to_arrive + stop_to_stop_times[stop]
 
     return arrival_times
 
 
-def print_etas(arrival_times: Dict[SiriStopId, int], recorded_at_time: datetime):
+@metrics.timed("batch_next_stops_eta")
+def batch_next_stops_eta(
+    vehicles: pd.DataFrame,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    k=K,
+    metric=KNN_METRIC,
+    offline=False,
+    exact=EXACT_KNN,
+) -> pd.DataFrame:
+    """
+    next_stops_eta for many vehicles at once.
+    vehicles is a table with recorded_at_time, lon, lat, start_time and next_stop_id columns.
+
+    the vehicles are grouped by (start_time, next_stop_id): each group shares a neighbor set
+    and stop to stop times, so the knn of all of its vehicles runs in one pass
+    (see route_etas and euclidean_etas)
+    and the times to the following stops are added to all of them at once.
+
+    returns a table with a row per (vehicle, stop): the vehicle's index in vehicles,
+    the siri_stop_id and the estimated seconds_to_arrive, in the order of the vehicles and the stops.
     """
-    prints the estimated times of arrival for each stop in a readable format.
+    if metric not in METRICS:
+        raise ValueError(f"Unknown knn metric: {metric}")
+    route = get_route(line_ref, operator_ref)
+    tables = []
+    for (start_time, next_stop_id), group in vehicles.groupby(
+        ["start_time", "next_stop_id"], sort=False
+    ):
+        start_time = pd.Timestamp(start_time).to_pydatetime()
+        if metric == "route":
+            seconds_to_arrive = route_etas(
+                start_time,
+                next_stop_id,
+                route.project_many(group["lon"], group["lat"]),
+                line_ref,
+                operator_ref,
+                k,
+                offline,
+                exact,
+            )
+        else:
+            seconds_to_arrive = euclidean_etas(
+                start_time,
+                next_stop_id,
+                group["lon"],
+                group["lat"],
+                line_ref,
+                operator_ref,
+                k,
+                offline,
+                exact,
+            )
+        seconds_to_arrive = np.trunc(seconds_to_arrive).astype(int)
+
+        next_stops = route.next_stops(next_stop_id)
+        stop_to_stop_times = time_between_stops(
+            start_time, next_stop_id, next_stops, line_ref
+        )
+        stops = [next_stop_id] + next_stops
+        offsets = np.array([0] + [stop_to_stop_times[stop] for stop in next_stops])
+
+        tables.append(
+            pd.DataFrame(
+                {
+                    "vehicle": np.repeat(group.index.to_numpy(), len(stops)),
+                    "siri_stop_id": np.tile(stops, len(group)),
+                    "seconds_to_arrive": (
+                        seconds_to_arrive[:, np.newaxis] + offsets
+                    ).ravel(),
+                }
+            )
+        )
+
+    if len(tables) == 0:
+        return pd.DataFrame(columns=["vehicle", "siri_stop_id", "seconds_to_arrive"])
+    etas = pd.concat(tables, ignore_index=True)
+    order = pd.Series(range(len(vehicles)), index=vehicles.index)
+    return etas.sort_values(
+        "vehicle", key=lambda vehicle: vehicle.map(order), kind="stable"
+    ).reset_index(drop=True)
+
+
+def print_etas(
+    arrival_times: Dict[SiriStopId, int], recorded_at_time: datetime, route: Route
+):
+    """
+    prints the estimated times of arrival for each stop of the route in a readable format.
     """
     for stop, seconds in arrival_times.items():
         arrival_time = recorded_at_time + pd.to_timedelta(seconds, unit="s")
-        stop_name = SIRI_STOPS_TO_NAME[stop]
+        stop_name = route.stop_name(stop)
         print(
             f"Stop {stop_name[::-1]} will be reached in {seconds} seconds, at {arrival_time.time()}"
         )
@@ -231,6 +495,8 @@ def main():
         f"{date_str} {recorded_at_time_str}", "%Y-%m-%d %H:%M:%S"
     )
     next_stop_id = 2391
+    line_ref = LINE_REFS["8_to_cinema"]
+    operator_ref = OPERATOR_REFS["METROPOLIN"]
 
     start = time.time()
     times = next_stops_eta(
@@ -239,10 +505,10 @@ def main():
         lat,
         start_time,
         next_stop_id,
-        LINE_REFS["8_to_cinema"],
-        OPERATOR_REFS["METROPOLIN"],
+        line_ref,
+        operator_ref,
     )
-    print_etas(times, recorded_at_time)
+    print_etas(times, recorded_at_time, get_route(line_ref, operator_ref))
     print("Calculation time:", time.time() - start)
     return
 
@@ -0,0 +1,301 @@
+"""
+a streaming consumer of live vehicle positions, that updates the ETAs of a vehicle on every position.
+
+the messages are SIRI vehicle locations, with the fields of the stride api:
+    siri_ride__id, siri_ride__scheduled_start_time, recorded_at_time, lon, lat
+
+a recorded feed (one json message per line) replays as a local stand-in for the live feed.
+to record a feed of a day from the local location store and replay it:
+    python live_feed.py record --date 2025-01-22 feed.jsonl
+    python live_feed.py replay feed.jsonl
+"""
+
+import argparse
+import datetime
+import json
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, Optional
+import numpy as np
+from dateutil import tz
+
+import catalog
+from consts import (
+    K,
+    KNN_METRIC,
+    LINE_REFS,
+    OPERATOR_REFS,
+    LineRef,
+    OperatorRef,
+    SiriRideId,
+    SiriStopId,
+)
+from get_data import NoDataError, time_to_seconds
+from knn import next_stop_eta
+from location_store import get_stored_locations
+from route import get_route
+from stop_to_stop import time_between_stops
+
+
+@dataclass
+class VehicleState:
+    """
+    what is known about a vehicle (a ride) from its last position.
+    """
+
+    start_time: datetime.datetime
+    next_stop_id: SiriStopId
+    recorded_at_time: datetime.datetime
+    lon: float
+    lat: float
+    position: float
+
+
+@dataclass
+class EtaUpdate:
+    siri_ride_id: SiriRideId
+    recorded_at_time: datetime.datetime
+    next_stop_id: SiriStopId
+    # seconds to arrive at each of the next stops, from recorded_at_time
+    etas: Dict[SiriStopId, float]
+
+
+class LiveEtas:
+    """
+    keeps the state of every vehicle of a line, and estimates its ETAs on every new position.
+
+    only the updated vehicle's ETAs are estimated: its position along the route gives its next stop
+    (a vehicle never goes back to a stop it passed), the knn (knn.next_stop_eta with the metric)
+    runs on the warm neighbor set (or compiled grid) of its slot and next stop, and the times to the following stops
+    are looked up once per slot and next stop and reused for every vehicle.
+    """
+
+    def __init__(
+        self,
+        line_ref: LineRef,
+        operator_ref: OperatorRef,
+        k: int = K,
+        metric: str = KNN_METRIC,
+        offline: bool = False,
+    ):
+        self.line_ref = line_ref
+        self.operator_ref = operator_ref
+        self.k = k
+        self.metric = metric
+        self.offline = offline
+        self.route = get_route(line_ref, operator_ref)
+        self.vehicles: Dict[SiriRideId, VehicleState] = dict()
+        # (arrival data signature, day_of_week, start seconds, next stop) : (stops, seconds from the next stop)
+        self._downstream = dict()
+        self.errors = 0
+
+    def update(self, message: Dict) -> Optional[EtaUpdate]:
+        """
+        updates the vehicle of the message, returns its new ETAs,
+        or None if they can't be estimated (e.g. there is no data for its slot).
+        """
+        ride_id = int(message["siri_ride__id"])
+        recorded_at_time = parse_time(message["recorded_at_time"])
+        lon, lat = float(message["lon"]), float(message["lat"])
+        position = self.route.project(lon, lat)
+
+        state = self.vehicles.get(ride_id)
+        if state is None:
+            start_time = parse_time(message["siri_ride__scheduled_start_time"])
+            state = VehicleState(
+                start_time=start_time.astimezone(tz.gettz("Israel")),
+                next_stop_id=self.route.next_stop(position),
+                recorded_at_time=recorded_at_time,
+                lon=lon,
+                lat=lat,
+                position=position,
+            )
+            self.vehicles[ride_id] = state
+        else:
+            state.recorded_at_time = recorded_at_time
+            state.lon, state.lat = lon, lat
+            state.position = max(state.position, position)
+            state.next_stop_id = self.route.next_stop(state.position)
+
+        try:
+            stops, offsets = self.downstream(state.start_time, state.next_stop_id)
+            seconds_to_arrive = int(
+                next_stop_eta(
+                    recorded_at_time,
+                    lon,
+                    lat,
+                    state.start_time,
+                    state.next_stop_id,
+                    self.line_ref,
+                    self.operator_ref,
+                    self.k,
+                    self.metric,
+                    self.offline,
+                )
+            )
+        except NoDataError:
+            # no data for the slot, or a stop the slot's data doesn't reach
+            self.errors += 1
+            return None
+        return EtaUpdate(
+            siri_ride_id=ride_id,
+            recorded_at_time=recorded_at_time,
+            next_stop_id=state.next_stop_id,
+            etas=dict(zip(stops, (seconds_to_arrive + offsets).tolist())),
+        )
+
+    def downstream(self, start_time: datetime.datetime, next_stop_id: SiriStopId):
+        """
+        returns the stops from next_stop_id to the end of the route, and the time to each one
+        from next_stop_id. only found times are remembered, so a slot whose data is added later
+        is estimated once it is there, and they are looked up again once the arrival data of the line changes.
+        """
+        key = (
+            catalog.dataset_signature(self.line_ref),
+            start_time.strftime("%A"),
+            time_to_seconds(start_time),
+            next_stop_id,
+        )
+        if key not in self._downstream:
+            next_stops = self.route.next_stops(next_stop_id)
+            times = time_between_stops(
+                start_time, next_stop_id, next_stops, self.line_ref
+            )
+            self._downstream[key] = (
+                [next_stop_id] + next_stops,
+                np.array([0] + [times[stop] for stop in next_stops]),
+            )
+        return self._downstream[key]
+
+    def consume(self, messages: Iterable[Dict]) -> Iterator[EtaUpdate]:
+        """
+        yields the ETA updates of the messages as they are consumed.
+        """
+        for message in messages:
+            update = self.update(message)
+            if update is not None:
+                yield update
+
+
+def parse_time(value) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+def read_feed(path: str, speed: Optional[float] = None) -> Iterator[Dict]:
+    """
+    yields the messages of a recorded feed.
+    if speed is given, the messages are yielded at speed times the pace they were recorded in.
+    """
+    first_recorded = None
+    started = time.perf_counter()
+    with open(path) as f:
+        for line in f:
+            message = json.loads(line)
+            if speed is not None:
+                recorded = parse_time(message["recorded_at_time"])
+                if first_recorded is None:
+                    first_recorded = recorded
+                due = (recorded - first_recorded).total_seconds() / speed
+                time.sleep(max(0, due - (time.perf_counter() - started)))
+            yield message
+
+
+def record_feed(
+    path: str,
+    date: datetime.date,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    directory: str = ".",
+) -> int:
+    """
+    writes the stored vehicle locations of the rides of a day as a feed, in the order they were recorded.
+    the rides are read from the arrival data of the line in the directory (see catalog.py).
+    returns the number of messages written.
+    """
+    day = catalog.get_line_arrival_data(line_ref, date, date, directory)
+    locations = get_stored_locations(day["siri_ride_stop_id"], line_ref, operator_ref)
+    rides = day.drop_duplicates("id").set_index("id")
+    israel = tz.gettz("Israel")
+    scheduled_start_times = {
+        ride_id: datetime.datetime.combine(date, datetime.time(), tzinfo=israel)
+        + datetime.timedelta(seconds=int(start_time))
+        for ride_id, start_time in rides["start_time"].items()
+    }
+
+    locations = locations.sort_values("recorded_at_time", kind="stable")
+    with open(path, "w") as f:
+        for ride_id, recorded_at_time, lon, lat in zip(
+            locations["siri_ride__id"],
+            locations["recorded_at_time"],
+            locations["lon"],
+            locations["lat"],
+        ):
+            message = {
+                "siri_ride__id": int(ride_id),
+                "siri_ride__scheduled_start_time": scheduled_start_times[
+                    ride_id
+                ].isoformat(),
+                "recorded_at_time": recorded_at_time.isoformat(),
+                "lon": float(lon),
+                "lat": float(lat),
+            }
+            f.write(json.dumps(message) + "\n")
+    return len(locations)
+
+
+def print_update(update: EtaUpdate):
+    next_eta = update.etas[update.next_stop_id]
+    print(
+        f"{update.recorded_at_time.time()} ride {update.siri_ride_id}: "
+        f"stop {update.next_stop_id} in {next_eta:.0f}s, "
+        f"{len(update.etas) - 1} more stops"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record = subparsers.add_parser("record", help="record a feed from the local data")
+    record.add_argument("feed")
+    record.add_argument("--date", type=datetime.date.fromisoformat, required=True)
+    record.add_argument(
+        "--directory", default=".", help="the directory of the arrival data files"
+    )
+    replay = subparsers.add_parser("replay", help="replay a recorded feed")
+    replay.add_argument("feed")
+    replay.add_argument(
+        "--speed", type=float, help="replay at this pace (as fast as possible if unset)"
+    )
+    replay.add_argument("--quiet", action="store_true", help="don't print the updates")
+    args = parser.parse_args()
+
+    line_ref = LINE_REFS["8_to_cinema"]
+    operator_ref = OPERATOR_REFS["METROPOLIN"]
+    if args.command == "record":
+        count = record_feed(
+            args.feed, args.date, line_ref, operator_ref, args.directory
+        )
+        print(f"recorded {count} messages to {args.feed}")
+        return
+
+    live_etas = LiveEtas(line_ref, operator_ref, offline=True)
+    updates = 0
+    start = time.perf_counter()
+    for update in live_etas.consume(read_feed(args.feed, args.speed)):
+        updates += 1
+        if not args.quiet:
+            print_update(update)
+    elapsed = time.perf_counter() - start
+    messages = updates + live_etas.errors
+    print(
+        f"{messages} messages, {updates} updates, {live_etas.errors} without data "
+        f"in {elapsed:.2f}s ({messages / elapsed:.0f} messages per second)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+a local store of historical vehicle locations, so the knn doesn't call the stride api per query.
+the locations of the rides are saved while the arrival data is generated,
+and can be backfilled for existing arrival data files with:
+    python location_store.py --file 2025-01-01-2025-04-30,REF29094.csv
+
+the stored distance_from_journey_start of the locations also calibrates the distances of the stops
+of the line's route (see route.py), so positions along the route follow the path the buses drive:
+    python location_store.py --file 2025-01-01-2025-04-30,REF29094.csv --calibrate
+"""
+
+import argparse
+import sqlite3
+import threading
+from typing import Dict, Iterable, List
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from api_functions import iterate_locations_by_ride_id
+
+from consts import (
+    LOCATION_STORE_FILE,
+    OPERATOR_REFS,
+    RIDES_PER_REQUEST,
+    ROUTES_FILE,
+    LineRef,
+    OperatorRef,
+    SiriRideId,
+    SiriRideStopId,
+)
+from get_data import ARRIVAL_DATA_FILE, get_arrival_data
+from route import Route, line_ref_of_file, load_routes, save_routes
+
+# the most ids in a single "IN (...)" of a query, below sqlite's limit of variables
+IDS_PER_QUERY = 900
+# meters from a stop of the locations whose distance_from_journey_start is the stop's distance
+STOP_RADIUS = 30
+
+_lock = threading.Lock()
+_connections: Dict[str, sqlite3.Connection] = dict()
+
+
+def get_connection(path: str = LOCATION_STORE_FILE) -> sqlite3.Connection:
+    if path not in _connections:
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS locations ("
+            "id INTEGER PRIMARY KEY, line_ref INTEGER, operator_ref INTEGER, "
+            "siri_ride_id INTEGER, siri_ride_stop_id INTEGER, "
+            "recorded_at_time INTEGER, lon REAL, lat REAL, distance_from_journey_start REAL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS locations_by_ride_stop "
+            "ON locations (line_ref, operator_ref, siri_ride_stop_id)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS locations_by_ride "
+            "ON locations (line_ref, operator_ref, siri_ride_id)"
+        )
+        # bumped on every write of locations of the line, see get_store_version
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS versions ("
+            "line_ref INTEGER, operator_ref INTEGER, version INTEGER, "
+            "PRIMARY KEY (line_ref, operator_ref))"
+        )
+        _connections[path] = connection
+    return _connections[path]
+
+
+def store_locations(locations: List[Dict], path: str = LOCATION_STORE_FILE) -> int:
+    """
+    saves vehicle locations, as returned by the stride api (/siri_vehicle_locations/list),
+    to the store. locations that are already stored are replaced.
+    returns the number of locations saved.
+    """
+    if len(locations) == 0:
+        return 0
+    df = pd.DataFrame(locations)
+    recorded_at_time = pd.to_datetime(df["recorded_at_time"], utc=True).dt.as_unit("s")
+    rows = zip(
+        df["id"].astype(int).tolist(),
+        df["siri_route__line_ref"].astype(int).tolist(),
+        df["siri_route__operator_ref"].astype(int).tolist(),
+        df["siri_ride__id"].astype(int).tolist(),
+        df["siri_ride_stop_id"].astype(int).tolist(),
+        recorded_at_time.astype("int64").tolist(),
+        df["lon"].astype(float).tolist(),
+        df["lat"].astype(float).tolist(),
+        df["distance_from_journey_start"].astype(float).tolist(),
+    )
+    lines = set(
+        zip(
+            df["siri_route__line_ref"].astype(int).tolist(),
+            df["siri_route__operator_ref"].astype(int).tolist(),
+        )
+    )
+    with _lock:
+        connection = get_connection(path)
+        connection.executemany(
+            "INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        connection.executemany(
+            "INSERT INTO versions VALUES (?, ?, 1) ON CONFLICT (line_ref, operator_ref) "
+            "DO UPDATE SET version = version + 1",
+            lines,
+        )
+        connection.commit()
+    return len(df)
+
+
+def get_store_version(
+    line_ref: LineRef, operator_ref: OperatorRef, path: str = LOCATION_STORE_FILE
+) -> int:
+    """
+    returns a number that changes whenever locations of the line are stored (by any process),
+    used to tell if the stored locations of the line changed.
+    """
+    with _lock:
+        row = (
+            get_connection(path)
+            .execute(
+                "SELECT version FROM versions WHERE line_ref = ? AND operator_ref = ?",
+                (line_ref, operator_ref),
+            )
+            .fetchone()
+        )
+    return 0 if row is None else row[0]
+
+
+def get_stored_locations(
+    siri_ride_stop_ids: Iterable[SiriRideStopId],
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    path: str = LOCATION_STORE_FILE,
+) -> pd.DataFrame:
+    """
+    returns the stored locations of the given ride stops, in the columns of the stride api
+    (id, siri_ride__id, siri_ride_stop_id, recorded_at_time, lon, lat, distance_from_journey_start),
+    ordered by recorded_at_time desc like api_functions.get_locations_for_kmenas.
+    """
+    siri_ride_stop_ids = sorted({int(i) for i in siri_ride_stop_ids})
+    chunks = []
+    with _lock:
+        connection = get_connection(path)
+        for i in range(0, len(siri_ride_stop_ids), IDS_PER_QUERY):
+            ids = siri_ride_stop_ids[i : i + IDS_PER_QUERY]
+            chunks.append(
+                pd.read_sql_query(
+                    "SELECT id, siri_ride_id AS siri_ride__id, siri_ride_stop_id, "
+                    "recorded_at_time, lon, lat, distance_from_journey_start "
+                    "FROM locations WHERE line_ref = ? AND operator_ref = ? "
+                    f"AND siri_ride_stop_id IN ({', '.join('?' * len(ids))})",
+                    connection,
+                    params=[line_ref, operator_ref, *ids],
+                )
+            )
+    if len(chunks) == 0:
+        return pd.DataFrame(
+            columns=[
+                "id",
+                "siri_ride__id",
+                "siri_ride_stop_id",
+                "recorded_at_time",
+                "lon",
+                "lat",
+                "distance_from_journey_start",
+            ]
+        )
+    locations = pd.concat(chunks, ignore_index=True)
+    locations["recorded_at_time"] = pd.to_datetime(
+        locations["recorded_at_time"], unit="s", utc=True
+    )
+    return locations.sort_values(
+        "recorded_at_time", ascending=False, kind="stable", ignore_index=True
+    )
+
+
+def get_stored_ride_ids(
+    line_ref: LineRef, operator_ref: OperatorRef, path: str = LOCATION_STORE_FILE
+) -> set:
+    with _lock:
+        rows = (
+            get_connection(path)
+            .execute(
+                "SELECT DISTINCT siri_ride_id FROM locations "
+                "WHERE line_ref = ? AND operator_ref = ?",
+                (line_ref, operator_ref),
+            )
+            .fetchall()
+        )
+    return {row[0] for row in rows}
+
+
+def backfill(
+    ride_ids: Iterable[SiriRideId],
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    path: str = LOCATION_STORE_FILE,
+    rides_per_request: int = RIDES_PER_REQUEST,
+    progress: bool = True,
+) -> int:
+    """
+    fetches and stores the locations of the rides that aren't in the store yet.
+    returns the number of locations saved.
+    """
+    stored = get_stored_ride_ids(line_ref, operator_ref, path)
+    ride_ids = sorted({int(i) for i in ride_ids} - stored)
+    saved = 0
+    for i in tqdm(
+        range(0, len(ride_ids), rides_per_request),
+        desc="Fetching ride locations",
+        disable=not progress,
+    ):
+        for page in iterate_locations_by_ride_id(ride_ids[i : i + rides_per_request]):
+            saved += store_locations(page, path)
+    return saved
+
+
+def calibrate_stop_distances(
+    route: Route, path: str = LOCATION_STORE_FILE, radius: float = STOP_RADIUS
+) -> np.ndarray:
+    """
+    returns the distance from the journey start of every stop of the route:
+    the median distance_from_journey_start of the stored locations of the line within radius meters of it.
+    the distances of stops without such locations are interpolated from the stops around them
+    by the straight segments between the stops.
+    raises ValueError if fewer than two stops have locations around them.
+    """
+    with _lock:
+        locations = pd.read_sql_query(
+            "SELECT lon, lat, distance_from_journey_start FROM locations "
+            "WHERE line_ref = ? AND operator_ref = ? "
+            "AND distance_from_journey_start IS NOT NULL",
+            get_connection(path),
+            params=[route.line_ref, route.operator_ref],
+        )
+    x, y = route.to_meters(locations["lon"], locations["lat"])
+    location_distances = locations["distance_from_journey_start"].to_numpy(dtype=float)
+    distances = np.full(len(route.stop_ids), np.nan)
+    for i, (stop_x, stop_y) in enumerate(zip(route.x, route.y)):
+        near = np.hypot(x - stop_x, y - stop_y) <= radius
+        if near.any():
+            distances[i] = np.median(location_distances[near])
+
+    measured = ~np.isnan(distances)
+    if measured.sum() < 2:
+        raise ValueError(
+            f"only {measured.sum()} stops of line {route.line_ref} have stored locations "
+            f"within {radius} meters, can't calibrate its stop distances"
+        )
+    straight = np.concatenate([[0], np.cumsum(route.segment_lengths)])
+    distances = np.interp(straight, straight[measured], distances[measured])
+    # a location of another stop of a route that passes near itself can't make the distances go back
+    return np.maximum.accumulate(distances)
+
+
+def calibrate_route(
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    path: str = LOCATION_STORE_FILE,
+    routes_file: str = ROUTES_FILE,
+) -> Route:
+    """
+    calibrates the stop distances of the route of the line (see calibrate_stop_distances),
+    and saves them to the routes file. returns the calibrated route.
+    """
+    routes = load_routes(routes_file)
+    route = routes.get(line_ref, operator_ref)
+    calibrated = Route(
+        operator_ref=route.operator_ref,
+        line_ref=route.line_ref,
+        name=route.name,
+        stop_ids=route.stop_ids,
+        codes=route.codes,
+        lons=route.lons,
+        lats=route.lats,
+        stop_names=route.stop_names,
+        stop_distances=calibrate_stop_distances(route, path),
+    )
+    save_routes(
+        [calibrated if other is route else other for other in routes.routes.values()],
+        routes_file,
+    )
+    return calibrated
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--file", default=ARRIVAL_DATA_FILE)
+    parser.add_argument("--store", default=LOCATION_STORE_FILE)
+    parser.add_argument("--operator-ref", type=int, default=OPERATOR_REFS["METROPOLIN"])
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help="calibrate the stop distances of the line's route from the stored locations",
+    )
+    args = parser.parse_args()
+
+    line_ref = line_ref_of_file(args.file)
+    if args.calibrate:
+        route = calibrate_route(line_ref, args.operator_ref, args.store)
+        print(
+            f"calibrated the distances of the {len(route.stop_ids)} stops of line {line_ref}, "
+            f"{route.length:.0f} meters"
+        )
+        return
+    ride_ids = get_arrival_data(args.file)["id"].unique()
+    saved = backfill(ride_ids, line_ref, args.operator_ref, args.store)
+    print(f"saved {saved} locations of line {line_ref} to {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+a persistent cache for stride lookups that never change (a ride's start time, a stop's code...).
+results are kept in an sqlite file shared by all runs, with an in-memory LRU in front of it.
+"""
+
+import datetime
+import functools
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from consts import LOOKUP_CACHE_FILE, LOOKUP_CACHE_SIZE
+
+_lock = threading.Lock()
+_connection = None
+_memory = OrderedDict()
+_stats: Dict[str, Dict[str, int]] = dict()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(LOOKUP_CACHE_FILE, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS lookups "
+            "(function TEXT, key TEXT, value TEXT, PRIMARY KEY (function, key))"
+        )
+    return _connection
+
+
+def encode(value) -> str:
+    def default(v):
+        if isinstance(v, datetime.datetime):
+            return {"datetime": v.isoformat()}
+        raise TypeError(f"can't cache a {type(v)}")
+
+    return json.dumps(value, default=default)
+
+
+def decode(text: str):
+    def object_hook(d):
+        if "datetime" in d:
+            return datetime.datetime.fromisoformat(d["datetime"])
+        return d
+
+    value = json.loads(text, object_hook=object_hook)
+    return tuple(value) if isinstance(value, list) else value
+
+
+# what cached returns for an argument that isn't cached, as a cached result may be None
+MISSING = object()
+
+
+def persistent_cache(function: Callable) -> Callable:
+    """
+    caches the results of a function of a single argument,
+    in memory and in the lookup cache file.
+
+    the wrapper also has:
+        cached(argument) - the cached result, or MISSING if it isn't cached (without calling the function).
+        store(results) - caches a dict of argument: result, e.g. of a bulk request.
+    """
+    name = function.__name__
+    stats = _stats.setdefault(name, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+
+    @functools.wraps(function)
+    def wrapper(argument):
+        value = lookup(name, argument)
+        if value is not MISSING:
+            return value
+        value = function(argument)
+        with _lock:
+            stats["misses"] += 1
+        store(name, {argument: value})
+        return value
+
+    wrapper.cached = lambda argument: lookup(name, argument)
+    wrapper.store = lambda results: store(name, results)
+    return wrapper
+
+
+def lookup(name: str, argument):
+    """
+    returns the cached result of the function for the argument, or MISSING.
+    """
+    stats = _stats[name]
+    key = (name, str(argument))
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            stats["memory_hits"] += 1
+            return _memory[key]
+        row = (
+            get_connection()
+            .execute("SELECT value FROM lookups WHERE function = ? AND key = ?", key)
+            .fetchone()
+        )
+        if row is None:
+            return MISSING
+        stats["disk_hits"] += 1
+        value = decode(row[0])
+        remember(key, value)
+        return value
+
+
+def store(name: str, results: Dict):
+    with _lock:
+        connection = get_connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)",
+            [
+                (name, str(argument), encode(value))
+                for argument, value in results.items()
+            ],
+        )
+        connection.commit()
+        for argument, value in results.items():
+            remember((name, str(argument)), value)
+
+
+def remember(key, value):
+    """
+    adds a result to the in-memory LRU, the lock must be held.
+    """
+    _memory[key] = value
+    _memory.move_to_end(key)
+    if len(_memory) > LOOKUP_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """
+    returns the memory hits, disk hits and misses of every cached function since the process started.
+    """
+    with _lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
+
+
+def clear_memory():
+    """
+    clears the in-memory LRU, the cache file is kept.
+    """
+    with _lock:
+        _memory.clear()
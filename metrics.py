@@ -0,0 +1,238 @@
+"""
+latency and count metrics of the ETA pipeline and the dataset builder, off by default.
+to turn them on, set ZOOZIT_METRICS=1 or call metrics.enable().
+
+    ZOOZIT_METRICS=1 ZOOZIT_METRICS_FILE=metrics.prom python knn.py
+
+when enabled, every stage (a function decorated with timed, or a block in a span) is timed
+into a latency histogram, and the counters count the rows scanned, the neighbors considered
+and the api calls made. the metrics are exported in the prometheus text format or as json lines,
+and written on exit to ZOOZIT_METRICS_FILE if it is set (as json lines if it ends with .jsonl).
+
+when disabled, a timed function or a count costs a single check.
+"""
+
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+# the upper bounds (in seconds) of the latency histograms' buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+PREFIX = "zoozit_"
+
+enabled = os.environ.get("ZOOZIT_METRICS", "") not in ("", "0")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = dict()
+_histograms: Dict[Tuple[str, Labels], "Histogram"] = dict()
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class Span:
+    """
+    times the block it wraps into the stage_seconds histogram of the stage.
+    """
+
+    __slots__ = ["stage", "labels", "start"]
+
+    def __init__(self, stage: str, labels: Dict[str, str]):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        observe(
+            "stage_seconds",
+            time.perf_counter() - self.start,
+            stage=self.stage,
+            **self.labels,
+        )
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_no_span = NoSpan()
+
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def count(name: str, value: float = 1, **labels):
+    """
+    adds value to the counter of the name and labels.
+    """
+    if not enabled:
+        return
+    key = (name, labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """
+    adds value to the latency histogram of the name and labels.
+    """
+    if not enabled:
+        return
+    key = (name, labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def span(stage: str, **labels):
+    """
+    returns a context manager that times its block as the stage.
+    """
+    if not enabled:
+        return _no_span
+    return Span(stage, labels)
+
+
+def timed(stage: str) -> Callable:
+    """
+    a decorator that times every call of the function as the stage.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(stage, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def to_prometheus() -> str:
+    """
+    returns the metrics in the prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            for (counter, labels), value in sorted(_counters.items()):
+                if counter == name:
+                    lines.append(f"{PREFIX}{name}_total{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (histogram_name, labels), histogram in sorted(_histograms.items()):
+                if histogram_name != name:
+                    continue
+                for bound, cumulative in zip(
+                    histogram.buckets, histogram.cumulative_counts()
+                ):
+                    bucket_labels = format_labels(labels + (("le", str(bound)),))
+                    lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+                inf_labels = format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{PREFIX}{name}_bucket{inf_labels} {histogram.count}")
+                lines.append(
+                    f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}"
+                )
+                lines.append(
+                    f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def to_json_lines() -> str:
+    """
+    returns the metrics as json lines, one per counter or histogram.
+    """
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(
+                {
+                    "name": name,
+                    "type": "counter",
+                    "labels": dict(labels),
+                    "value": value,
+                }
+            )
+        for (name, labels), histogram in sorted(_histograms.items()):
+            lines.append(
+                {
+                    "name": name,
+                    "type": "histogram",
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(
+                        zip(map(str, histogram.buckets), histogram.cumulative_counts())
+                    ),
+                }
+            )
+    return "".join(json.dumps(line) + "\n" for line in lines)
+
+
+def write(path: str):
+    """
+    writes the metrics to path, as json lines if it ends with .jsonl, otherwise in the prometheus format.
+    """
+    with open(path, "w") as f:
+        f.write(to_json_lines() if path.endswith(".jsonl") else to_prometheus())
+
+
+if os.environ.get("ZOOZIT_METRICS_FILE"):
+    atexit.register(lambda: write(os.environ["ZOOZIT_METRICS_FILE"]))
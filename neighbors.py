@@ -0,0 +1,344 @@
+"""
+the neighbor sets of the knn: the stored locations of the rides of a (day_of_week, start_time, next_stop),
+with their times to arrive at the next stop, and the indexes the knn searches them with.
+the neighbor sets and the knn estimators over them are shared by the knn (knn.py) and the compiled grids (eta_grid.py).
+"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+import catalog
+import metrics
+from consts import (
+    BATCH_DISTANCES,
+    BATCH_MATRIX_LOCATIONS,
+    LINE_REFS,
+    NEIGHBOR_SETS_CACHE_SIZE,
+    SPATIAL_INDEX_MIN_LOCATIONS,
+    Latitute,
+    LineRef,
+    LocationId,
+    Longtitude,
+    OperatorRef,
+    SiriRideStopId,
+    SiriStopId,
+)
+from get_data import NoDataError, time_to_seconds
+from location_store import (
+    backfill,
+    get_store_version,
+    get_stored_locations,
+    get_stored_ride_ids,
+)
+from route import PositionIndex, get_route
+from spatial_index import GridIndex
+
+
+@dataclass
+class NeighborSet:
+    """
+    the relevant locations for the knn of a (day_of_week, start_time, next_stop_id),
+    with the arrival times of their stops and a spatial index over them
+    (if they are at least SPATIAL_INDEX_MIN_LOCATIONS, otherwise index is None).
+    """
+
+    locations: pd.DataFrame
+    arrival_dict: Dict[SiriRideStopId, int]
+    index: Optional[GridIndex]
+    # the locations as arrays, for run_knn_vectorized
+    lons: np.ndarray
+    lats: np.ndarray
+    times_to_arrive: np.ndarray
+    # the locations' positions along the route, for run_route_knn
+    position_index: PositionIndex
+
+
+_neighbor_sets: "OrderedDict[tuple, NeighborSet]" = OrderedDict()
+_neighbor_sets_lock = threading.Lock()
+
+
+def neighbor_sets_count() -> int:
+    """
+    returns the number of neighbor sets kept for the following queries (see get_neighbor_set).
+    """
+    with _neighbor_sets_lock:
+        return len(_neighbor_sets)
+
+
+def get_neighbor_set(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    offline=False,
+) -> NeighborSet:
+    """
+    returns the neighbor set of the slot, built once and reused by the following queries
+    of the same slot (until the arrival data, the stored locations or the route of the line change).
+    the last NEIGHBOR_SETS_CACHE_SIZE neighbor sets are kept.
+    safe to call from several threads, a missing set might be built by more than one of them.
+    """
+    route = get_route(line_ref, operator_ref)
+    # the route is reloaded whenever the routes file changes, and the key keeps it alive,
+    # so it is the same object exactly as long as the positions along it are the same
+    key = (
+        route,
+        start_time.strftime("%A"),
+        time_to_seconds(start_time),
+        next_stop_id,
+        line_ref,
+        operator_ref,
+        catalog.dataset_signature(line_ref),
+        get_store_version(line_ref, operator_ref),
+    )
+    with _neighbor_sets_lock:
+        neighbor_set = _neighbor_sets.get(key)
+        if neighbor_set is not None:
+            _neighbor_sets.move_to_end(key)
+            return neighbor_set
+
+    locations, arrival_dict = get_relavent_locations(
+        start_time, next_stop_id, line_ref, operator_ref, offline
+    )
+    lons = locations["lon"].to_numpy(dtype=float)
+    lats = locations["lat"].to_numpy(dtype=float)
+    neighbor_set = NeighborSet(
+        locations=locations,
+        arrival_dict=arrival_dict,
+        index=(
+            GridIndex(lons, lats) if len(lons) >= SPATIAL_INDEX_MIN_LOCATIONS else None
+        ),
+        lons=lons,
+        lats=lats,
+        times_to_arrive=calculate_times_to_arrive(locations, arrival_dict),
+        position_index=PositionIndex(route.location_positions(locations)),
+    )
+    with _neighbor_sets_lock:
+        _neighbor_sets[key] = neighbor_set
+        if len(_neighbor_sets) > NEIGHBOR_SETS_CACHE_SIZE:
+            _neighbor_sets.popitem(last=False)
+    return neighbor_set
+
+
+@metrics.timed("get_relavent_locations")
+def get_relavent_locations(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    line_ref: LineRef,
+    operator_ref: OperatorRef,
+    offline=False,
+) -> pd.DataFrame:
+    """
+    returns all relevant locations for knn in a dataframe.
+    a location is relevant if it is:
+        - in the same time
+        - the same day of week
+        - has the same next_stop_id
+
+    the locations are read from the local location store. the locations of rides that
+    aren't stored yet are fetched from the stride api and stored first
+    (offline, a NoDataError is raised instead, see location_store.py to backfill them).
+    """
+    location_ids, siri_ride_stop_ids, arrival_dict = get_relavent_ids(
+        start_time, next_stop_id, line_ref
+    )
+    if len(location_ids) == 0 or len(siri_ride_stop_ids) == 0:
+        raise NoDataError(
+            "no valid precalculated arrival time found for the given parameters. can't estimate"
+        )
+    missing_ride_ids = set(location_ids) - get_stored_ride_ids(line_ref, operator_ref)
+    if missing_ride_ids and offline:
+        raise NoDataError(
+            f"the locations of {len(missing_ride_ids)} rides aren't stored. can't estimate offline"
+        )
+    if missing_ride_ids:
+        backfill(missing_ride_ids, line_ref, operator_ref, progress=False)
+    locations = get_stored_locations(siri_ride_stop_ids, line_ref, operator_ref)
+    if locations.empty:
+        raise NoDataError("no locations found for the given parameters. can't estimate")
+    return locations, arrival_dict
+
+
+@metrics.timed("get_relavent_ids")
+def get_relavent_ids(
+    start_time: datetime,
+    next_stop_id: SiriStopId,
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+) -> Tuple[List[LocationId], List[SiriRideStopId], Dict[SiriRideStopId, int]]:
+    """
+    returns all relavent Location ids, siri_ride_stop_ids that are relevant for the knn.
+    also returns a dictionary of arrival times (seconds since midnight) for each stop.
+    """
+
+    filtered_data = catalog.get_slot_data(start_time, line_ref, next_stop_id)
+    metrics.count("rows_scanned", len(filtered_data), stage="get_relavent_ids")
+
+    location_ids = list(set(filtered_data["id"].tolist()))
+    siri_ride_stop_ids = filtered_data["siri_ride_stop_id"].tolist()
+    arrival_dict = dict(
+        zip(filtered_data["siri_ride_stop_id"], filtered_data["arrival_time"])
+    )
+
+    return location_ids, siri_ride_stop_ids, arrival_dict
+
+
+def calculate_times_to_arrive(
+    locations: pd.DataFrame, arrival_dict: Dict[SiriRideStopId, int]
+) -> np.ndarray:
+    """
+    calculates the time to arrive (in seconds) of all the locations at once,
+    the same as calculate_time_to_arrive does for a single location.
+    the recorded at times are converted to Israel time in a single vectorized step.
+    """
+    arrival_times = (
+        locations["siri_ride_stop_id"].map(arrival_dict).to_numpy(dtype=float)
+    )
+    recorded_at_times = pd.to_datetime(locations["recorded_at_time"], utc=True)
+    recorded_at_times = recorded_at_times.dt.tz_convert("Israel")
+    recorded_seconds = (
+        recorded_at_times.dt.hour * 3600
+        + recorded_at_times.dt.minute * 60
+        + recorded_at_times.dt.second
+    ).to_numpy(dtype=float)
+    return arrival_times - recorded_seconds
+
+
+def run_route_knn(
+    position_index: PositionIndex,
+    times_to_arrive: np.ndarray,
+    position: float,
+    k: int,
+) -> float:
+    """
+    the same estimation as run_knn_vectorized, with the distance between locations
+    being the distance between their positions along the route.
+
+    the neighbor sets are already of a single slot (day of week and start time) and next stop,
+    so the neighbors are searched by position only, with a bisect of the sorted positions.
+    """
+    nearest, distances = position_index.query(position, k)
+    times = times_to_arrive[nearest]
+
+    exact = distances == 0
+    if exact.any():
+        return times[np.argmax(exact)]
+
+    inverse_distances = 1 / distances
+    return (inverse_distances * times).sum() / inverse_distances.sum()
+
+
+def run_route_knn_batch(
+    position_index: PositionIndex,
+    times_to_arrive: np.ndarray,
+    positions: np.ndarray,
+    k: int,
+) -> np.ndarray:
+    """
+    run_route_knn for many positions over the same neighbor set,
+    returns the estimated seconds to arrive of every position.
+    """
+    nearest, distances = position_index.query_many(positions, k)
+    return weigh_neighbors(times_to_arrive[nearest], distances)
+
+
+def weigh_neighbors(times: np.ndarray, distances: np.ndarray) -> np.ndarray:
+    """
+    the estimation of run_knn_vectorized for every row of (positions x k) arrays
+    of the nearest locations' times to arrive and distances, sorted by distance.
+    """
+    exact = distances == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse_distances = 1 / distances
+        weighted = (inverse_distances * times).sum(axis=1) / inverse_distances.sum(
+            axis=1
+        )
+    return np.where(
+        exact.any(axis=1),
+        times[np.arange(len(times)), np.argmax(exact, axis=1)],
+        weighted,
+    )
+
+
+def run_knn_vectorized(
+    lons: np.ndarray,
+    lats: np.ndarray,
+    times_to_arrive: np.ndarray,
+    lon: Longtitude,
+    lat: Latitute,
+    k: int,
+    index: Optional[GridIndex] = None,
+) -> float:
+    """
+    the same estimation as knn.run_knn, on arrays of the locations' lon, lat and time to arrive
+    (see calculate_times_to_arrive) instead of a dataframe.
+
+    without an index the distances are calculated in one expression,
+    and the k nearest are picked with argpartition instead of a full sort.
+    """
+    if index is None:
+        distances = np.sqrt((lons - lon) ** 2 + (lats - lat) ** 2)
+        k = min(k, len(distances))
+        if k < len(distances):
+            nearest = np.argpartition(distances, k - 1)[:k]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        distances = distances[nearest]
+    else:
+        nearest, distances = index.query(lon, lat, k)
+    times = times_to_arrive[nearest]
+
+    exact = distances == 0
+    if exact.any():
+        return times[np.argmax(exact)]
+
+    inverse_distances = 1 / distances
+    return (inverse_distances * times).sum() / inverse_distances.sum()
+
+
+def run_knn_batch(
+    lons: np.ndarray,
+    lats: np.ndarray,
+    times_to_arrive: np.ndarray,
+    query_lons: np.ndarray,
+    query_lats: np.ndarray,
+    k: int,
+    index: Optional[GridIndex] = None,
+) -> np.ndarray:
+    """
+    run_knn_vectorized for many positions over the same locations,
+    returns the estimated seconds to arrive of every position.
+
+    up to BATCH_MATRIX_LOCATIONS locations, the distances of a chunk of positions to all of the locations
+    are calculated as one matrix, with chunks small enough for the matrix to have at most BATCH_DISTANCES entries.
+    the nearest locations to more positions are searched in the spatial index, all of the positions at once
+    (see GridIndex.query_many), with an index built for the batch if none is given.
+    """
+    if len(lons) > BATCH_MATRIX_LOCATIONS:
+        if index is None:
+            index = GridIndex(lons, lats)
+        nearest, distances = index.query_many(query_lons, query_lats, k)
+        return weigh_neighbors(times_to_arrive[nearest], distances)
+    k = min(k, len(lons))
+    chunk_size = max(1, BATCH_DISTANCES // max(1, len(lons)))
+    estimates = np.empty(len(query_lons))
+    for start in range(0, len(query_lons), chunk_size):
+        end = start + chunk_size
+        # the nearest are picked by squared distance, only their distances are square rooted
+        squared_distances = np.square(lons - query_lons[start:end, np.newaxis])
+        squared_distances += np.square(lats - query_lats[start:end, np.newaxis])
+        if k < len(lons):
+            nearest = np.argpartition(squared_distances, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(len(lons)), squared_distances.shape)
+        distances = np.sqrt(np.take_along_axis(squared_distances, nearest, axis=1))
+        by_distance = np.argsort(distances, axis=1, kind="stable")
+        nearest = np.take_along_axis(nearest, by_distance, axis=1)
+        distances = np.take_along_axis(distances, by_distance, axis=1)
+        estimates[start:end] = weigh_neighbors(times_to_arrive[nearest], distances)
+    return estimates
@@ -0,0 +1,418 @@
+"""
+the routes of the lines: their ordered stops, the stops' codes and coordinates,
+and the geometry of the path through them.
+
+the routes are loaded from a local file (ROUTES_FILE), with a route per (operator_ref, line_ref):
+    {"routes": [{"operator_ref": 15, "line_ref": 29094, "name": "8_to_cinema",
+                 "stops": [{"siri_stop_id": 6752, "code": 26863, "name": "...", "lon": 34.86, "lat": 32.12}, ...]}]}
+
+a position along the route is the distance in meters from the first stop,
+measured along the straight segments between consecutive stops.
+the stops can also have the distance of the stop along the path the buses actually drive
+("distance", in the scale of the distance_from_journey_start of the vehicle locations, see
+location_store.calibrate_stop_distances). then the positions are in that scale:
+a point between two stops is placed between their distances by how far along the segment it is.
+"""
+
+import bisect
+import json
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from consts import (
+    LINE_REFS,
+    ROUTES_FILE,
+    Latitute,
+    LineRef,
+    Longtitude,
+    OperatorRef,
+    SiriStopCode,
+    SiriStopId,
+)
+from get_data import file_signature
+
+EARTH_RADIUS = 6371000  # meters
+
+
+class Route:
+    """
+    the stops of a line in their order, and the path through them.
+
+    the stops' codes and coordinates are kept in arrays in the order of the stops,
+    and stop_index maps a stop to its place in the order.
+
+    lon/lat are converted to meters with an equirectangular projection around the route's
+    mean latitude, which is accurate enough for the few kilometers of a city bus line.
+    """
+
+    def __init__(
+        self,
+        operator_ref: OperatorRef,
+        line_ref: LineRef,
+        name: str,
+        stop_ids: List[SiriStopId],
+        codes: List[SiriStopCode],
+        lons: List[Longtitude],
+        lats: List[Latitute],
+        stop_names: Optional[List[str]] = None,
+        stop_distances: Optional[List[float]] = None,
+    ):
+        self.operator_ref = operator_ref
+        self.line_ref = line_ref
+        self.name = name
+        self.stop_ids = [SiriStopId(int(stop)) for stop in stop_ids]
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.stop_names = (
+            list(stop_names) if stop_names is not None else [""] * len(self.stop_ids)
+        )
+        self.stop_index = {stop: i for i, stop in enumerate(self.stop_ids)}
+        self.code_index = {int(code): i for i, code in enumerate(self.codes)}
+
+        self.meters_per_degree_lat = EARTH_RADIUS * math.pi / 180
+        self.meters_per_degree_lon = self.meters_per_degree_lat * math.cos(
+            math.radians(self.lats.mean() if len(self.lats) else 0)
+        )
+        self.x, self.y = self.to_meters(self.lons, self.lats)
+
+        self.segment_x = np.diff(self.x)
+        self.segment_y = np.diff(self.y)
+        self.segment_lengths = np.hypot(self.segment_x, self.segment_y)
+        self.stop_distances = (
+            np.asarray(stop_distances, dtype=float)
+            if stop_distances is not None
+            else None
+        )
+        if self.stop_distances is not None:
+            if len(self.stop_distances) != len(self.stop_ids):
+                raise ValueError(
+                    f"line {line_ref} has {len(self.stop_ids)} stops "
+                    f"but {len(self.stop_distances)} stop distances"
+                )
+            if (np.diff(self.stop_distances) < 0).any():
+                raise ValueError(f"the stop distances of line {line_ref} decrease")
+            # the position of every stop along the route, and the span of positions of every segment
+            self.stop_positions = self.stop_distances - self.stop_distances[0]
+            self.segment_spans = np.diff(self.stop_positions)
+        else:
+            self.stop_positions = np.concatenate([[0], np.cumsum(self.segment_lengths)])
+            self.segment_spans = self.segment_lengths
+
+    @property
+    def length(self) -> float:
+        return float(self.stop_positions[-1])
+
+    def next_stops(self, stop_id: SiriStopId) -> List[SiriStopId]:
+        """
+        returns the stops after stop_id, in their order.
+        """
+        return self.stop_ids[self.stop_index[stop_id] + 1 :]
+
+    def stop_location(self, stop_id: SiriStopId) -> Tuple[Longtitude, Latitute]:
+        index = self.stop_index[stop_id]
+        return float(self.lons[index]), float(self.lats[index])
+
+    def stop_code(self, stop_id: SiriStopId) -> SiriStopCode:
+        return SiriStopCode(int(self.codes[self.stop_index[stop_id]]))
+
+    def stop_name(self, stop_id: SiriStopId) -> str:
+        return self.stop_names[self.stop_index[stop_id]]
+
+    def to_meters(self, lons, lats) -> Tuple[np.ndarray, np.ndarray]:
+        return (
+            np.asarray(lons, dtype=float) * self.meters_per_degree_lon,
+            np.asarray(lats, dtype=float) * self.meters_per_degree_lat,
+        )
+
+    def project_many(self, lons, lats) -> np.ndarray:
+        """
+        returns the position along the route of every lon, lat:
+        the position of the closest point to it on the route's segments.
+        """
+        return self.project_with_offsets(lons, lats)[0]
+
+    def project_with_offsets(self, lons, lats) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        project_many, and the distance in meters of every lon, lat from the closest point to it on the route.
+        """
+        x, y = self.to_meters(np.atleast_1d(lons), np.atleast_1d(lats))
+        if len(self.segment_lengths) == 0:
+            return np.zeros(len(x)), np.hypot(x - self.x[:1], y - self.y[:1])
+
+        # (point x segment) offsets from the segments' starts
+        dx = x[:, np.newaxis] - self.x[:-1]
+        dy = y[:, np.newaxis] - self.y[:-1]
+        lengths = np.where(self.segment_lengths > 0, self.segment_lengths, 1)
+        along = np.clip((dx * self.segment_x + dy * self.segment_y) / lengths**2, 0, 1)
+        distances = np.hypot(dx - along * self.segment_x, dy - along * self.segment_y)
+        segment = np.argmin(distances, axis=1)
+        points = np.arange(len(x))
+        return (
+            self.stop_positions[segment]
+            + along[points, segment] * self.segment_spans[segment],
+            distances[points, segment],
+        )
+
+    def points_at(self, positions) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the lon, lat of the points at the positions along the route (clipped to its ends),
+        the inverse of project_many for points on the route.
+        """
+        positions = np.clip(
+            np.atleast_1d(np.asarray(positions, dtype=float)), 0, self.length
+        )
+        if len(self.segment_spans) == 0:
+            return np.repeat(self.lons[:1], len(positions)), np.repeat(
+                self.lats[:1], len(positions)
+            )
+        segment = np.clip(
+            np.searchsorted(self.stop_positions, positions, side="right") - 1,
+            0,
+            len(self.segment_spans) - 1,
+        )
+        spans = np.where(self.segment_spans > 0, self.segment_spans, 1)
+        along = (positions - self.stop_positions[segment]) / spans[segment]
+        return (
+            self.lons[segment] + along * np.diff(self.lons)[segment],
+            self.lats[segment] + along * np.diff(self.lats)[segment],
+        )
+
+    def location_positions(self, locations: pd.DataFrame) -> np.ndarray:
+        """
+        returns the position along the route of every vehicle location (with the columns of the stride api).
+        if the stops have measured distances, the distance_from_journey_start of the locations is used
+        (where it is known), instead of projecting their lon, lat onto the segments.
+        """
+        positions = self.project_many(
+            locations["lon"].to_numpy(dtype=float),
+            locations["lat"].to_numpy(dtype=float),
+        )
+        if self.stop_distances is None:
+            return positions
+        distances = (
+            locations["distance_from_journey_start"].to_numpy(dtype=float)
+            - self.stop_distances[0]
+        )
+        return np.where(np.isnan(distances), positions, distances)
+
+    def project(self, lon: Longtitude, lat: Latitute) -> float:
+        return float(self.project_many(lon, lat)[0])
+
+    def stop_position(self, stop_id: SiriStopId) -> float:
+        return float(self.stop_positions[self.stop_index[stop_id]])
+
+    def next_stop(self, position: float) -> SiriStopId:
+        """
+        returns the first stop at or after the position along the route.
+        """
+        index = bisect.bisect_left(self.stop_positions, position)
+        return self.stop_ids[min(index, len(self.stop_ids) - 1)]
+
+
+class PositionIndex:
+    """
+    positions along the route sorted once, to find the nearest ones to a position with a bisect
+    instead of calculating the distance to every one.
+    """
+
+    def __init__(self, positions: np.ndarray):
+        positions = np.asarray(positions, dtype=float)
+        self.order = np.argsort(positions, kind="stable")
+        self.sorted_positions = positions[self.order]
+
+    def query(self, position: float, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the indexes (in the original positions) of the k nearest positions
+        (or all of them if there are fewer) and their distances, sorted by distance.
+        """
+        positions = self.sorted_positions
+        k = min(k, len(positions))
+        right = bisect.bisect_left(positions, position)
+        left = right - 1
+        nearest = []
+        # the k nearest are a window around the bisect point, grown towards the closer side
+        while len(nearest) < k:
+            if right >= len(positions) or (
+                left >= 0 and position - positions[left] <= positions[right] - position
+            ):
+                nearest.append(left)
+                left -= 1
+            else:
+                nearest.append(right)
+                right += 1
+        nearest = np.array(nearest, dtype=int)
+        return self.order[nearest], np.abs(positions[nearest] - position)
+
+    def query_many(self, positions, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        query for many positions at once, returns (positions x k) arrays of the indexes and distances,
+        with the same neighbors in the same order as query.
+
+        the k nearest of a position are among the k sorted positions on each side of its bisect point,
+        so all of the windows are bisected and sorted by distance in one pass. the window is ordered
+        with the left side closest first and then the right side, so a stable sort breaks ties
+        the same way query does.
+        """
+        sorted_positions = self.sorted_positions
+        positions = np.atleast_1d(np.asarray(positions, dtype=float))
+        k = min(k, len(sorted_positions))
+        right = np.searchsorted(sorted_positions, positions, side="left")
+        window = right[:, np.newaxis] + np.concatenate(
+            [np.arange(-1, -k - 1, -1), np.arange(k)]
+        )
+        valid = (window >= 0) & (window < len(sorted_positions))
+        window = np.clip(window, 0, max(0, len(sorted_positions) - 1))
+        distances = np.where(
+            valid,
+            np.abs(sorted_positions[window] - positions[:, np.newaxis]),
+            np.inf,
+        )
+        by_distance = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        nearest = np.take_along_axis(window, by_distance, axis=1)
+        return self.order[nearest], np.take_along_axis(distances, by_distance, axis=1)
+
+
+class RouteRegistry:
+    """
+    the routes of all the lines, by (operator_ref, line_ref) and by line_ref alone
+    (line refs are unique across operators).
+    """
+
+    def __init__(self, routes: List[Route]):
+        self.routes = {(route.operator_ref, route.line_ref): route for route in routes}
+        self.lines = {route.line_ref: route for route in routes}
+
+    def __len__(self) -> int:
+        return len(self.routes)
+
+    def get(
+        self, line_ref: LineRef, operator_ref: Optional[OperatorRef] = None
+    ) -> Route:
+        if operator_ref is None:
+            route = self.lines.get(line_ref)
+        else:
+            route = self.routes.get((operator_ref, line_ref))
+        if route is None:
+            raise ValueError(
+                f"No route found for line {line_ref} of operator {operator_ref}"
+            )
+        return route
+
+    def of_operator(self, operator_ref: OperatorRef) -> List[Route]:
+        return [
+            route
+            for (route_operator, _), route in self.routes.items()
+            if route_operator == operator_ref
+        ]
+
+
+_registries: Dict[str, Tuple[Tuple[int, int], RouteRegistry]] = dict()
+
+
+def load_routes(path: str = ROUTES_FILE) -> RouteRegistry:
+    with open(path, encoding="utf-8") as f:
+        routes = json.load(f)["routes"]
+    return RouteRegistry(
+        [
+            Route(
+                operator_ref=OperatorRef(route["operator_ref"]),
+                line_ref=LineRef(route["line_ref"]),
+                name=route.get("name", str(route["line_ref"])),
+                stop_ids=[stop["siri_stop_id"] for stop in route["stops"]],
+                codes=[stop["code"] for stop in route["stops"]],
+                lons=[stop["lon"] for stop in route["stops"]],
+                lats=[stop["lat"] for stop in route["stops"]],
+                stop_names=[stop.get("name", "") for stop in route["stops"]],
+                stop_distances=(
+                    [stop["distance"] for stop in route["stops"]]
+                    if all("distance" in stop for stop in route["stops"])
+                    else None
+                ),
+            )
+            for route in routes
+        ]
+    )
+
+
+def save_routes(routes: List[Route], path: str = ROUTES_FILE):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "routes": [
+                    {
+                        "operator_ref": int(route.operator_ref),
+                        "line_ref": int(route.line_ref),
+                        "name": route.name,
+                        "stops": [
+                            {
+                                "siri_stop_id": stop,
+                                "code": int(code),
+                                "name": name,
+                                "lon": float(lon),
+                                "lat": float(lat),
+                                **(
+                                    {"distance": float(distance)}
+                                    if distance is not None
+                                    else {}
+                                ),
+                            }
+                            for stop, code, name, lon, lat, distance in zip(
+                                route.stop_ids,
+                                route.codes,
+                                route.stop_names,
+                                route.lons,
+                                route.lats,
+                                (
+                                    route.stop_distances
+                                    if route.stop_distances is not None
+                                    else [None] * len(route.stop_ids)
+                                ),
+                            )
+                        ],
+                    }
+                    for route in routes
+                ]
+            },
+            f,
+            ensure_ascii=False,
+            indent=1,
+        )
+        f.write("\n")
+    os.replace(path + ".tmp", path)
+
+
+def get_registry(path: str = ROUTES_FILE) -> RouteRegistry:
+    """
+    returns the routes of the routes file, loaded once and again only if the file changed.
+    """
+    signature = file_signature(path)
+    loaded = _registries.get(path)
+    if loaded is None or loaded[0] != signature:
+        loaded = (signature, load_routes(path))
+        _registries[path] = loaded
+    return loaded[1]
+
+
+def get_route(
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+    operator_ref: Optional[OperatorRef] = None,
+) -> Route:
+    return get_registry().get(line_ref, operator_ref)
+
+
+def line_ref_of_file(file_path: str) -> LineRef:
+    """
+    returns the line ref in the name of an arrival data file ({start_date}-{end_date},REF{line_ref}).
+    """
+    return LineRef(int(os.path.basename(file_path).split(",REF")[1].split(".")[0]))
+
+
+def get_file_route(file_path: str) -> Route:
+    """
+    returns the route of the line of an arrival data file.
+    """
+    return get_route(line_ref_of_file(file_path))
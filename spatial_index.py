@@ -0,0 +1,224 @@
+import math
+from typing import Tuple
+import numpy as np
+
+from consts import Latitute, Longtitude
+
+# the average number of points in a grid cell
+POINTS_PER_CELL = 4
+# the most rings of cells around a position searched at once by query_many
+QUERY_MANY_MAX_RINGS = 64
+# the most (position, cell) pairs searched at once by query_many
+QUERY_MANY_CELLS = 1000000
+
+
+class GridIndex:
+    """
+    a uniform grid over lon/lat points, to find the nearest points to a position
+    without calculating the distance to every point.
+
+    distances are euclidean in degrees, the same as knn.calculate_distance.
+    the points are sorted by cell, so the points of a cell are a slice of the sorted arrays.
+    """
+
+    def __init__(self, lons: np.ndarray, lats: np.ndarray):
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.min_lon = self.lons.min() if len(self.lons) else 0.0
+        self.min_lat = self.lats.min() if len(self.lats) else 0.0
+        width = (self.lons.max() - self.min_lon) if len(self.lons) else 0.0
+        height = (self.lats.max() - self.min_lat) if len(self.lats) else 0.0
+
+        cells = max(1, len(self.lons) // POINTS_PER_CELL)
+        self.cell_size = max(
+            math.sqrt(width * height / cells), width / cells, height / cells
+        )
+        if self.cell_size == 0:
+            self.cell_size = 1.0
+        self.columns = int(width / self.cell_size) + 1
+        self.rows = int(height / self.cell_size) + 1
+
+        cell_x, cell_y = self._cells(self.lons, self.lats)
+        keys = cell_x * self.rows + cell_y
+        self.order = np.argsort(keys, kind="stable")
+        self.starts = np.searchsorted(
+            keys[self.order], np.arange(self.columns * self.rows + 1)
+        )
+
+    def _cells(self, lons, lats) -> Tuple[np.ndarray, np.ndarray]:
+        cell_x = ((lons - self.min_lon) / self.cell_size).astype(int)
+        cell_y = ((lats - self.min_lat) / self.cell_size).astype(int)
+        return np.clip(cell_x, 0, self.columns - 1), np.clip(cell_y, 0, self.rows - 1)
+
+    def query(
+        self, lon: Longtitude, lat: Latitute, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the positions of the k nearest points (or all of them if there are fewer)
+        and their distances, sorted by distance.
+
+        the rings of cells around the position's cell are searched outwards,
+        until the k-th nearest point found is closer than any point in the next ring can be.
+        """
+        k = min(k, len(self.lons))
+        if k == 0:
+            return np.array([], dtype=int), np.array([], dtype=float)
+
+        x = math.floor((lon - self.min_lon) / self.cell_size)
+        y = math.floor((lat - self.min_lat) / self.cell_size)
+        # rings closer than this don't overlap the grid
+        ring = max(0, -x, x - self.columns + 1, -y, y - self.rows + 1)
+        last_ring = max(x, self.columns - 1 - x, y, self.rows - 1 - y)
+
+        candidates = []
+        found = 0
+        while True:
+            for cell_x, cell_y in self._ring(x, y, ring):
+                key = cell_x * self.rows + cell_y
+                start, end = self.starts[key], self.starts[key + 1]
+                if end > start:
+                    candidates.append(self.order[start:end])
+                    found += end - start
+            if found >= k:
+                positions = np.concatenate(candidates)
+                distances = np.sqrt(
+                    (self.lons[positions] - lon) ** 2
+                    + (self.lats[positions] - lat) ** 2
+                )
+                # any point in the next rings is at least ring cells away
+                kth_distance = np.partition(distances, k - 1)[k - 1]
+                if ring >= last_ring or kth_distance <= ring * self.cell_size:
+                    break
+            ring += 1
+
+        nearest = np.argsort(distances, kind="stable")[:k]
+        return positions[nearest], distances[nearest]
+
+    def query_many(
+        self, lons: np.ndarray, lats: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        query for many positions at once, returns (positions x k) arrays of the positions and distances
+        of the nearest points, the same as query returns for every position.
+
+        the rings of cells around all of the positions are searched in rounds, each round searching
+        twice as many rings as the last one for the positions whose k nearest weren't found yet
+        (see _search_rings). positions that aren't found within QUERY_MANY_MAX_RINGS rings are queried one by one.
+        """
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        k = min(k, len(self.lons))
+        nearest = np.zeros((len(lons), k), dtype=int)
+        distances = np.zeros((len(lons), k))
+        if k == 0:
+            return nearest, distances
+
+        remaining = np.arange(len(lons))
+        rings = 1
+        while len(remaining) > 0 and rings <= QUERY_MANY_MAX_RINGS:
+            not_found = []
+            # in chunks of at most QUERY_MANY_CELLS (position, cell) pairs
+            chunk_size = max(1, QUERY_MANY_CELLS // (2 * rings + 1) ** 2)
+            for start in range(0, len(remaining), chunk_size):
+                chunk = remaining[start : start + chunk_size]
+                found_nearest, found_distances, found = self._search_rings(
+                    lons[chunk], lats[chunk], k, rings
+                )
+                nearest[chunk[found]] = found_nearest[found]
+                distances[chunk[found]] = found_distances[found]
+                not_found.append(chunk[~found])
+            remaining = np.concatenate(not_found)
+            rings *= 2
+        for i in remaining:
+            nearest[i], distances[i] = self.query(lons[i], lats[i], k)
+        return nearest, distances
+
+    def _search_rings(
+        self, lons: np.ndarray, lats: np.ndarray, k: int, rings: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        searches the first rings rings of cells around every position, in the order query searches them.
+        returns the positions and distances of the k nearest points found for every position,
+        and whether they are its k nearest: when no point outside of the rings can be closer
+        than the k-th one, or the rings cover the whole grid.
+        """
+        offsets = np.array(
+            [cell for ring in range(rings + 1) for cell in self._ring_offsets(ring)]
+        )
+        x = np.floor((lons - self.min_lon) / self.cell_size).astype(int)
+        y = np.floor((lats - self.min_lat) / self.cell_size).astype(int)
+        cell_x = x[:, np.newaxis] + offsets[:, 0]
+        cell_y = y[:, np.newaxis] + offsets[:, 1]
+        inside = (
+            (cell_x >= 0)
+            & (cell_x < self.columns)
+            & (cell_y >= 0)
+            & (cell_y < self.rows)
+        )
+        keys = np.where(inside, cell_x * self.rows + cell_y, 0)
+        starts = np.where(inside, self.starts[keys], 0).ravel()
+        counts = np.where(inside, self.starts[keys + 1], 0).ravel() - starts
+
+        # the candidates of every position, in the order of its cells
+        total = counts.sum()
+        if total == 0:
+            return (
+                np.zeros((len(lons), k), dtype=int),
+                np.zeros((len(lons), k)),
+                np.zeros(len(lons), dtype=bool),
+            )
+        candidates = self.order[
+            np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        ]
+        queries = np.repeat(np.repeat(np.arange(len(lons)), len(offsets)), counts)
+        candidate_distances = np.sqrt(
+            (self.lons[candidates] - lons[queries]) ** 2
+            + (self.lats[candidates] - lats[queries]) ** 2
+        )
+        # by position, and by distance within a position, ties in the order of the candidates
+        by_distance = np.lexsort((candidate_distances, queries))
+        found = counts.reshape(len(lons), len(offsets)).sum(axis=1)
+        picked = by_distance[
+            np.clip(
+                (np.cumsum(found) - found)[:, np.newaxis] + np.arange(k),
+                0,
+                max(0, total - 1),
+            )
+        ]
+        nearest = candidates[picked]
+        distances = candidate_distances[picked]
+
+        # any point in the next rings is at least rings cells away
+        last_ring = np.maximum.reduce([x, self.columns - 1 - x, y, self.rows - 1 - y])
+        done = (found >= k) & (
+            (distances[:, -1] <= rings * self.cell_size) | (rings >= last_ring)
+        )
+        return nearest, distances, done
+
+    @staticmethod
+    def _ring_offsets(ring: int):
+        """
+        the offsets of the cells at chebyshev distance ring, in the order _ring yields them.
+        """
+        if ring == 0:
+            return [(0, 0)]
+        return [(dx, dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)] + [
+            (dx, dy) for dy in range(-ring + 1, ring) for dx in (-ring, ring)
+        ]
+
+    def _ring(self, x: int, y: int, ring: int):
+        """
+        yields the cells of the grid at chebyshev distance ring from (x, y).
+        """
+        if ring == 0:
+            if 0 <= x < self.columns and 0 <= y < self.rows:
+                yield x, y
+            return
+        for cell_x in range(max(x - ring, 0), min(x + ring, self.columns - 1) + 1):
+            for cell_y in (y - ring, y + ring):
+                if 0 <= cell_y < self.rows:
+                    yield cell_x, cell_y
+        for cell_y in range(max(y - ring + 1, 0), min(y + ring - 1, self.rows - 1) + 1):
+            for cell_x in (x - ring, x + ring):
+                if 0 <= cell_x < self.columns:
+                    yield cell_x, cell_y
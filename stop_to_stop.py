@@ -1,81 +1,344 @@
+import argparse
 import datetime
+import os
 import time
-from typing import Dict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
 from consts import (
-    SIRI_STOP_ORDER,
-    SIRI_STOPS_TO_CODE,
-    STOP_LOCATIONS,
     LINE_REFS,
     OPERATOR_REFS,
+    LineRef,
     SiriStopId,
 )
-from get_data import get_arrival_data
+from get_data import NoDataError, time_to_seconds
+from route import Route, get_route
+import catalog
+import metrics
 
 
-def generate_time_diffs(start_time: datetime.datetime) -> Dict[SiriStopId, int]:
+@dataclass
+class SegmentTable:
+    """
+    mean stop to stop times for every (day_of_week, start_time) slot of the arrival data of a line
+    (all its partitions, see catalog.py), along the route of the line.
 
-    day_of_week = start_time.strftime("%A")
-    start_hour = start_time.strftime("%H:%M:%S")
-    data = get_arrival_data()
+    segment_times[slot, i] is the mean time from route.stop_ids[i - 1] to route.stop_ids[i],
+    cumulative_times[slot, i] is the mean time from route.stop_ids[0] to route.stop_ids[i].
+    both are NaN where there is no data, and errors[slot] holds the message of a slot
+    that could not be calculated at all.
+    """
 
-    filtered_data = data[
-        (data["start_time"] == start_hour) & (data["day_of_week"] == day_of_week)
-    ]
+    line_ref: LineRef
+    # the catalog.dataset_signature of the arrival data the table was built from
+    source_signature: Tuple
+    route: Route
+    slots: Dict[Tuple[str, int], int]
+    segment_times: np.ndarray
+    cumulative_times: np.ndarray
+    errors: np.ndarray
 
-    rides = filtered_data["id"].unique()
-    all_times = {stop: list() for stop in SIRI_STOP_ORDER}
-    for i in range(1, len(SIRI_STOP_ORDER)):
-        last = SIRI_STOP_ORDER[i - 1]
-        curr = SIRI_STOP_ORDER[i]
-
-        for ride in rides:
-
-            last_entry = filtered_data[
-                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == last)
-            ]
-
-            curr_entry = filtered_data[
-                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == curr)
-            ]
-
-            if len(curr_entry) != 1 or len(last_entry) != 1:
-                if len(curr_entry) == 0 or len(last_entry) == 0:
-                    continue
-                else:
-                    raise ValueError(
-                        f"Expected one entry for a ride, found more then one with ride {ride}, stop: {curr}, or stop: {next}"
-                    )
-            last_time = last_entry["arrival_time"].values[0]
-            curr_time = curr_entry["arrival_time"].values[0]
-            curr_time = datetime.datetime.strptime(curr_time, "%H:%M:%S")
-            last_time = datetime.datetime.strptime(last_time, "%H:%M:%S")
-
-            diff = (curr_time - last_time).total_seconds()
-            all_times[curr].append(diff)
-
-    for stop in SIRI_STOP_ORDER[1:]:
-        if len(all_times[stop]) == 0:
-            raise ValueError(f"No data found for stop {stop} at {start_time.time()}")
-
-    times = {
-        stop: sum(all_times[stop]) / len(all_times[stop])
-        for stop in SIRI_STOP_ORDER[1:]
-    }
+
+# bump whenever the saved layout changes, so old tables get rebuilt
+SEGMENT_TABLE_VERSION = 3
+
+# (directory, line_ref) : segment table
+_segment_tables: Dict[Tuple[str, LineRef], SegmentTable] = dict()
+
+
+def segment_table_path(line_ref: LineRef, directory: str = ".") -> str:
+    return os.path.join(directory, f"REF{line_ref}.segments.npz")
+
+
+@metrics.timed("generate_time_diffs")
+def generate_time_diffs(
+    start_time: datetime.datetime,
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+    directory: str = ".",
+) -> Dict[SiriStopId, float]:
+    """
+    returns the average travel time to each stop of the line from the stop before it,
+    for rides with the same day of week and start time as start_time.
+    the times are read from the precalculated segment table.
+    """
+    stops = get_route(line_ref).stop_ids
+    segment_times = get_slot(start_time, line_ref, directory)[0]
+    missing = np.isnan(segment_times[1:])
+    if missing.any():
+        stop = stops[1:][np.argmax(missing)]
+        raise NoDataError(f"No data found for stop {stop} at {start_time.time()}")
+
+    return {stop: float(diff) for stop, diff in zip(stops[1:], segment_times[1:])}
+
+
+@metrics.timed("time_between_stops")
+def time_between_stops(
+    start_time: datetime.datetime,
+    from_stop: SiriStopId,
+    to_stops: Optional[List[SiriStopId]] = None,
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+    directory: str = ".",
+) -> Dict[SiriStopId, float]:
+    """
+    returns the average travel time from from_stop to each of to_stops
+    (from_stop and all the stops after it by default),
+    for rides of the line with the same day of week and start time as start_time.
+    raises a ValueError if a stop of to_stops comes before from_stop in the route of the line.
+    """
+    route = get_route(line_ref)
+    segment_times, cumulative_times = get_slot(start_time, line_ref, directory)
+    from_index = route.stop_index[from_stop]
+    times = dict()
+    for stop in route.stop_ids[from_index:] if to_stops is None else to_stops:
+        to_index = route.stop_index[stop]
+        if to_index < from_index:
+            raise ValueError(
+                f"Stop {stop} comes before stop {from_stop} in the route of line {route.line_ref}"
+            )
+        travel_time = cumulative_times[to_index] - cumulative_times[from_index]
+        if np.isnan(travel_time):
+            missing = np.isnan(segment_times[from_index + 1 : to_index + 1])
+            missing_stop = route.stop_ids[from_index + 1 + np.argmax(missing)]
+            raise NoDataError(
+                f"No data found for stop {missing_stop} at {start_time.time()}"
+            )
+        times[stop] = float(travel_time)
     return times
 
 
+def get_slot(
+    start_time: datetime.datetime,
+    line_ref: LineRef = LINE_REFS["8_to_cinema"],
+    directory: str = ".",
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    returns the segment times and the cumulative times of the slot start_time belongs to.
+    raises the error the slot was built with, if it has one.
+    """
+    table = get_segment_table(line_ref, directory)
+    key = (start_time.strftime("%A"), time_to_seconds(start_time))
+    slot = table.slots.get(key)
+    if slot is None:
+        raise NoDataError(
+            f"No data found for stop {table.route.stop_ids[1]} at {start_time.time()}"
+        )
+    if table.errors[slot]:
+        raise NoDataError(str(table.errors[slot]))
+    return table.segment_times[slot], table.cumulative_times[slot]
+
+
+def get_segment_table(
+    line_ref: LineRef = LINE_REFS["8_to_cinema"], directory: str = "."
+) -> SegmentTable:
+    """
+    returns the segment table of the line.
+    the table is loaded from disk once, and rebuilt whenever the line's arrival data
+    (a partition of it, see catalog.py) or its route changes.
+    """
+    signature = catalog.dataset_signature(line_ref, directory=directory)
+    route = get_route(line_ref)
+    key = (directory, line_ref)
+    table = _segment_tables.get(key)
+    if table is None or not is_up_to_date(table, signature, route):
+        table = load_segment_table(line_ref, directory)
+        if table is None or not is_up_to_date(table, signature, route):
+            table = build_segment_table(line_ref, directory)
+        _segment_tables[key] = table
+    return table
+
+
+def is_up_to_date(table: SegmentTable, signature: Tuple, route: Route) -> bool:
+    return (
+        table.source_signature == signature and table.route.stop_ids == route.stop_ids
+    )
+
+
+def load_segment_table(
+    line_ref: LineRef, directory: str = "."
+) -> Optional[SegmentTable]:
+    """
+    loads the segment table of the line from disk.
+    returns None if it wasn't built yet, or was built for other stops than the line's route.
+    """
+    table_path = segment_table_path(line_ref, directory)
+    if not os.path.exists(table_path):
+        return None
+    route = get_route(line_ref)
+    with np.load(table_path) as saved:
+        if (
+            saved.get("version") != SEGMENT_TABLE_VERSION
+            or saved["stops"].tolist() != route.stop_ids
+        ):
+            return None
+        return SegmentTable(
+            line_ref=line_ref,
+            source_signature=tuple(
+                (str(path), int(mtime), int(size))
+                for path, mtime, size in zip(
+                    saved["source_paths"], saved["source_mtimes"], saved["source_sizes"]
+                )
+            ),
+            route=route,
+            slots={
+                (str(day), int(hour)): i
+                for i, (day, hour) in enumerate(
+                    zip(saved["days_of_week"], saved["start_times"])
+                )
+            },
+            segment_times=saved["segment_times"],
+            cumulative_times=saved["cumulative_times"],
+            errors=saved["errors"],
+        )
+
+
+def build_segment_table(
+    line_ref: LineRef = LINE_REFS["8_to_cinema"], directory: str = "."
+) -> SegmentTable:
+    """
+    calculates the mean segment times of every (day_of_week, start_time) slot
+    in the arrival data of the line, and saves them next to it.
+    """
+    arrival_data = catalog.load_line_arrival_data(line_ref, directory=directory)
+    signature = arrival_data.signature
+    route = get_route(line_ref)
+    data = arrival_data.data
+    slots = data.groupby(["day_of_week", "start_time"], sort=True, observed=True)
+
+    segment_times = np.full((slots.ngroups, len(route.stop_ids)), np.nan)
+    errors = np.full(slots.ngroups, "", dtype=object)
+    for i, (_, filtered_data) in enumerate(slots):
+        try:
+            segment_times[i] = calculate_segment_times(filtered_data, route)
+        except ValueError as e:
+            errors[i] = str(e)
+    segment_times[:, 0] = 0
+    cumulative_times = np.cumsum(segment_times, axis=1)
+
+    keys = list(slots.groups.keys())
+    days_of_week = np.array([day for day, _ in keys], dtype=str)
+    start_times = np.array([hour for _, hour in keys], dtype=np.int32)
+    errors = errors.astype(str)
+    np.savez_compressed(
+        segment_table_path(line_ref, directory),
+        version=SEGMENT_TABLE_VERSION,
+        source_paths=np.array([path for path, _, _ in signature], dtype=str),
+        source_mtimes=np.array([mtime for _, mtime, _ in signature], dtype=np.int64),
+        source_sizes=np.array([size for _, _, size in signature], dtype=np.int64),
+        stops=np.array(route.stop_ids),
+        days_of_week=days_of_week,
+        start_times=start_times,
+        segment_times=segment_times,
+        cumulative_times=cumulative_times,
+        errors=errors,
+    )
+    return SegmentTable(
+        line_ref=line_ref,
+        source_signature=signature,
+        route=route,
+        slots={(str(day), int(hour)): i for i, (day, hour) in enumerate(keys)},
+        segment_times=segment_times,
+        cumulative_times=cumulative_times,
+        errors=errors,
+    )
+
+
+def calculate_time_diffs(
+    filtered_data: pd.DataFrame, start_time: datetime.datetime, route: Route
+) -> Dict[SiriStopId, float]:
+    """
+    returns the average travel time to each stop of the route from the stop before it,
+    for the rides in filtered_data (all from the same time slot).
+    """
+    stops = route.stop_ids
+    segment_times = calculate_segment_times(filtered_data, route)
+    for stop, diff in zip(stops[1:], segment_times[1:]):
+        if np.isnan(diff):
+            raise NoDataError(f"No data found for stop {stop} at {start_time.time()}")
+
+    times = {stop: float(diff) for stop, diff in zip(stops[1:], segment_times[1:])}
+    return times
+
+
+def calculate_segment_times(filtered_data: pd.DataFrame, route: Route) -> np.ndarray:
+    """
+    returns an array of the average travel time to each stop of the route
+    from the stop before it, NaN for stops without data (and for the first stop).
+
+    the arrivals are pivoted into a (ride x stop) matrix ordered by the route's stops,
+    so all the segment durations are the difference between adjacent columns.
+    """
+    stops = route.stop_ids
+    rides = filtered_data["id"].unique()
+    slot = filtered_data[filtered_data["siri_stop_id"].isin(stops)]
+
+    counts = (
+        slot.groupby(["id", "siri_stop_id"])
+        .size()
+        .unstack()
+        .reindex(index=rides, columns=stops)
+        .fillna(0)
+        .to_numpy()
+    )
+    both_present = (counts[:, :-1] > 0) & (counts[:, 1:] > 0)
+    duplicated = (counts[:, :-1] > 1) | (counts[:, 1:] > 1)
+    ride_indexes, stop_indexes = np.nonzero(both_present & duplicated)
+    if len(ride_indexes) > 0:
+        # report the same ride and stops the per-ride loop used to stop at
+        first = np.lexsort((ride_indexes, stop_indexes))[0]
+        ride = rides[ride_indexes[first]]
+        last = stops[stop_indexes[first]]
+        curr = stops[stop_indexes[first] + 1]
+        raise ValueError(
+            f"Expected one entry for a ride, found more then one with ride {ride}, stop: {curr}, or stop: {last}"
+        )
+
+    arrivals = (
+        slot["arrival_time"]
+        .groupby([slot["id"], slot["siri_stop_id"]])
+        .first()
+        .unstack()
+        .reindex(index=rides, columns=stops)
+        .to_numpy(dtype=float)
+    )
+    diffs = arrivals[:, 1:] - arrivals[:, :-1]
+    found = ~np.isnan(diffs)
+    amounts = found.sum(axis=0)
+    sums = np.where(found, diffs, 0).sum(axis=0)
+
+    segment_times = np.full(len(stops), np.nan)
+    segment_times[1:] = np.divide(
+        sums, amounts, out=np.full(len(sums), np.nan), where=amounts > 0
+    )
+    return segment_times
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="rebuild the segment table of the line",
+    )
+    parser.add_argument("--line", type=int, default=LINE_REFS["8_to_cinema"])
+    args = parser.parse_args()
+
     start = time.time()
 
+    if args.build:
+        table = build_segment_table(args.line)
+        print(f"built {len(table.slots)} slots into {segment_table_path(args.line)}")
+        print("calculation time:", time.time() - start)
+        return
+
     start_time = datetime.datetime.strptime(f"2024-01-01 10:45:00", "%Y-%m-%d %H:%M:%S")
-    time_diffs = generate_time_diffs(start_time)
+    time_diffs = generate_time_diffs(start_time, args.line)
     total = 0
     for stop, diff in time_diffs.items():
         print(f"{stop} :{int(diff)} seconds")
         total += int(diff)
-    print(
-        f"Total time from {SIRI_STOP_ORDER[0]} to {SIRI_STOP_ORDER[-1]}: {int(total)} seconds"
-    )
+    stops = get_route(args.line).stop_ids
+    print(f"Total time from {stops[0]} to {stops[-1]}: {int(total)} seconds")
 
     print("calculation time:", time.time() - start)
     return
@@ -0,0 +1,171 @@
+"""
+the transports api_functions sends its stride requests through:
+    StrideTransport - the stride api itself
+    RecordingTransport - the stride api, saving every response to a recording file
+    ReplayTransport - the responses of a recording file, without the network
+
+the transport is chosen with environment variables, e.g. to record a run and replay it offline:
+    STRIDE_TRANSPORT=record python average_arrival_time.py
+    STRIDE_TRANSPORT=replay STRIDE_REPLAY_LATENCY=0.05 python average_arrival_time.py
+
+STRIDE_RECORDING sets the recording file (STRIDE_RECORDING_FILE by default),
+and STRIDE_REPLAY_LATENCY the seconds every replayed request waits, to simulate the api.
+"""
+
+import argparse
+import atexit
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import urllib.parse
+from typing import Dict, Optional
+import stride
+from stride.common import parse_params, parse_res
+
+from consts import STRIDE_RECORDING_FILE
+
+# bump whenever the recording layout changes
+RECORDING_VERSION = 1
+
+
+class MissingRecording(Exception):
+    pass
+
+
+class StrideTransport:
+    def __init__(self, pre_requests_callback=None):
+        self.pre_requests_callback = pre_requests_callback
+
+    def get(self, path: str, params: Dict):
+        return stride.get(
+            path, dict(params), pre_requests_callback=self.pre_requests_callback
+        )
+
+
+class RecordingTransport:
+    """
+    sends the requests to another transport (the stride api by default),
+    and keeps the responses, which are saved to the recording file on exit (or with save).
+    a recording that already exists is added to.
+    """
+
+    def __init__(
+        self,
+        path: str = STRIDE_RECORDING_FILE,
+        transport: Optional[StrideTransport] = None,
+    ):
+        self.path = path
+        self.transport = transport if transport is not None else StrideTransport()
+        self.responses = load_recording(path) if os.path.exists(path) else dict()
+        self.lock = threading.Lock()
+        atexit.register(self.save)
+
+    def get(self, path: str, params: Dict):
+        response = self.transport.get(path, params)
+        key = request_key(path, params)
+        with self.lock:
+            self.responses[key] = encode(response)
+        return response
+
+    def save(self):
+        with self.lock:
+            save_recording(self.responses, self.path)
+
+
+class ReplayTransport:
+    """
+    answers the requests from a recording file, every request waiting latency seconds.
+    a request that wasn't recorded raises MissingRecording.
+    """
+
+    def __init__(self, path: str = STRIDE_RECORDING_FILE, latency: float = 0):
+        self.path = path
+        self.latency = latency
+        self.responses = load_recording(path)
+
+    def get(self, path: str, params: Dict):
+        if self.latency:
+            time.sleep(self.latency)
+        key = request_key(path, params)
+        if key not in self.responses:
+            raise MissingRecording(f"no recorded response to {key} in {self.path}")
+        # every request gets its own copy, parsed the same way stride.get parses a response
+        return parse_res(json.loads(self.responses[key]))
+
+
+def request_key(path: str, params: Dict) -> str:
+    """
+    returns the request's url path and query, with the params sorted and formatted the way stride sends them.
+    """
+    params = parse_params(dict(params))
+    return f"{path}?{urllib.parse.urlencode(sorted((k, str(v)) for k, v in params.items()))}"
+
+
+def encode(response) -> str:
+    """
+    returns the response as json, with the datetimes stride.get parsed back in the api's format.
+    """
+
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        raise TypeError(f"can't record a {type(value)}")
+
+    return json.dumps(response, default=default, separators=(",", ":"))
+
+
+def load_recording(path: str) -> Dict[str, str]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        recording = json.load(f)
+    if recording.get("version") != RECORDING_VERSION:
+        raise ValueError(f"{path} isn't a recording of version {RECORDING_VERSION}")
+    return recording["responses"]
+
+
+def save_recording(responses: Dict[str, str], path: str):
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        json.dump({"version": RECORDING_VERSION, "responses": responses}, f)
+    os.replace(path + ".tmp", path)
+
+
+def from_environment(pre_requests_callback=None):
+    """
+    returns the transport set by the STRIDE_TRANSPORT environment variable
+    ("record", "replay", or the stride api if it isn't set).
+    """
+    mode = os.environ.get("STRIDE_TRANSPORT", "")
+    path = os.environ.get("STRIDE_RECORDING", STRIDE_RECORDING_FILE)
+    if mode == "record":
+        return RecordingTransport(path, StrideTransport(pre_requests_callback))
+    if mode == "replay":
+        return ReplayTransport(path, float(os.environ.get("STRIDE_REPLAY_LATENCY", 0)))
+    if mode:
+        raise ValueError(f"unknown STRIDE_TRANSPORT: {mode}")
+    return StrideTransport(pre_requests_callback)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("recording", nargs="?", default=STRIDE_RECORDING_FILE)
+    args = parser.parse_args()
+
+    responses = load_recording(args.recording)
+    paths = dict()
+    for key in responses:
+        path = key.split("?")[0]
+        paths[path] = paths.get(path, 0) + 1
+    print(
+        f"{args.recording}: {len(responses)} responses, "
+        f"{os.path.getsize(args.recording) / 1e6:.2f}MB"
+    )
+    for path, count in sorted(paths.items()):
+        print(f"{path}: {count}")
+
+
+if __name__ == "__main__":
+    main()
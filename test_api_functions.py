@@ -0,0 +1,81 @@
+import datetime
+from typing import Dict, List
+import pytest
+from dateutil import tz
+
+import api_functions
+
+
+class ListTransport:
+    """
+    answers every list request with a page of records, and keeps the params of the requests.
+    """
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        self.requests = []
+
+    def get(self, path: str, params: Dict):
+        self.requests.append(dict(params))
+        offset, limit = params["offset"], params["limit"]
+        return self.records[offset : offset + limit]
+
+
+@pytest.mark.parametrize(
+    "records, page_sizes, requests",
+    [
+        (25, [10, 10, 5], 3),
+        # a last full page is followed by a request for an empty one, that isn't yielded
+        (20, [10, 10], 3),
+        (0, [], 1),
+    ],
+)
+def test_iterate_pages(monkeypatch, records, page_sizes, requests):
+    transport = ListTransport([{"id": i} for i in range(records)])
+    monkeypatch.setattr(api_functions, "transport", transport)
+    monkeypatch.setattr(api_functions, "rate_limiter", None)
+
+    pages = list(
+        api_functions.iterate_pages("/list", {"order_by": "id asc"}, page_size=10)
+    )
+    assert [len(page) for page in pages] == page_sizes
+    assert [record["id"] for page in pages for record in page] == list(range(records))
+    assert transport.requests == [
+        {"order_by": "id asc", "limit": 10, "offset": offset}
+        for offset in range(0, 10 * requests, 10)
+    ]
+
+
+def test_iterate_list_of_the_api(fake_api):
+    israel = tz.gettz("Israel")
+    params = {
+        "scheduled_start_time_from": datetime.datetime(2025, 1, 20, tzinfo=israel),
+        "scheduled_start_time_to": datetime.datetime(2025, 1, 23, tzinfo=israel),
+        "order_by": "scheduled_start_time asc,id asc",
+    }
+    rides = api_functions.stride_get("/siri_rides/list", {**params, "limit": 100000})
+    assert len(rides) > 7
+    assert list(api_functions.iterate_list("/siri_rides/list", params, 7)) == rides
+
+
+def test_locations_of_rides_are_paged(fake_api):
+    israel = tz.gettz("Israel")
+    rides = api_functions.stride_get(
+        "/siri_rides/list",
+        {
+            "scheduled_start_time_from": datetime.datetime(2025, 1, 22, tzinfo=israel),
+            "scheduled_start_time_to": datetime.datetime(2025, 1, 23, tzinfo=israel),
+            "limit": 3,
+        },
+    )
+    ride_ids = [ride["id"] for ride in rides]
+    locations = api_functions.stride_get(
+        "/siri_vehicle_locations/list",
+        {
+            "siri_rides__ids": api_functions.comma_separated_string(ride_ids),
+            "order_by": "recorded_at_time desc,id desc",
+            "limit": 1000000,
+        },
+    )
+    assert len(locations) > 30
+    assert api_functions.get_locations_by_ride_id(ride_ids, page_size=30) == locations
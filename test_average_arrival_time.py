@@ -0,0 +1,242 @@
+import datetime
+import json
+import os
+import threading
+import types
+from collections import OrderedDict
+import pandas as pd
+import pytest
+from dateutil import tz
+
+import api_functions
+import average_arrival_time
+import lookup_cache
+from average_arrival_time import (
+    generate_rides_data,
+    get_covered_days,
+    get_relevant_siri_ride_ids,
+    get_relevant_siri_ride_ids_by_day,
+    manifest_path,
+    refresh_data,
+)
+from conftest import FAKE_API_FILE, PROJECT_DIRECTORY
+from stride_transport import StrideTransport
+
+
+class PathsTransport(StrideTransport):
+    """
+    the stride api, keeping the path of every request.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.paths = []
+
+    def get(self, path, params):
+        self.paths.append(path)
+        return super().get(path, params)
+
+
+def test_ride_discovery(fake_api, monkeypatch):
+    transport = PathsTransport()
+    monkeypatch.setattr(api_functions, "transport", transport)
+    israel = tz.gettz("Israel")
+    start_time = datetime.datetime(2025, 1, 10, tzinfo=israel)
+    end_time = datetime.datetime(2025, 1, 20, tzinfo=israel)
+
+    days = get_relevant_siri_ride_ids_by_day(start_time, end_time, 29094, 15, 8, 9)
+
+    # the rides of the days that start between the hours, as in the data the fake api serves
+    data = pd.read_csv(os.path.join(PROJECT_DIRECTORY, FAKE_API_FILE))
+    data["date"] = pd.to_datetime(data["date"]).dt.date
+    data = data[
+        (data["date"] >= start_time.date())
+        & (data["date"] <= end_time.date())
+        & (data["start_time"] >= "08:00:00")
+        & (data["start_time"] <= "09:00:00")
+    ].drop_duplicates("id")
+    expected = {day: set(rides["id"].tolist()) for day, rides in data.groupby("date")}
+    assert len(expected) > 1
+    assert days == expected
+    # naive times are of Israel
+    assert (
+        get_relevant_siri_ride_ids_by_day(
+            start_time.replace(tzinfo=None),
+            end_time.replace(tzinfo=None),
+            29094,
+            15,
+            8,
+            9,
+        )
+        == expected
+    )
+    # only the rides are listed, without their vehicle locations
+    assert set(transport.paths) == {"/siri_rides/list"}
+
+    ride_ids = get_relevant_siri_ride_ids(start_time, end_time, 29094, 15, 8, 9)
+    assert ride_ids == set().union(*expected.values())
+    # the start times are cached on the way
+    ride_id = next(iter(ride_ids))
+    assert (
+        api_functions.get_start_time_for_ride_id.cached(ride_id)
+        is not lookup_cache.MISSING
+    )
+
+
+class FailuresTransport(StrideTransport):
+    """
+    the stride api, counting the requests that failed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, params):
+        try:
+            return super().get(path, params)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            raise
+
+
+def test_concurrent_generation_matches_sequential(flaky_api, workspace, monkeypatch):
+    transport = FailuresTransport()
+    monkeypatch.setattr(api_functions, "transport", transport)
+    israel = tz.gettz("Israel")
+    ride_ids = get_relevant_siri_ride_ids(
+        datetime.datetime(2025, 1, 21, tzinfo=israel),
+        datetime.datetime(2025, 1, 22, tzinfo=israel),
+        29094,
+        15,
+    )
+    assert len(ride_ids) > 10
+
+    paths = dict()
+    for workers in [1, 4]:
+        # every run starts with an empty lookup cache, so it fetches everything
+        monkeypatch.setattr(
+            lookup_cache, "LOOKUP_CACHE_FILE", str(workspace / f"lookups{workers}")
+        )
+        monkeypatch.setattr(lookup_cache, "_connection", None)
+        monkeypatch.setattr(lookup_cache, "_memory", OrderedDict())
+        paths[workers] = str(workspace / f"workers{workers}.csv")
+        generate_rides_data(ride_ids, paths[workers], workers, rides_per_request=3)
+
+    # the injected errors were retried
+    assert transport.failures > 0
+    with open(paths[1]) as sequential, open(paths[4]) as concurrent:
+        assert sequential.read() == concurrent.read()
+    data = pd.read_csv(paths[4])
+    assert set(data["id"]) == ride_ids
+    # in the order of the ride ids
+    assert data["id"].is_monotonic_increasing
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_refills_tokens(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(api_functions, "time", clock)
+    limiter = api_functions.RateLimiter(rate=10, burst=3)
+
+    # a burst without waiting, then a token every 1 / rate seconds
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+    # the tokens refill up to the burst, however long it waited
+    clock.now += 60
+    for _ in range(3):
+        limiter.acquire()
+    assert len(clock.sleeps) == 1
+    limiter.acquire()
+    assert len(clock.sleeps) == 2
+    assert clock.now == pytest.approx(60.2)
+
+
+def test_refresh_fetches_only_missing_past_days(fake_api, workspace, monkeypatch):
+    israel = tz.gettz("Israel")
+
+    class Today(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime(2025, 1, 22, 12, tzinfo=israel)
+
+    # refresh_data asks the module's datetime what day it is
+    monkeypatch.setattr(
+        average_arrival_time,
+        "datetime",
+        types.SimpleNamespace(
+            date=datetime.date,
+            time=datetime.time,
+            timedelta=datetime.timedelta,
+            datetime=Today,
+        ),
+    )
+    day = datetime.date.fromisoformat
+    # covered by the manifest, and by a file of the line
+    average_arrival_time.save_covered_days(29094, {day("2025-01-17")}, str(workspace))
+    data = pd.read_csv(os.path.join(PROJECT_DIRECTORY, FAKE_API_FILE))
+    data[data["date"] == "2025-01-20"].to_csv(
+        workspace / "2025-01-20-2025-01-20,REF29094.csv", index=False
+    )
+
+    new_files = refresh_data(
+        datetime.datetime(2025, 1, 16, tzinfo=israel),
+        datetime.datetime(2025, 1, 24, tzinfo=israel),
+        29094,
+        15,
+        str(workspace),
+        workers=2,
+    )
+
+    # the 18th is a saturday, without rides. the 22nd is today, and the rest are yet to come
+    assert [os.path.basename(path) for path in new_files] == [
+        "2025-01-16-2025-01-16,REF29094.csv",
+        "2025-01-19-2025-01-19,REF29094.csv",
+        "2025-01-21-2025-01-21,REF29094.csv",
+    ]
+    for path in new_files:
+        fetched = pd.read_csv(path)
+        expected = data[data["date"] == os.path.basename(path)[:10]]
+        assert set(fetched["id"]) == set(expected["id"])
+    with open(manifest_path(29094, str(workspace))) as f:
+        assert json.load(f)["covered_days"] == [
+            "2025-01-16",
+            "2025-01-17",
+            "2025-01-19",
+            "2025-01-20",
+            "2025-01-21",
+        ]
+
+    # the next refresh only looks for the rides of the day without them
+    transport = PathsTransport()
+    monkeypatch.setattr(api_functions, "transport", transport)
+    assert (
+        refresh_data(
+            datetime.datetime(2025, 1, 16, tzinfo=israel),
+            datetime.datetime(2025, 1, 21, tzinfo=israel),
+            29094,
+            15,
+            str(workspace),
+        )
+        == []
+    )
+    assert set(transport.paths) == {"/siri_rides/list"}
+    assert day("2025-01-18") not in get_covered_days(29094, str(workspace))
@@ -0,0 +1,53 @@
+import datetime
+import pandas as pd
+
+from catalog import get_line_arrival_data, iterate_arrival_data
+from conftest import FAKE_API_FILE, copy_arrival_data
+
+
+def write_partition(data: pd.DataFrame, directory, start: str, end: str) -> str:
+    path = str(directory / f"{start}-{end},REF29094.csv")
+    data[(data["date"] >= start) & (data["date"] <= end)].to_csv(path, index=False)
+    return path
+
+
+def test_overlapping_partitions_yield_every_ride_once(workspace):
+    month = pd.read_csv(copy_arrival_data(workspace, FAKE_API_FILE))
+    (workspace / FAKE_API_FILE).unlink()
+    write_partition(month, workspace, "2025-01-01", "2025-01-20")
+    # the rides of the overlap have other arrival times in the larger partition, which is read first
+    later = month.copy()
+    later["arrival_time"] = "23:59:59"
+    write_partition(later, workspace, "2025-01-10", "2025-01-31")
+    # covered by the others, so it isn't read
+    write_partition(later, workspace, "2025-01-12", "2025-01-15")
+
+    parts = list(
+        iterate_arrival_data(
+            29094,
+            datetime.date(2025, 1, 1),
+            datetime.date(2025, 1, 31),
+            str(workspace),
+        )
+    )
+    assert len(parts) == 2
+    data = pd.concat(parts, ignore_index=True)
+    assert len(data) == len(month)
+    assert set(data["id"]) == set(month["id"])
+    # a ride comes whole from a single partition
+    for part in parts[1:]:
+        assert not set(part["id"]) & set(parts[0]["id"])
+    dates = data["date"].dt.strftime("%Y-%m-%d")
+    # read as seconds since midnight
+    assert ((data["arrival_time"] == 86399) == (dates >= "2025-01-10")).all()
+
+    # a range inside the partitions only yields its days
+    data = get_line_arrival_data(
+        29094,
+        datetime.date(2025, 1, 18),
+        datetime.date(2025, 1, 22),
+        str(workspace),
+    )
+    expected = month[(month["date"] >= "2025-01-18") & (month["date"] <= "2025-01-22")]
+    assert len(data) == len(expected)
+    assert set(data["id"]) == set(expected["id"])
@@ -0,0 +1,90 @@
+import datetime
+import numpy as np
+import pytest
+
+import eta_grid
+import knn
+from conftest import METERS_PER_DEGREE
+from consts import ETA_GRID_MAX_ERROR, ETA_GRID_MAX_OFFSET
+from eta_grid import compile_grid
+from neighbors import run_knn_batch, run_route_knn_batch
+
+
+def exact_knn(neighbor_set, route, positions, metric):
+    if metric == "route":
+        return run_route_knn_batch(
+            neighbor_set.position_index, neighbor_set.times_to_arrive, positions, 5
+        )
+    lons, lats = route.points_at(positions)
+    return run_knn_batch(
+        neighbor_set.lons,
+        neighbor_set.lats,
+        neighbor_set.times_to_arrive,
+        lons,
+        lats,
+        5,
+    )
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "route"])
+def test_grid_matches_exact_knn(neighbor_set, route, metric):
+    grid = compile_grid(neighbor_set, route, k=5, spacing=5, metric=metric)
+    positions = np.random.default_rng(1).uniform(
+        grid.start_position, grid.end_position, 5000
+    )
+    errors = np.abs(
+        grid.lookup_many(positions, np.inf)
+        - exact_knn(neighbor_set, route, positions, metric)
+    )
+    # within the error the grid reports
+    assert grid.max_error > 0
+    assert errors.max() <= grid.max_error
+
+    # the positions it serves are within ETA_GRID_MAX_ERROR, the rest fall back to the exact knn
+    served = ~np.isnan(grid.lookup_many(positions))
+    assert served.mean() > 0.5
+    assert errors[served].max() <= ETA_GRID_MAX_ERROR
+    position = positions[served][0]
+    assert grid.lookup(position) == pytest.approx(grid.lookup_many([position])[0])
+    # outside of the grid
+    assert grid.lookup(grid.end_position + 1) is None
+
+
+def test_next_stop_eta_reads_the_grid(neighbor_set, route, monkeypatch):
+    grid = compile_grid(neighbor_set, route, k=5, spacing=5, metric="euclidean")
+    monkeypatch.setattr(knn, "get_route", lambda line_ref, operator_ref: route)
+    monkeypatch.setattr(
+        eta_grid,
+        "get_eta_grid",
+        lambda start_time, next_stop_id, k, metric, *args: (
+            grid if metric == "euclidean" else None
+        ),
+    )
+    neighbor_sets_built = []
+
+    def get_neighbor_set(*args):
+        neighbor_sets_built.append(args)
+        return neighbor_set
+
+    monkeypatch.setattr(knn, "get_neighbor_set", get_neighbor_set)
+
+    start_time = datetime.datetime(2025, 1, 22, 7)
+    served = np.flatnonzero(grid.errors <= ETA_GRID_MAX_ERROR)[len(grid.errors) // 2]
+    lon, _ = route.points_at(grid.start_position + (served + 0.5) * grid.spacing)
+    lat = (ETA_GRID_MAX_OFFSET / 2) / METERS_PER_DEGREE
+
+    def eta(lon, lat, **kwargs):
+        return knn.next_stop_eta(
+            start_time, lon[0], lat, start_time, 30, 1, 15, k=5, **kwargs
+        )
+
+    # the default metric is read from the grid, without the neighbor set
+    from_grid = eta(lon, lat)
+    assert neighbor_sets_built == []
+    exact = eta(lon, lat, exact=True)
+    assert len(neighbor_sets_built) == 1
+    assert from_grid == pytest.approx(exact, abs=ETA_GRID_MAX_ERROR)
+
+    # too far from the route for the grid
+    eta(lon, lat * 3)
+    assert len(neighbor_sets_built) == 2
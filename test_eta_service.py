@@ -0,0 +1,109 @@
+import asyncio
+import json
+import pytest
+
+import eta_service
+import knn
+from eta_service import EtaService
+from get_data import NoDataError
+
+VEHICLE = {
+    "recorded_at_time": "2025-01-22T07:20:00",
+    "lon": 34.846114,
+    "lat": 32.134802,
+    "start_time": "2025-01-22T07:15:00",
+    "next_stop_id": 2391,
+}
+
+
+async def send(port: int, requests):
+    """
+    sends the (method, path, body) requests over one connection to the service,
+    returns the (status, headers, body) responses it got before the connection closed.
+    """
+    reader, writer = await asyncio.open_connection("localhost", port)
+    for method, path, body in requests:
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+    await writer.drain()
+    responses = []
+    while True:
+        status_line = await reader.readline()
+        if not status_line:
+            break
+        headers = await eta_service.read_headers(reader)
+        data = await reader.readexactly(int(headers["content-length"]))
+        responses.append((int(status_line.split()[1]), headers, json.loads(data)))
+        if len(responses) == len(requests):
+            break
+    writer.close()
+    return responses
+
+
+def serve_requests(requests):
+    async def run():
+        server = await asyncio.start_server(
+            EtaService(workers=2).handle, "localhost", 0
+        )
+        async with server:
+            return await send(server.sockets[0].getsockname()[1], requests)
+
+    return asyncio.run(run())
+
+
+def eta(query) -> tuple:
+    return "POST", "/eta", json.dumps(query).encode()
+
+
+@pytest.mark.parametrize(
+    "query, status",
+    [
+        (VEHICLE, 200),
+        ({**VEHICLE, "k": 0}, 400),
+        # true isn't a positive integer, although python counts bools as ints
+        ({**VEHICLE, "k": True}, 400),
+        ({**VEHICLE, "line_ref": True}, 400),
+        ({**VEHICLE, "metric": "manhattan"}, 400),
+        ({**VEHICLE, "next_stop_id": 1}, 400),
+        ({key: VEHICLE[key] for key in ["lon", "lat"]}, 400),
+        ([VEHICLE], 400),
+    ],
+)
+def test_query_validation(workspace, monkeypatch, query, status):
+    monkeypatch.setattr(knn, "next_stops_eta", lambda *args, **kwargs: {2391: 60})
+    [(got, _, response)] = serve_requests([eta(query)])
+    assert got == status, response
+
+
+@pytest.mark.parametrize(
+    "error, status", [(NoDataError("no rides"), 422), (RuntimeError("bug"), 500)]
+)
+def test_estimation_errors(workspace, monkeypatch, error, status):
+    def next_stops_eta(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(knn, "next_stops_eta", next_stops_eta)
+    [(got, _, response)] = serve_requests([eta(VEHICLE)])
+    assert got == status
+    assert str(error) in response["message"]
+
+
+def test_keep_alive_and_errors_of_the_connection(workspace, monkeypatch):
+    monkeypatch.setattr(knn, "next_stops_eta", lambda *args, **kwargs: {2391: 60})
+    responses = serve_requests(
+        [("POST", "/eta", b"{not json"), eta(VEHICLE), ("GET", "/nowhere", b"")]
+    )
+    # the connection is kept alive after errors of the request
+    assert [status for status, _, _ in responses] == [400, 200, 404]
+
+
+def test_too_large_body_closes_the_connection(workspace, monkeypatch):
+    monkeypatch.setattr(eta_service, "MAX_BODY_SIZE", 10)
+    # the body isn't read, so the next request can't be told apart from it
+    responses = serve_requests([eta(VEHICLE), eta(VEHICLE)])
+    assert len(responses) == 1
+    status, headers, _ = responses[0]
+    assert status == 413
+    assert headers["connection"] == "close"
@@ -0,0 +1,75 @@
+import os
+import pandas as pd
+import pytest
+
+from conftest import PROJECT_DIRECTORY
+from get_data import (
+    ARRIVAL_DATA_DTYPES,
+    ARRIVAL_DATA_FILE,
+    ArrivalDataWriter,
+    convert_to_columnar,
+    read_arrival_data,
+    write_columnar,
+)
+
+
+def read(path: str) -> pd.DataFrame:
+    # a copy, since the columns of a columnar dataset are memory-mapped arrays
+    return read_arrival_data(path).copy()
+
+
+@pytest.fixture
+def raw_data() -> pd.DataFrame:
+    """
+    the first rows of the bundled arrival data, as written by generate_data.
+    """
+    return pd.read_csv(
+        os.path.join(PROJECT_DIRECTORY, ARRIVAL_DATA_FILE),
+        dtype=ARRIVAL_DATA_DTYPES,
+        nrows=1000,
+    )
+
+
+def test_columnar_round_trip(raw_data, tmp_path):
+    csv_path = str(tmp_path / "2025-01-01-2025-04-30,REF29094.csv")
+    raw_data.to_csv(csv_path, index=False)
+    expected = read_arrival_data(csv_path)
+
+    columnar_path = convert_to_columnar(csv_path)
+    assert columnar_path.endswith(".columns")
+    pd.testing.assert_frame_equal(read(columnar_path), expected)
+
+    # writing again replaces the dataset
+    write_columnar(expected.iloc[:10], columnar_path)
+    pd.testing.assert_frame_equal(read(columnar_path), expected.iloc[:10])
+    assert not os.path.exists(columnar_path + ".tmp")
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".columns"])
+def test_writer_round_trip(raw_data, tmp_path, suffix):
+    csv_path = str(tmp_path / "expected.csv")
+    raw_data.to_csv(csv_path, index=False)
+    path = str(tmp_path / f"written{suffix}")
+
+    # a chunk size that doesn't divide the rows, so the last chunk is partial
+    with ArrivalDataWriter(path, chunk_size=300) as writer:
+        for row in raw_data.to_dict("records"):
+            writer.append(**row)
+        assert not os.path.exists(path)
+
+    pd.testing.assert_frame_equal(read(path), read(csv_path))
+    if suffix == ".csv":
+        # written exactly as write_arrival_data writes all the rows at once
+        with open(path) as written, open(csv_path) as expected:
+            assert written.read() == expected.read()
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".columns"])
+def test_writer_leaves_no_file_on_error(raw_data, tmp_path, suffix):
+    path = str(tmp_path / f"written{suffix}")
+    with pytest.raises(RuntimeError):
+        with ArrivalDataWriter(path, chunk_size=300) as writer:
+            for row in raw_data.to_dict("records"):
+                writer.append(**row)
+            raise RuntimeError("generating the data failed")
+    assert os.listdir(tmp_path) == []
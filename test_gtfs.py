@@ -0,0 +1,113 @@
+import zipfile
+import numpy as np
+import pytest
+
+import api_functions
+import gtfs
+from gtfs import build_gtfs_tables, get_gtfs_tables, gtfs_route, import_routes
+from route import get_registry
+
+FEED = {
+    "stops.txt": [
+        "stop_id,stop_code,stop_name,stop_lat,stop_lon",
+        "1,101,first,32.100,34.800",
+        "2,102,second,32.101,34.801",
+        "3,103,third,32.102,34.802",
+        "4,104,detour,32.103,34.803",
+        # a station, without a code
+        "5,,station,32.104,34.804",
+    ],
+    "routes.txt": [
+        "route_id,agency_id,route_short_name",
+        "500,15,8",
+        "600,3,9",
+    ],
+    "trips.txt": [
+        "route_id,service_id,trip_id,shape_id",
+        # the detour is listed first, but most of the trips drive shape a
+        "500,1,detour,b",
+        "500,1,a1,a",
+        "500,1,a2,a",
+        "600,1,other,c",
+    ],
+    "stop_times.txt": [
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence",
+        "detour,07:00:00,07:00:00,1,1",
+        "detour,07:05:00,07:05:00,4,2",
+        # out of order, and with the station
+        "a1,07:10:00,07:10:00,3,4",
+        "a1,07:00:00,07:00:00,1,1",
+        "a1,07:05:00,07:05:00,5,2",
+        "a1,07:07:00,07:07:00,2,3",
+        "a2,08:00:00,08:00:00,1,1",
+        "a2,08:05:00,08:05:00,2,2",
+        "a2,08:10:00,08:10:00,3,3",
+        "other,07:00:00,07:00:00,3,1",
+        "other,07:05:00,07:05:00,1,2",
+    ],
+}
+
+
+@pytest.fixture
+def feed(workspace) -> str:
+    path = str(workspace / "feed.zip")
+    with zipfile.ZipFile(path, "w") as f:
+        for name, lines in FEED.items():
+            # with a byte order mark, like the feed of the MOT
+            f.writestr(name, "\ufeff" + "\n".join(lines) + "\n")
+    gtfs._gtfs_tables.clear()
+    yield path
+    gtfs._gtfs_tables.clear()
+
+
+def test_build_gtfs_tables(feed):
+    tables = build_gtfs_tables(feed)
+    assert tables.stop_codes.tolist() == [101, 102, 103, 104]
+    assert tables.stop_location(102) == (34.801, 32.101)
+    assert tables.stop_name(104) == "detour"
+    assert tables.route_operator(500) == 15
+    assert tables.route_name(600) == "9"
+    # the stops of a trip of the most common shape, in their sequence, without the station
+    assert tables.route_stops(500) == [101, 102, 103]
+    assert tables.route_stops(600) == [103, 101]
+
+    # the saved tables are loaded instead of streaming the zip again
+    gtfs._gtfs_tables.clear()
+    loaded = get_gtfs_tables(feed)
+    assert loaded is not tables
+    assert loaded.route_stops(500) == [101, 102, 103]
+    assert np.array_equal(loaded.stop_names, tables.stop_names)
+
+
+def test_gtfs_route_without_siri_stop_ids(feed):
+    tables = get_gtfs_tables(feed)
+    with pytest.raises(ValueError, match=r"\[103\] of line 500"):
+        gtfs_route(tables, 500, {101: 1, 102: 2})
+
+
+def test_import_routes(feed, workspace, monkeypatch):
+    monkeypatch.setattr(
+        api_functions, "get_siri_operator_refs", lambda line_refs: {500: {15}}
+    )
+    fetched = []
+
+    def get_siri_stop_ids(codes):
+        fetched.append(codes)
+        return {code: code * 10 for code in codes}
+
+    monkeypatch.setattr(api_functions, "get_siri_stop_ids", get_siri_stop_ids)
+    routes_path = str(workspace / "routes.json")
+
+    [route] = import_routes([500], feed, routes_path)
+    assert route.operator_ref == 15
+    assert route.stop_ids == [1010, 1020, 1030]
+    assert fetched == [[101, 102, 103]]
+    assert get_registry(routes_path).lines[500].stop_ids == [1010, 1020, 1030]
+
+    # the siri stop ids of the imported route are reused
+    import_routes([500], feed, routes_path)
+    assert len(fetched) == 1
+
+    # line 600 is of an operator stride has no siri line of
+    with pytest.raises(ValueError, match="isn't a siri line"):
+        import_routes([600], feed, routes_path)
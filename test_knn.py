@@ -0,0 +1,80 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+import eta_grid
+import knn
+import neighbors
+from conftest import METERS_PER_DEGREE
+from eta_grid import compile_grid
+
+
+@pytest.fixture
+def vehicles(route) -> pd.DataFrame:
+    # vehicles a few meters off the route, of two slots, on the way to either of the last two stops
+    rng = np.random.default_rng(2)
+    positions = rng.uniform(0, 3000, 100)
+    lons, _ = route.points_at(positions)
+    start_times = [datetime.datetime(2025, 1, 22, 7), datetime.datetime(2025, 1, 22, 8)]
+    return pd.DataFrame(
+        {
+            "recorded_at_time": datetime.datetime(2025, 1, 22, 9),
+            "lon": lons,
+            "lat": rng.normal(0, 5, len(positions)) / METERS_PER_DEGREE,
+            "start_time": [start_times[i] for i in rng.integers(0, 2, len(positions))],
+            "next_stop_id": np.where(positions < 1000, 20, 30),
+        },
+        # not in order, so the result is ordered by the vehicles' order
+        index=rng.permutation(len(positions)) * 10,
+    )
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "route"])
+@pytest.mark.parametrize("exact", [True, False])
+@pytest.mark.parametrize(
+    "batch_matrix_locations", [neighbors.BATCH_MATRIX_LOCATIONS, 0]
+)
+def test_batch_matches_one_by_one(
+    route, neighbor_set, vehicles, monkeypatch, metric, exact, batch_matrix_locations
+):
+    grids = {
+        name: compile_grid(neighbor_set, route, k=5, spacing=5, metric=name)
+        for name in knn.METRICS
+    }
+    monkeypatch.setattr(knn, "get_route", lambda line_ref, operator_ref: route)
+    monkeypatch.setattr(knn, "get_neighbor_set", lambda *args: neighbor_set)
+    monkeypatch.setattr(
+        eta_grid,
+        "get_eta_grid",
+        lambda start_time, next_stop_id, k, metric, *args: grids[metric],
+    )
+    monkeypatch.setattr(
+        knn,
+        "time_between_stops",
+        lambda start_time, next_stop_id, next_stops, line_ref: {
+            stop: start_time.hour * 10 + stop for stop in next_stops
+        },
+    )
+    # with more locations than this, the euclidean batch searches the spatial index
+    monkeypatch.setattr(neighbors, "BATCH_MATRIX_LOCATIONS", batch_matrix_locations)
+
+    etas = knn.batch_next_stops_eta(vehicles, 1, 15, k=5, metric=metric, exact=exact)
+
+    expected = [
+        (vehicle, stop, seconds)
+        for vehicle, row in vehicles.iterrows()
+        for stop, seconds in knn.next_stops_eta(
+            row["recorded_at_time"],
+            row["lon"],
+            row["lat"],
+            row["start_time"],
+            row["next_stop_id"],
+            1,
+            15,
+            k=5,
+            metric=metric,
+            exact=exact,
+        ).items()
+    ]
+    assert list(etas.itertuples(index=False, name=None)) == expected
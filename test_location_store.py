@@ -0,0 +1,67 @@
+import os
+import pandas as pd
+
+import api_functions
+from conftest import FAKE_API_FILE, PROJECT_DIRECTORY
+from location_store import (
+    backfill,
+    get_store_version,
+    get_stored_locations,
+    get_stored_ride_ids,
+    store_locations,
+)
+
+
+def ride_ids_of(date: str) -> list:
+    data = pd.read_csv(os.path.join(PROJECT_DIRECTORY, FAKE_API_FILE))
+    return sorted(data[data["date"] == date]["id"].unique().tolist())
+
+
+def test_backfill_stores_missing_rides_and_bumps_the_version(fake_api, workspace):
+    ride_ids = ride_ids_of("2025-01-22")
+    assert get_store_version(29094, 15) == 0
+
+    saved = backfill(ride_ids[:-1], 29094, 15, rides_per_request=3, progress=False)
+    assert saved > 0
+    assert get_stored_ride_ids(29094, 15) == set(ride_ids[:-1])
+    version = get_store_version(29094, 15)
+    assert version > 0
+
+    # the stored locations are the ones of the api, latest first
+    locations = api_functions.get_locations_by_ride_id(ride_ids[:-1])
+    stored = get_stored_locations(
+        {location["siri_ride_stop_id"] for location in locations}, 29094, 15
+    )
+    assert len(stored) == saved == len(locations)
+    assert set(stored["id"]) == {location["id"] for location in locations}
+    assert stored["recorded_at_time"].is_monotonic_decreasing
+
+    # the stored rides aren't fetched again, and nothing changes
+    assert backfill(ride_ids[:-1], 29094, 15, progress=False) == 0
+    assert get_store_version(29094, 15) == version
+    assert store_locations([]) == 0
+    assert get_store_version(29094, 15) == version
+
+    # only the missing ride is fetched
+    missing = api_functions.get_locations_by_ride_id(ride_ids[-1:])
+    assert backfill(ride_ids, 29094, 15, progress=False) == len(missing)
+    assert get_stored_ride_ids(29094, 15) == set(ride_ids)
+    assert get_store_version(29094, 15) > version
+    # the version is of the line and its operator
+    assert get_store_version(29094, 3) == 0
+
+
+def test_stored_locations_are_replaced(fake_api, workspace):
+    [ride_id] = ride_ids_of("2025-01-22")[:1]
+    locations = api_functions.get_locations_by_ride_id([ride_id])
+    store_locations(locations)
+    version = get_store_version(29094, 15)
+
+    moved = [{**location, "lon": 35.0} for location in locations]
+    assert store_locations(moved) == len(locations)
+    assert get_store_version(29094, 15) > version
+    stored = get_stored_locations(
+        {location["siri_ride_stop_id"] for location in locations}, 29094, 15
+    )
+    assert len(stored) == len(locations)
+    assert (stored["lon"] == 35.0).all()
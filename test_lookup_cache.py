@@ -0,0 +1,26 @@
+import lookup_cache
+from lookup_cache import MISSING, persistent_cache
+
+
+def test_cached_none_is_told_apart_from_a_miss(workspace):
+    calls = []
+
+    @persistent_cache
+    def find_nothing(argument):
+        calls.append(argument)
+        return None
+
+    assert find_nothing.cached(1) is MISSING
+    assert find_nothing(1) is None
+    assert find_nothing.cached(1) is None
+    # from the cache file as well as from memory
+    lookup_cache.clear_memory()
+    assert find_nothing.cached(1) is None
+    assert find_nothing(1) is None
+    assert calls == [1]
+
+    find_nothing.store({2: None, 3: (4, 5)})
+    assert find_nothing.cached(2) is None
+    assert find_nothing.cached(3) == (4, 5)
+    assert find_nothing.cached(4) is MISSING
+    assert calls == [1]
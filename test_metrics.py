@@ -0,0 +1,104 @@
+import json
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def record():
+    metrics.count("rows_scanned", 10, stage="slot")
+    metrics.count("rows_scanned", 5, stage="slot")
+    metrics.count("api_calls")
+    for seconds in [0.25, 2, 100]:
+        metrics.observe("request_seconds", seconds, path="/eta", status=200)
+
+
+def test_prometheus_format(enabled):
+    record()
+    labels = 'path="/eta",status="200"'
+    buckets = [
+        ("0.0001", 0),
+        ("0.0005", 0),
+        ("0.001", 0),
+        ("0.005", 0),
+        ("0.01", 0),
+        ("0.05", 0),
+        ("0.1", 0),
+        ("0.5", 1),
+        ("1", 1),
+        ("5", 2),
+        ("10", 2),
+        ("60", 2),
+        # above every bucket
+        ("+Inf", 3),
+    ]
+    assert metrics.to_prometheus().splitlines() == [
+        "# TYPE zoozit_api_calls_total counter",
+        "zoozit_api_calls_total 1",
+        "# TYPE zoozit_rows_scanned_total counter",
+        'zoozit_rows_scanned_total{stage="slot"} 15',
+        "# TYPE zoozit_request_seconds histogram",
+        *[
+            f'zoozit_request_seconds_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in buckets
+        ],
+        f"zoozit_request_seconds_sum{{{labels}}} 102.25",
+        f"zoozit_request_seconds_count{{{labels}}} 3",
+    ]
+
+
+def test_json_lines_format(enabled):
+    record()
+    lines = [json.loads(line) for line in metrics.to_json_lines().splitlines()]
+    assert lines[:2] == [
+        {"name": "api_calls", "type": "counter", "labels": {}, "value": 1},
+        {
+            "name": "rows_scanned",
+            "type": "counter",
+            "labels": {"stage": "slot"},
+            "value": 15,
+        },
+    ]
+    [histogram] = lines[2:]
+    assert histogram["labels"] == {"path": "/eta", "status": "200"}
+    assert (histogram["count"], histogram["sum"]) == (3, 102.25)
+    assert histogram["buckets"]["0.5"] == 1
+    assert histogram["buckets"]["60"] == 2
+
+
+def test_stages_are_timed(enabled):
+    @metrics.timed("twice")
+    def twice(value):
+        return value * 2
+
+    assert twice(2) == 4
+    with metrics.span("block", line_ref=1):
+        pass
+    text = metrics.to_prometheus()
+    assert 'zoozit_stage_seconds_count{stage="twice"} 1' in text
+    assert 'zoozit_stage_seconds_count{line_ref="1",stage="block"} 1' in text
+
+
+def test_write_picks_the_format(enabled, tmp_path):
+    record()
+    metrics.write(str(tmp_path / "metrics.prom"))
+    metrics.write(str(tmp_path / "metrics.jsonl"))
+    assert (tmp_path / "metrics.prom").read_text() == metrics.to_prometheus()
+    assert (tmp_path / "metrics.jsonl").read_text() == metrics.to_json_lines()
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    metrics.reset()
+    record()
+    with metrics.span("block"):
+        pass
+    assert metrics.to_prometheus().strip() == ""
+    assert metrics.to_json_lines() == ""
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from neighbors import run_route_knn, run_route_knn_batch
+from route import (
+    PositionIndex,
+    Route,
+    get_file_route,
+    get_registry,
+    get_route,
+    save_routes,
+)
+
+
+def brute_force(positions, position, k):
+    return np.sort(np.abs(positions - position), kind="stable")[:k]
+
+
+@pytest.mark.parametrize("size", [1, 5, 300])
+@pytest.mark.parametrize("k", [1, 5, 12])
+def test_position_index_matches_brute_force(size, k):
+    rng = np.random.default_rng(size + k)
+    # rounded, so many positions are tied
+    positions = np.round(rng.uniform(0, 3000, size), -1)
+    index = PositionIndex(positions)
+    queries = np.concatenate([rng.uniform(-100, 3100, 100), positions[:10]])
+
+    many_nearest, many_distances = index.query_many(queries, k)
+    for position, batch_nearest, batch_distances in zip(
+        queries, many_nearest, many_distances
+    ):
+        nearest, distances = index.query(position, k)
+        assert distances == pytest.approx(brute_force(positions, position, k))
+        assert distances == pytest.approx(np.abs(positions[nearest] - position))
+        # the same neighbors in the same order, ties included
+        assert (batch_nearest == nearest).all()
+        assert (batch_distances == distances).all()
+
+
+def test_route_knn_batch_matches_single_queries():
+    rng = np.random.default_rng(0)
+    positions = np.round(rng.uniform(0, 3000, 200), -1)
+    times_to_arrive = rng.uniform(0, 600, 200)
+    index = PositionIndex(positions)
+    queries = np.concatenate([rng.uniform(0, 3000, 100), positions[:10]])
+    expected = [run_route_knn(index, times_to_arrive, query, 5) for query in queries]
+    assert (run_route_knn_batch(index, times_to_arrive, queries, 5) == expected).all()
+
+
+def test_projection_along_straight_segments(route):
+    lons = [route.lons[0], route.lons[1], (route.lons[1] + route.lons[2]) / 2]
+    # off the route by a bit, projected onto the closest point of it
+    lats = [0.001, 0, -0.001]
+    assert route.project_many(lons, lats) == pytest.approx([0, 1000, 2000])
+    assert route.next_stop(1500) == 30
+
+
+def test_projection_on_measured_distances(route):
+    measured = Route(
+        route.operator_ref,
+        route.line_ref,
+        route.name,
+        route.stop_ids,
+        route.codes,
+        route.lons,
+        route.lats,
+        stop_distances=[100, 1600, 3100],
+    )
+    assert measured.stop_positions == pytest.approx([0, 1500, 3000])
+    # half way between the second and third stops
+    middle = (route.lons[1] + route.lons[2]) / 2
+    assert measured.project(middle, 0) == pytest.approx(2250)
+
+    locations = pd.DataFrame(
+        {
+            "lon": [route.lons[1], middle],
+            "lat": [0, 0],
+            "distance_from_journey_start": [1700, np.nan],
+        }
+    )
+    # the measured distance where there is one, the projection where there isn't
+    assert measured.location_positions(locations) == pytest.approx([1600, 2250])
+    assert route.location_positions(locations) == pytest.approx([1000, 2000])
+
+    with pytest.raises(ValueError):
+        Route(1, 1, "", [1, 2], [1, 2], [0, 1], [0, 0], stop_distances=[10, 5])
+
+
+def test_registry_after_save_routes(route, workspace):
+    other = Route(
+        operator_ref=3,
+        line_ref=2,
+        name="other",
+        stop_ids=[40, 50],
+        codes=[400, 500],
+        lons=[0, 0.01],
+        lats=[0.01, 0.01],
+        stop_names=["first", "last"],
+        stop_distances=[0, 1200],
+    )
+    path = str(workspace / "test_routes.json")
+    save_routes([route, other], path)
+
+    registry = get_registry(path)
+    assert len(registry) == 2
+    assert get_registry(path) is registry
+    assert registry.get(1).stop_ids == [10, 20, 30]
+    assert list(registry.get(1, 15).codes) == [100, 200, 300]
+    assert registry.get(2, 3).stop_names == ["first", "last"]
+    assert registry.get(2).stop_distances == pytest.approx([0, 1200])
+    assert registry.get(2).length == pytest.approx(1200)
+    assert [route.line_ref for route in registry.of_operator(3)] == [2]
+    assert registry.of_operator(5) == []
+    with pytest.raises(ValueError, match="line 1 of operator 3"):
+        registry.get(1, 3)
+    with pytest.raises(ValueError, match="line 7"):
+        registry.get(7)
+
+    # saving again replaces the loaded routes
+    renamed = Route(
+        route.operator_ref,
+        route.line_ref,
+        "renamed",
+        route.stop_ids[1:],
+        route.codes[1:],
+        route.lons[1:],
+        route.lats[1:],
+    )
+    save_routes([renamed], path)
+    registry = get_registry(path)
+    assert len(registry) == 1
+    assert registry.get(1).name == "renamed"
+    assert registry.get(1).stop_ids == [20, 30]
+    with pytest.raises(ValueError):
+        registry.get(2)
+
+
+def test_routes_of_files(workspace):
+    # the routes file of the workspace
+    route = get_route()
+    assert get_route(route.line_ref, route.operator_ref) is route
+    for file_name in [
+        f"2025-01-01-2025-01-31,REF{route.line_ref}.csv",
+        os.path.join("data", f"2025-01-01-2025-01-31,REF{route.line_ref}.columns"),
+    ]:
+        assert get_file_route(file_name) is route
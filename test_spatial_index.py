@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from spatial_index import GridIndex
+
+
+def brute_force(lons, lats, lon, lat, k):
+    distances = np.sqrt((lons - lon) ** 2 + (lats - lat) ** 2)
+    return np.sort(distances)[:k]
+
+
+@pytest.mark.parametrize("size", [1, 7, 1000])
+@pytest.mark.parametrize("k", [1, 5, 20])
+def test_grid_index_matches_brute_force(size, k):
+    rng = np.random.default_rng(size * k)
+    # clustered around a few points, like the locations around the stops
+    centers = rng.uniform(0, 0.05, (10, 2))[rng.integers(0, 10, size)]
+    lons = 34.8 + centers[:, 0] + rng.normal(0, 0.002, size)
+    lats = 32.1 + centers[:, 1] + rng.normal(0, 0.002, size)
+    index = GridIndex(lons, lats)
+
+    # inside the points' bounding box, and outside of it
+    queries = np.column_stack(
+        [rng.uniform(34.75, 34.9, 50), rng.uniform(32.05, 32.2, 50)]
+    )
+    for lon, lat in queries:
+        nearest, distances = index.query(lon, lat, k)
+        assert len(nearest) == min(k, size)
+        assert distances == pytest.approx(brute_force(lons, lats, lon, lat, k))
+        assert distances == pytest.approx(
+            np.sqrt((lons[nearest] - lon) ** 2 + (lats[nearest] - lat) ** 2)
+        )
+
+
+def test_grid_index_of_identical_points():
+    lons, lats = np.full(10, 34.8), np.full(10, 32.1)
+    nearest, distances = GridIndex(lons, lats).query(34.8, 32.1, 3)
+    assert len(set(nearest.tolist())) == 3
+    assert (distances == 0).all()
+
+
+def test_empty_grid_index():
+    nearest, distances = GridIndex(np.array([]), np.array([])).query(34.8, 32.1, 5)
+    assert len(nearest) == len(distances) == 0
+
+
+@pytest.mark.parametrize("size", [1, 7, 1000])
+@pytest.mark.parametrize("k", [1, 5, 20])
+def test_query_many_matches_query(size, k):
+    rng = np.random.default_rng(size * k)
+    centers = rng.uniform(0, 0.05, (10, 2))[rng.integers(0, 10, size)]
+    # rounded, so some of the points are at the same distance from a position
+    lons = np.round(34.8 + centers[:, 0] + rng.normal(0, 0.002, size), 3)
+    lats = np.round(32.1 + centers[:, 1] + rng.normal(0, 0.002, size), 3)
+    index = GridIndex(lons, lats)
+
+    query_lons = np.round(rng.uniform(34.75, 34.9, 200), 3)
+    query_lats = np.round(rng.uniform(32.05, 32.2, 200), 3)
+    nearest, distances = index.query_many(query_lons, query_lats, k)
+    for i, (lon, lat) in enumerate(zip(query_lons, query_lats)):
+        expected_nearest, expected_distances = index.query(lon, lat, k)
+        assert nearest[i].tolist() == expected_nearest.tolist()
+        assert distances[i].tolist() == expected_distances.tolist()
@@ -0,0 +1,126 @@
+import datetime
+from typing import Dict
+import pandas as pd
+import pytest
+
+from conftest import copy_arrival_data
+from consts import SiriStopId
+from get_data import ARRIVAL_DATA_DTYPES, NoDataError
+from route import Route, get_file_route
+from stop_to_stop import generate_time_diffs, time_between_stops
+
+# slots of the bundled arrival data compared against the loop (the loop is slow),
+# of slots with data for every stop and of slots without
+SLOTS = 5
+SLOTS_WITHOUT_DATA = 2
+
+
+def generate_time_diffs_loop(
+    filtered_data: pd.DataFrame, start_time: datetime.datetime, route: Route
+) -> Dict[SiriStopId, float]:
+    """
+    the original per-ride implementation of stop_to_stop.calculate_time_diffs,
+    the reference the segment table is checked against.
+    """
+    stops = route.stop_ids
+    rides = filtered_data["id"].unique()
+    all_times = {stop: list() for stop in stops}
+    for i in range(1, len(stops)):
+        last = stops[i - 1]
+        curr = stops[i]
+
+        for ride in rides:
+
+            last_entry = filtered_data[
+                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == last)
+            ]
+
+            curr_entry = filtered_data[
+                (filtered_data["id"] == ride) & (filtered_data["siri_stop_id"] == curr)
+            ]
+
+            if len(curr_entry) != 1 or len(last_entry) != 1:
+                if len(curr_entry) == 0 or len(last_entry) == 0:
+                    continue
+                else:
+                    raise ValueError(
+                        f"Expected one entry for a ride, found more then one with ride {ride}, stop: {curr}, or stop: {last}"
+                    )
+            last_time = last_entry["arrival_time"].values[0]
+            curr_time = curr_entry["arrival_time"].values[0]
+            curr_time = datetime.datetime.strptime(curr_time, "%H:%M:%S")
+            last_time = datetime.datetime.strptime(last_time, "%H:%M:%S")
+
+            diff = (curr_time - last_time).total_seconds()
+            all_times[curr].append(diff)
+
+    for stop in stops[1:]:
+        if len(all_times[stop]) == 0:
+            raise ValueError(f"No data found for stop {stop} at {start_time.time()}")
+
+    times = {stop: sum(all_times[stop]) / len(all_times[stop]) for stop in stops[1:]}
+    return times
+
+
+@pytest.fixture
+def arrival_data(workspace):
+    return copy_arrival_data(workspace)
+
+
+def test_segment_table_matches_loop(arrival_data, workspace):
+    raw_data = pd.read_csv(arrival_data, dtype=ARRIVAL_DATA_DTYPES)
+    route = get_file_route(arrival_data)
+    compared, compared_without_data = 0, 0
+    for (_, start_hour), filtered_data in raw_data.groupby(
+        ["day_of_week", "start_time"]
+    ):
+        start_time = datetime.datetime.combine(
+            datetime.date.fromisoformat(filtered_data["date"].iloc[0]),
+            datetime.time.fromisoformat(start_hour),
+        )
+        try:
+            result = generate_time_diffs(start_time, route.line_ref, str(workspace))
+        except NoDataError as e:
+            if compared_without_data < SLOTS_WITHOUT_DATA:
+                with pytest.raises(ValueError, match=str(e)):
+                    generate_time_diffs_loop(filtered_data, start_time, route)
+                compared_without_data += 1
+            continue
+        if compared < SLOTS:
+            expected = generate_time_diffs_loop(filtered_data, start_time, route)
+            assert result == pytest.approx(expected)
+            compared += 1
+    assert (compared, compared_without_data) == (SLOTS, SLOTS_WITHOUT_DATA)
+
+
+def test_time_between_stops_adds_up_segments(arrival_data, workspace):
+    raw_data = pd.read_csv(arrival_data, dtype=ARRIVAL_DATA_DTYPES)
+    route = get_file_route(arrival_data)
+    for date, start_hour in zip(raw_data["date"], raw_data["start_time"]):
+        start_time = datetime.datetime.combine(
+            datetime.date.fromisoformat(date), datetime.time.fromisoformat(start_hour)
+        )
+        try:
+            segments = generate_time_diffs(start_time, route.line_ref, str(workspace))
+        except NoDataError:
+            continue
+        break
+
+    from_stop = route.stop_ids[2]
+    times = time_between_stops(
+        start_time, from_stop, line_ref=route.line_ref, directory=str(workspace)
+    )
+    assert times[from_stop] == 0
+    expected = 0
+    for stop in route.next_stops(from_stop):
+        expected += segments[stop]
+        assert times[stop] == pytest.approx(expected)
+
+    with pytest.raises(ValueError, match="comes before"):
+        time_between_stops(
+            start_time,
+            from_stop,
+            [route.stop_ids[1]],
+            route.line_ref,
+            str(workspace),
+        )
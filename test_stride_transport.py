@@ -0,0 +1,56 @@
+import datetime
+import pytest
+from dateutil import tz
+
+import api_functions
+from stride_transport import (
+    MissingRecording,
+    RecordingTransport,
+    ReplayTransport,
+    StrideTransport,
+)
+
+
+def fetch():
+    israel = tz.gettz("Israel")
+    start_times = api_functions.get_ride_start_times(
+        datetime.datetime(2025, 1, 22, 0, 0, tzinfo=israel),
+        datetime.datetime(2025, 1, 23, 0, 0, tzinfo=israel),
+        [29094],
+        [15],
+    )
+    ride_stops = api_functions.get_ride_stops(sorted(start_times)[:3])
+    return start_times, ride_stops
+
+
+def test_record_and_replay(fake_api, workspace, monkeypatch):
+    path = str(workspace / "recording.json.gz")
+    recording = RecordingTransport(path, StrideTransport())
+    monkeypatch.setattr(api_functions, "transport", recording)
+    start_times, ride_stops = fetch()
+    assert len(start_times) > 0 and len(ride_stops) > 0
+    recording.save()
+
+    # the replay doesn't need the api
+    fake_api.shutdown()
+    monkeypatch.setattr(api_functions, "transport", ReplayTransport(path))
+    replayed_start_times, replayed_ride_stops = fetch()
+    assert replayed_start_times == start_times
+    assert all(
+        isinstance(start_time, datetime.datetime)
+        for start_time in replayed_start_times.values()
+    )
+    assert replayed_ride_stops == ride_stops
+
+    with pytest.raises(MissingRecording):
+        api_functions.get_ride_stops([1])
+
+
+def test_recording_is_added_to(fake_api, workspace, monkeypatch):
+    path = str(workspace / "recording.json.gz")
+    for ride_id in [1, 2]:
+        recording = RecordingTransport(path, StrideTransport())
+        monkeypatch.setattr(api_functions, "transport", recording)
+        api_functions.get_ride_stops([ride_id])
+        recording.save()
+    assert len(ReplayTransport(path).responses) == 2